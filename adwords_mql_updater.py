@@ -1,19 +1,29 @@
+from startup_profile import StartupProfile
+
 import argparse
 import configparser
-import hashlib
 import json
 import logging
 import os
+import signal
 import sys
-from collections import namedtuple
+import threading
+from collections import namedtuple, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+from functools import partial
 from pathlib import Path
 from typing import List
 
-import pandas as pd
 import psycopg2
-import sklearn
-from sklearn.externals import joblib
 
+from db_pool import ConnectionPool
+from event_intake import sql_ready_candidates, acknowledge_events, prune_events, PLATFORM_MOBILE, PLATFORM_WEB, \
+    WEB_USER_AFF_IDS
+from id_binding import bound_user_ids
+from ledger import PredictionLedger
+from stage_scheduler import Stage, run_stages, run_periodically, select_stages
+from tracing import tracer
 from utils import sql_get_unhandled_mobile_users, \
     sql_insert_mobile_mql_for_users, sql_insert_web_mql_for_users, sql_get_unhandled_web_users, \
     sql_insert_web_non_predicted_deponators, sql_insert_mobile_predicted_deponators
@@ -26,28 +36,45 @@ APPS_FLYER_TABLE = 'apps_flyer'
 ADWORDS_CLICK_HISTORY = 'user_adwords_click_history'
 HOURS_AFTER_REG = 24 * 7
 DAYS_BEFORE_NOW = 3
+# Daemon mode: seconds between starts of a stage, per stage in the [schedule] section of the config
+DEFAULT_STAGE_INTERVAL = 300
+# Features are aggregated up to created + 1 day; the grace covers replication lag of GP
+WINDOW_GRACE_HOURS = 2
 
 LOG_LEVEL = "INFO"
 # LOG_LEVEL = "INFO"
 LOG_FILE = '/var/log/ltv-predict/main.log'
 
 logger = logging.getLogger()
-logger.setLevel(LOG_LEVEL)
-ch = logging.StreamHandler()
-ch.setLevel(LOG_LEVEL)
-formatter = logging.Formatter(
-    '%(asctime)s [%(filename)s.%(lineno)d] %(processName)s %(levelname)-1s %(name)s - %(message)s')
-ch.setFormatter(formatter)
-logger.addHandler(ch)
-fh = logging.FileHandler(LOG_FILE)
-fh.setLevel(LOG_LEVEL)
-fh.setFormatter(formatter)
-logger.addHandler(fh)
-
-AppConfig = namedtuple("AppConfig", "gp_user, gp_pass, wp_user, wp_pass, ver_ignore, model_path")
-
-
-def sql_user_data(user_ids):
+# Scoring stages need the model, pandas and numpy; these are imported only when one of them runs
+SCORING_STAGES = ['mobile_users', 'web_users']
+STAGE_NAMES = SCORING_STAGES + ['web_deponators', 'mobile_deponators']
+
+
+def setup_logging(log_file=LOG_FILE):
+    # Called after argument parsing, so importing this module has no side effects
+    logger.setLevel(LOG_LEVEL)
+    ch = logging.StreamHandler()
+    ch.setLevel(LOG_LEVEL)
+    formatter = logging.Formatter(
+        '%(asctime)s [%(filename)s.%(lineno)d] %(processName)s %(levelname)-1s %(name)s - %(message)s')
+    ch.setFormatter(formatter)
+    logger.addHandler(ch)
+    if log_file:
+        fh = logging.FileHandler(log_file)
+        fh.setLevel(LOG_LEVEL)
+        fh.setFormatter(formatter)
+        logger.addHandler(fh)
+
+
+AppConfig = namedtuple("AppConfig", "gp_user, gp_pass, wp_user, wp_pass, ver_ignore, model_path, prefetch, "
+                                    "max_sessions, gp_session, wpad_session, ledger_path, daemon, interval, "
+                                    "intervals, event_intake, stages, log_file, profile_startup, model_name, gp_dsn, "
+                                    "wpad_dsn, gp_distributed, metrics_json, metrics_textfile")
+Pools = namedtuple("Pools", "gp wpad")
+
+
+def sql_user_data(user_ids_table, window_grace_hours=WINDOW_GRACE_HOURS):
     return f"""
     WITH 
         required_users AS (
@@ -63,9 +90,11 @@ def sql_user_data(user_ids):
             u.is_regulated                      AS is_regulated,
             u.is_public                         AS is_public,
             (u.nickname IS NOT NULL)            AS has_nik,
-            u.created                           AS created
+            u.created                           AS created,
+            u.created + INTERVAL '1 day'        AS window_end,
+            (u.created + INTERVAL '1 day' + INTERVAL '{window_grace_hours} hours' <= now()) AS window_closed
           FROM users u
-          WHERE u.user_id in ({",".join([str(x) for x in user_ids])})),
+          WHERE u.user_id in (SELECT user_id FROM {user_ids_table})),
         ni_data AS (SELECT
                       ap.user_id,
                       --                   extract(EPOCH FROM (min(ap.create_at) - u.created)) AS first_deal_interval,
@@ -188,6 +217,8 @@ def sql_user_data(user_ids):
       u.is_public,
       u.has_nik,
       u.created,
+      u.window_end,
+      u.window_closed,
       coalesce(n.volume_train_digital, 0) AS volume_train_digital,
       coalesce(n.pnl_train_digital, 0) AS pnl_train_digital,
       coalesce(n.volume_train_cfd, 0) AS volume_train_cfd,
@@ -215,7 +246,7 @@ def sql_user_data(user_ids):
     """
 
 
-def sql_user_stat_tags_wpad(user_ids, days_after_reg=1):
+def sql_user_stat_tags_wpad(user_ids_table, days_after_reg=1):
     return f"""
     SELECT
       t.user_id,
@@ -263,10 +294,10 @@ def sql_user_stat_tags_wpad(user_ids, days_after_reg=1):
           ELSE 0 END) AS trading_indicator_added
 
     FROM stat_tags t LEFT JOIN users u ON t.user_id = u.user_id
-      WHERE t.user_id in ({",".join([str(x) for x in user_ids])}) AND t.tag_time < (u.created + INTERVAL '{days_after_reg} day')
+      WHERE t.user_id in (SELECT user_id FROM {user_ids_table}) AND t.tag_time < (u.created + INTERVAL '{days_after_reg} day')
     GROUP BY t.user_id
     """
-def sql_user_stat_tags_gp(user_ids, days_after_reg=1):
+def sql_user_stat_tags_gp(user_ids_table, days_after_reg=1):
     return f"""
     SELECT
       ut.user_id,
@@ -315,7 +346,7 @@ def sql_user_stat_tags_gp(user_ids, days_after_reg=1):
     
     FROM user_tags ut LEFT JOIN users u ON ut.user_id = u.user_id
       INNER JOIN tags t ON ut.tag_id = t.id
-    WHERE ut.user_id IN ({",".join([str(x) for x in user_ids])})
+    WHERE ut.user_id IN (SELECT user_id FROM {user_ids_table})
           AND ut.created < (u.created + INTERVAL '{days_after_reg} day')
     GROUP BY ut.user_id
     """
@@ -335,82 +366,10 @@ def get_field_from_cfg(cfg, field):
     return cfg[field]
 
 
-def features_engineering(df):
-    result = pd.DataFrame()
-    # Features
-    # age
-    result["age_18_24"] = ((df["age"] >= 18) & (df["age"] < 24))
-    result["age_24_30"] = ((df["age"] >= 24) & (df["age"] < 30))
-    result["age_30_40"] = ((df["age"] >= 30) & (df["age"] < 40))
-    result["age_40_50"] = ((df["age"] >= 40) & (df["age"] < 50))
-    result["age_50_80"] = ((df["age"] >= 50) & (df["age"] <= 80))
-    result["age_trash"] = ((df["age"] < 18) | (df["age"] > 80))
-
-    # gender
-    result["gender_1"] = df["gender"] == 1
-    result["gender_2"] = df["gender"] == 2
-
-    # currency_id
-    result['currency_id_5'] = df['currency_id'] == 5
-    result['currency_id_1'] = df['currency_id'] == 1
-    result['currency_id_2'] = df['currency_id'] == 2
-    result['currency_id_6'] = df['currency_id'] == 6
-    result['currency_id_7'] = df['currency_id'] == 7
-    result['currency_id_4'] = df['currency_id'] == 4
-    result['currency_id_8'] = df['currency_id'] == 8
-
-    # client_platform_id
-    result['client_platform_id_2'] = df['client_platform_id'] == 2
-    result['client_platform_id_9'] = df['client_platform_id'] == 9
-    result['client_platform_id_3'] = df['client_platform_id'] == 3
-    result['client_platform_id_12'] = df['client_platform_id'] == 12
-
-    result['used_historical_prices'] = df['used_historical_prices']
-    result['tried_to_change_asset'] = df['tried_to_change_asset']
-    result['changed_deal_amount_manualy'] = df['changed_deal_amount_manualy']
-    result['visit_traderoom'] = df['visit_traderoom']
-    result['button_deposit_pag'] = df['button_deposit_pag']
-    result['visited_withdrawal_page'] = df['visited_withdrawal_page']
-    result['added_technical_analysis'] = df['added_technical_analysis']
-    result['changed_chart_type'] = df['changed_chart_type']
-    result['open_video_tutorial'] = df['open_video_tutorial']
-    result['sell_option_used'] = df['sell_option_used']
-    result['refreshed_demo'] = df['refreshed_demo']
-    result['phone_confirmed'] = df['phone_confirmed']
-    result['user_use_buyback'] = df['user_use_buyback']
-    result['trading_indicator_added'] = df['trading_indicator_added']
-
-    result['volume_train_digital'] = df['volume_train_digital']
-    result['pnl_train_digital'] = df['pnl_train_digital']
-    result['volume_train_cfd'] = df['volume_train_cfd']
-    result['pnl_train_cfd'] = df['pnl_train_cfd']
-    result['volume_train_forex'] = df['volume_train_forex']
-    result['pnl_train_forex'] = df['pnl_train_forex']
-    result['volume_train_crypto'] = df['volume_train_crypto']
-    result['pnl_train_crypto'] = df['pnl_train_crypto']
-    result['closed_count'] = df['closed_count']
-    result['instrument_actives_count'] = df['instrument_actives_count']
-    result['instrument_actives_digital_count'] = df['instrument_actives_digital_count']
-    result['instrument_actives_cfd_count'] = df['instrument_actives_cfd_count']
-    result['instrument_actives_forex_count'] = df['instrument_actives_forex_count']
-    result['instrument_actives_crypto_count'] = df['instrument_actives_crypto_count']
-    result['digital_count'] = df['digital_count']
-    result['cfd_count'] = df['cfd_count']
-    result['forex_count'] = df['forex_count']
-    result['crypto_count'] = df['crypto_count']
-    result['bin_count'] = df['bin_count']
-    result['volume_train_bin'] = df['volume_train_bin']
-    result['pnl_train_bin'] = df['pnl_train_bin']
-    result['instrument_actives_bin_count'] = df['instrument_actives_bin_count']
-
-    result = result.fillna(0)
-    return result
-
-
 def read_model(model_name, model_path, ignore_wrong_version=False):
-    model_file_path = model_path + "/" + model_name + '.pkl'
+    from tree_artifact import read_artifact
+
     model_cfg_path = model_path + "/" + model_name + '.json'
-    check_path(Path(model_file_path))
     check_path(Path(model_cfg_path))
     cfg_json = None
     logger.info(f"Read model cfg {model_cfg_path}")
@@ -418,8 +377,26 @@ def read_model(model_name, model_path, ignore_wrong_version=False):
         cfg_json = json.load(cfg_json_file)
     logger.info("Cfg loaded")
     logger.debug("Cfg:%s", cfg_json)
-    logger.info(f"Read classifier {model_file_path}")
     main_threshold = get_field_from_cfg(cfg_json, 'main_threshold')
+    if 'artifact' in cfg_json:
+        # Tree artifacts don't depend on the sklearn version and are shared between processes via mmap
+        artifact_path = model_path + "/" + cfg_json['artifact']
+        check_path(Path(artifact_path))
+        logger.info(f"Read tree artifact {artifact_path}")
+        clf = read_artifact(artifact_path)
+        logger.info(f"Classifier loaded: trees={clf.n_trees} max_depth={clf.max_depth}")
+        return clf, main_threshold, cfg_json
+    return read_pickled_model(model_name, model_path, cfg_json, ignore_wrong_version), main_threshold, cfg_json
+
+
+def read_pickled_model(model_name, model_path, cfg_json, ignore_wrong_version=False):
+    import sklearn
+    from sklearn.externals import joblib
+    from tree_engine import CompiledForest, ENGINE_RANDOM_FOREST
+
+    model_file_path = model_path + "/" + model_name + '.pkl'
+    check_path(Path(model_file_path))
+    logger.info(f"Read classifier {model_file_path}")
     sklearn_v = get_field_from_cfg(cfg_json, 'sklearn_v')
     if sklearn_v != sklearn.__version__:
         if not ignore_wrong_version:
@@ -427,7 +404,14 @@ def read_model(model_name, model_path, ignore_wrong_version=False):
             sys.exit(1)
     clf = joblib.load(model_file_path)
     logger.info("Classifier loaded")
-    return clf, main_threshold, cfg_json
+    # Models without the engine field are sklearn forests. Boosting models are saved already compiled.
+    if cfg_json.get('engine', ENGINE_RANDOM_FOREST) == ENGINE_RANDOM_FOREST:
+        try:
+            clf = CompiledForest.from_sklearn(clf)
+            logger.info(f"Classifier compiled: trees={clf.n_trees} max_depth={clf.max_depth}")
+        except ValueError as e:
+            logger.warning(f"Can't compile classifier, sklearn predict will be used: {e}")
+    return clf
 
 
 def make_class_prediction(clf, X, threshold):
@@ -449,57 +433,73 @@ def get_web_users_for_prediction(wpad_connect) -> List[int]:
     return __get_users_for_prediction(wpad_connect, sql)
 
 
+def get_mobile_candidates_from_events(wpad_connect) -> List[int]:
+    prune_events(wpad_connect, PLATFORM_MOBILE, MQL_MOBILE_TARGET_TABLE)
+    sql = sql_ready_candidates(PLATFORM_MOBILE, MQL_MOBILE_TARGET_TABLE, WINDOW_GRACE_HOURS)
+    return __get_users_for_prediction(wpad_connect, sql)
+
+
+def get_web_candidates_from_events(wpad_connect) -> List[int]:
+    prune_events(wpad_connect, PLATFORM_WEB, MQL_WEB_TARGET_TABLE)
+    sql = sql_ready_candidates(PLATFORM_WEB, MQL_WEB_TARGET_TABLE, WINDOW_GRACE_HOURS, WEB_USER_AFF_IDS)
+    return __get_users_for_prediction(wpad_connect, sql)
+
+
 def __get_users_for_prediction(wpad_connect, sql) -> List[int]:
     logger.info("Get user for prediction")
     result = []
     try:
-        with wpad_connect.cursor() as cur:
+        with wpad_connect.cursor() as cur, tracer.span('candidates') as span:
             logger.debug("Execute query 'get unhandled users'. SQL:%s", repr(sql))
             cur.execute(sql)
             result = [x[0] for x in cur.fetchall()]
+            span.rows = len(result)
     finally:
         wpad_connect.commit()
     logger.info("Unhandled users count: %s", len(result))
     return result
 
 
-def sql_query_to_dataframe(sql, connection):
-    outputquery = "COPY ({0}) TO STDOUT WITH CSV HEADER DELIMITER ','".format(sql)
-    output_file_path = "/tmp/" + str(hashlib.sha1(outputquery.encode()).hexdigest()) + ".csv"
-    try:
-        connection.autocommit = True
-        with connection.cursor() as cur, open(output_file_path, "w") as file:
-            logger.info(f"Copy data from sql to {output_file_path} ...")
-            cur.copy_expert(outputquery, file)
-            logger.info(f"Copy successfully complete ...")
-    finally:
-        connection.autocommit = False
-        connection.commit()
-    return pd.read_csv(output_file_path)
+def sql_query_to_dataframe(sql, cursor, dtypes=None, span_name='copy', chunk_num=None):
+    from copy_reader import copy_query_to_dataframe
+
+    logger.info("Copy data from sql ...")
+    with tracer.span(span_name, chunk_num) as span:
+        df, bytes_read = copy_query_to_dataframe(cursor, sql, dtypes)
+        span.rows, span.bytes = len(df), bytes_read
+    logger.info(f"Copy successfully complete. Rows: {len(df)}, bytes: {bytes_read}")
+    return df
 
 
-def get_dataset_for_users(gp_connect, user_ids):
+def get_dataset_for_users(gp_connect, user_ids, distributed=True, chunk_num=None):
     # 'c_actives_train_count' 10317
     logger.info("Get dataset for users")
-    sql_for_user_data = sql_user_data(user_ids)
-    sql_for_stat_tags = sql_user_stat_tags_gp(user_ids)
-    logger.debug("Query user data. SQL:%s", repr(sql_for_user_data))
-    logger.debug("Query stat tags data. SQL:%s", repr(sql_for_stat_tags))
-        # user_data = sqlio.read_sql_query(sql_for_user_data, gp_connect)
-    # user_tagas_data = sqlio.read_sql_query(sql_for_stat_tags, wpad_connect)
-    logger.info("Get user data from GP")
-    user_data = sql_query_to_dataframe(sql_for_user_data, gp_connect)
-    logger.info("Get tags data from GP")
-    user_tagas_data = sql_query_to_dataframe(sql_for_stat_tags, gp_connect)
-
-    logger.info("Combine to one dataset")
-    ds_users_i = user_data.set_index('user_id')
-    ds_stat_tags_i = user_tagas_data.set_index('user_id')
-
-    data_i = ds_users_i.combine_first(ds_stat_tags_i)
-    data = data_i.reset_index()
-    data[ds_stat_tags_i.columns.values] = data[ds_stat_tags_i.columns.values].fillna(0)
-    return data
+    with tracer.span('fetch', chunk_num) as span:
+        with bound_user_ids(gp_connect, user_ids, distributed=distributed) as user_ids_table, \
+                gp_connect.cursor() as cur:
+            sql_for_user_data = sql_user_data(user_ids_table)
+            sql_for_stat_tags = sql_user_stat_tags_gp(user_ids_table)
+            logger.debug("Query user data. SQL:%s", repr(sql_for_user_data))
+            logger.debug("Query stat tags data. SQL:%s", repr(sql_for_stat_tags))
+            logger.info("Get user data from GP")
+            user_data = sql_query_to_dataframe(sql_for_user_data, cur, span_name='copy_user_data',
+                                               chunk_num=chunk_num)
+            logger.info("Get tags data from GP")
+            user_tagas_data = sql_query_to_dataframe(sql_for_stat_tags, cur, span_name='copy_stat_tags',
+                                                     chunk_num=chunk_num)
+
+        logger.info("Combine to one dataset")
+        with tracer.span('join', chunk_num) as join_span:
+            df = combine_user_datasets(user_data, user_tagas_data)
+            join_span.rows = span.rows = len(df)
+    return df
+
+
+def combine_user_datasets(user_data, user_tags_data):
+    from frame_join import join_on_key, JoinSource
+
+    # Users without tags get zero counters
+    return join_on_key([JoinSource(user_data, None), JoinSource(user_tags_data, 0)])
 
 
 def execute_and_fill_df(conn, sql):
@@ -508,71 +508,258 @@ def execute_and_fill_df(conn, sql):
     local_cursor.fetchall()
 
 
-MQLData = namedtuple("MQLData", "user_id is_mql proba")
+MQLData = namedtuple("MQLData", "user_id is_mql proba window_end window_closed")
 
 
-def find_mqls(gp_connect, user_ids, chunk_size) -> List[MQLData]:
+def find_mqls(gp_connect, user_ids, chunk_size, prefetch=0, gp_pool=None, distributed=True) -> List[MQLData]:
     logger.info("Find mqls")
     result = []
-    for chunk_num, user_ids_batch in enumerate(chunker(user_ids, chunk_size)):
-        logger.info(f"Handle chunk_num: {chunk_num}")
-        df = get_dataset_for_users(gp_connect, user_ids_batch)
-        if len(df) == 0:
-            logger.warning("No MQLs found: %s", result)
-        else:
-            logger.debug("Dataframe:\n%s", df)
-            X_df = features_engineering(df)
-            X = X_df.as_matrix()
-            y, proba_xs = make_class_prediction(clf, X, main_threshold)
-            for i, user_id in enumerate(df['user_id']):
-                result.append(MQLData(user_id=user_id, is_mql=y[i], proba=proba_xs[i]))
-            logger.debug("Mqls found: %s", result)
+    user_id_chunks = chunker(user_ids, chunk_size)
+    if prefetch > 0:
+        datasets = prefetch_datasets(gp_pool, user_id_chunks, prefetch, distributed)
+    else:
+        datasets = (get_dataset_for_users(gp_connect, user_ids_batch, distributed, chunk_num)
+                    for chunk_num, user_ids_batch in enumerate(user_id_chunks))
+    with closing(datasets):
+        for chunk_num, df in enumerate(datasets):
+            logger.info(f"Handle chunk_num: {chunk_num}")
+            if len(df) == 0:
+                logger.warning("No MQLs found: %s", result)
+            else:
+                logger.debug("Dataframe:\n%s", df)
+                result.extend(predict_mqls(df, encoder, clf, main_threshold, chunk_num))
+                logger.debug("Mqls found: %s", result)
     return result
 
 
+def predict_mqls(df, feature_encoder, model, threshold, chunk_num=None) -> List[MQLData]:
+    with tracer.span('encode', chunk_num) as span:
+        X = feature_encoder.encode(df)
+        span.rows = len(X)
+    with tracer.span('predict', chunk_num) as span:
+        y, proba_xs = make_class_prediction(model, X, threshold)
+        span.rows = len(y)
+    window_closed = df['window_closed'].fillna(False).values.astype(bool)
+    return [MQLData(user_id=user_id, is_mql=y[i], proba=proba_xs[i], window_end=window_end,
+                    window_closed=window_closed[i])
+            for i, (user_id, window_end) in enumerate(zip(df['user_id'], df['window_end']))]
+
+
+def prefetch_datasets(gp_pool, user_id_chunks, depth, distributed=True):
+    # Fetches up to `depth` chunks ahead on a worker thread with a pooled GP connection,
+    # while the caller encodes and scores the current one. Chunks are yielded in order.
+    stage = tracer.current_stage()
+
+    def fetch(chunk_num, user_ids_batch):
+        with gp_pool.connection() as gp_connect, tracer.in_stage(stage):
+            return get_dataset_for_users(gp_connect, user_ids_batch, distributed, chunk_num)
+
+    executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="gp-prefetch")
+    pending = deque()
+    try:
+        for chunk_num, user_ids_batch in enumerate(user_id_chunks):
+            pending.append(executor.submit(fetch, chunk_num, user_ids_batch))
+            if len(pending) > depth:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=True)
+
+
 def save_mobile_mgl_data(wpad_connect, users_with_mql: List[MQLData]):
     __save_mgl_data(wpad_connect, MQL_MOBILE_TARGET_TABLE, users_with_mql,
-                    lambda user_ids: sql_insert_mobile_mql_for_users(MQL_MOBILE_TARGET_TABLE, user_ids))
+                    lambda user_ids_table: sql_insert_mobile_mql_for_users(MQL_MOBILE_TARGET_TABLE, user_ids_table))
 
 
 def save_web_mgl_data(wpad_connect, users_with_mql: List[MQLData]):
     __save_mgl_data(wpad_connect, MQL_WEB_TARGET_TABLE, users_with_mql,
-                    lambda user_ids: sql_insert_web_mql_for_users(ADWORDS_CLICK_HISTORY, MQL_WEB_TARGET_TABLE,
-                                                                  user_ids))
+                    lambda user_ids_table: sql_insert_web_mql_for_users(ADWORDS_CLICK_HISTORY, MQL_WEB_TARGET_TABLE,
+                                                                        user_ids_table))
 
 
 def __save_mgl_data(wpad_connect, taret_table_name, users_with_mql: List[MQLData], userids_to_sql_fun):
     only_mql_user_ids = [data.user_id for data in users_with_mql if data.is_mql]
     if len(only_mql_user_ids) > 0:
-        sql = userids_to_sql_fun(only_mql_user_ids)
-        try:
-            with wpad_connect.cursor() as cur:
-                logger.info(f"Start inserting MQL data to {taret_table_name}.")
-                logger.debug("Inserting MQL data SQL:%s", repr(sql))
-                cur.execute(sql)
-                rowcount = cur.rowcount
-                logger.info(f"Complete inserting MQL data to {taret_table_name}. Row count:({rowcount}).")
-        finally:
-            wpad_connect.commit()
+        with tracer.span('insert_mql') as span, bound_user_ids(wpad_connect, only_mql_user_ids) as user_ids_table, \
+                wpad_connect.cursor() as cur:
+            sql = userids_to_sql_fun(user_ids_table)
+            logger.info(f"Start inserting MQL data to {taret_table_name}.")
+            logger.debug("Inserting MQL data SQL:%s", repr(sql))
+            cur.execute(sql)
+            rowcount = span.rows = cur.rowcount
+            logger.info(f"Complete inserting MQL data to {taret_table_name}. Row count:({rowcount}).")
 
     else:
         logger.warning("No MQL data")
 
 
-def execute_common_insert_sql(sql):
+def execute_common_insert_sql(wpad_connect, sql):
     try:
-        with wpad_connect.cursor() as cur:
+        with wpad_connect.cursor() as cur, tracer.span('insert_deponators') as span:
             logger.info(f"Start common inserting.")
             logger.debug("Commn inserting SQL:%s", repr(sql))
             cur.execute(sql)
-            rowcount = cur.rowcount
+            rowcount = span.rows = cur.rowcount
             logger.info(f"Complete common Row count:({rowcount}).")
     finally:
         wpad_connect.commit()
 
 
-def connect_to_gp(gp_user, gp_pass):
+def skip_frozen_users(ledger, user_ids):
+    if ledger is None:
+        return user_ids
+    frozen = ledger.frozen_user_ids()
+    result = [user_id for user_id in user_ids if user_id not in frozen]
+    logger.info(f"Skip users already scored with a closed feature window: {len(user_ids) - len(result)}")
+    return result
+
+
+def record_predictions(ledger, users_with_mql: List[MQLData]):
+    if ledger is not None:
+        ledger.record(users_with_mql)
+
+
+def handled_user_ids(candidates, user_ids, users_with_mql: List[MQLData]):
+    # Candidates sent to scoring without features in GP stay in the outbox and are tried again.
+    # Candidates skipped by the ledger were scored before and are handled too.
+    not_found = set(user_ids) - {data.user_id for data in users_with_mql}
+    return [user_id for user_id in candidates if user_id not in not_found]
+
+
+def handle_mobile_users(pools, ledger, config):
+    with pools.gp.connection() as gp_connect, pools.wpad.connection(autocommit=True) as wpad_connect:
+        logger.info("Handle mobile users")
+        if config.event_intake:
+            candidates = get_mobile_candidates_from_events(wpad_connect)
+        else:
+            candidates = get_mobile_users_for_prediction(wpad_connect)
+        mobile_user_ids = skip_frozen_users(ledger, candidates)
+        mobile_users_with_mql: List[MQLData] = find_mqls(gp_connect, mobile_user_ids, CHUNK_SIZE,
+                                                         config.prefetch, pools.gp, config.gp_distributed)
+        logger.debug(mobile_users_with_mql)
+        save_mobile_mgl_data(wpad_connect, mobile_users_with_mql)
+        record_predictions(ledger, mobile_users_with_mql)
+        if config.event_intake:
+            handled = handled_user_ids(candidates, mobile_user_ids, mobile_users_with_mql)
+            acknowledge_events(wpad_connect, PLATFORM_MOBILE, handled)
+
+
+def handle_web_users(pools, ledger, config):
+    with pools.gp.connection() as gp_connect, pools.wpad.connection(autocommit=True) as wpad_connect:
+        logger.info("Handle web users")
+        if config.event_intake:
+            candidates = get_web_candidates_from_events(wpad_connect)
+        else:
+            candidates = get_web_users_for_prediction(wpad_connect)
+        web_user_ids = skip_frozen_users(ledger, candidates)
+        web_users_with_mql: List[MQLData] = find_mqls(gp_connect, web_user_ids, CHUNK_SIZE,
+                                                      config.prefetch, pools.gp, config.gp_distributed)
+        save_web_mgl_data(wpad_connect, web_users_with_mql)
+        record_predictions(ledger, web_users_with_mql)
+        if config.event_intake:
+            handled = handled_user_ids(candidates, web_user_ids, web_users_with_mql)
+            acknowledge_events(wpad_connect, PLATFORM_WEB, handled)
+
+
+def handle_web_deponators(pools, config):
+    with pools.wpad.connection(autocommit=True) as wpad_connect:
+        logger.info("Handle non predicted web deponators")
+        web_i_sql = sql_insert_web_non_predicted_deponators(MQL_WEB_TARGET_TABLE, hours_after_reg=HOURS_AFTER_REG,
+                                                            days_before_now=DAYS_BEFORE_NOW)
+        execute_common_insert_sql(wpad_connect, web_i_sql)
+
+
+def handle_mobile_deponators(pools, config):
+    with pools.wpad.connection(autocommit=True) as wpad_connect:
+        logger.info("Handle non predicted mobile deponators")
+        mob_i_sql = sql_insert_mobile_predicted_deponators(MQL_MOBILE_TARGET_TABLE, hours_after_reg=HOURS_AFTER_REG,
+                                                           days_before_now=DAYS_BEFORE_NOW)
+        execute_common_insert_sql(wpad_connect, mob_i_sql)
+
+
+def make_stages(pools, ledger, config):
+    # Deponator inserts skip users already queued, so they run after scoring of the same platform
+    scoring_sessions = 2 + (1 if config.prefetch > 0 else 0)
+    stages = [Stage("mobile_users", partial(handle_mobile_users, pools, ledger, config), scoring_sessions, []),
+              Stage("web_users", partial(handle_web_users, pools, ledger, config), scoring_sessions, []),
+              Stage("web_deponators", partial(handle_web_deponators, pools, config), 1, ["web_users"]),
+              Stage("mobile_deponators", partial(handle_mobile_deponators, pools, config), 1, ["mobile_users"])]
+    stages = [stage._replace(fn=partial(tracer.run_stage, stage.name, stage.fn)) for stage in stages]
+    return select_stages(stages, config.stages)
+
+
+def load_model(config):
+    # Scoring in find_mqls uses these globals; the daemon replaces them between cycles on SIGHUP
+    global clf, main_threshold, encoder
+    from feature_encoder import FeatureEncoder
+
+    model, threshold, cfg_json = read_model(model_name=config.model_name, model_path=config.model_path,
+                                            ignore_wrong_version=config.ver_ignore)
+    model_encoder = FeatureEncoder(get_field_from_cfg(cfg_json, 'feature_columns'))
+    clf, main_threshold, encoder = model, threshold, model_encoder
+
+
+def run_service(stages, ledger, config):
+    # Model, pools and encoder stay warm between cycles. SIGTERM/SIGINT stop the service after the current
+    # cycle, SIGHUP reloads the model before the next one.
+    stop_requested = threading.Event()
+    reload_requested = threading.Event()
+    wakeup = threading.Event()
+
+    def on_stop(signum, frame):
+        stop_requested.set()
+        wakeup.set()
+
+    def on_reload(signum, frame):
+        reload_requested.set()
+        wakeup.set()
+
+    signal.signal(signal.SIGTERM, on_stop)
+    signal.signal(signal.SIGINT, on_stop)
+    signal.signal(signal.SIGHUP, on_reload)
+
+    def before_cycle():
+        if reload_requested.is_set():
+            reload_requested.clear()
+            logger.info("Reload model")
+            try:
+                load_model(config)
+            except (Exception, SystemExit):
+                logger.exception("Model reload failed, the loaded model is kept.")
+        if ledger is not None:
+            ledger.prune()
+
+    unknown = set(config.intervals) - {stage.name for stage in stages}
+    if unknown:
+        logger.warning(f"Unknown stages in [schedule]: {sorted(unknown)}")
+    intervals = {stage.name: config.intervals.get(stage.name, config.interval) for stage in stages}
+    logger.info(f"Run as a service, stage intervals: {intervals}")
+    run_periodically(stages, intervals, config.max_sessions, wakeup, stop_requested.is_set, before_cycle,
+                     lambda results: export_metrics(config))
+    logger.info("Service stopped")
+
+
+def export_metrics(config):
+    # Summary of one run (a cycle in the daemon mode), the next run starts with no spans
+    tracer.export(config.metrics_json, config.metrics_textfile)
+    tracer.reset()
+
+
+def make_pools(config) -> Pools:
+    gp_pool = ConnectionPool(partial(connect_to_gp, config.gp_user, config.gp_pass, config.gp_dsn), "GP",
+                             maxconn=config.max_sessions, session_settings=config.gp_session)
+    wpad_pool = ConnectionPool(partial(connect_to_wpad, config.wp_user, config.wp_pass, config.wpad_dsn), "WPAD02",
+                               maxconn=config.max_sessions, session_settings=config.wpad_session)
+    return Pools(gp=gp_pool, wpad=wpad_pool)
+
+
+def connect_to_gp(gp_user, gp_pass, dsn=None):
     logger.info("Connect to GP")
+    if dsn:
+        return psycopg2.connect(dsn, user=gp_user, password=gp_pass)
     return psycopg2.connect(database="reporting",
                             user=gp_user,
                             password=gp_pass,
@@ -580,8 +767,10 @@ def connect_to_gp(gp_user, gp_pass):
                             port=6432)
 
 
-def connect_to_wpad(wp_user, wp_pass):
+def connect_to_wpad(wp_user, wp_pass, dsn=None):
     logger.info("Connect to WPAD02")
+    if dsn:
+        return psycopg2.connect(dsn, user=wp_user, password=wp_pass)
     return psycopg2.connect(database="options_analytics",
                             user=wp_user,
                             password=wp_pass,
@@ -593,10 +782,57 @@ def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument("-c", "--config", type=str, help="App config", required=True)
     parser.add_argument("--model_path", type=str, help="Path to model")
+    parser.add_argument("--model_name", type=str, default=MODEL_NAME, help="Name of the model files")
+    parser.add_argument("--prefetch", type=int, default=0,
+                        help="Chunks fetched from GP ahead of scoring on a separate connection (0 - sequential)")
+    parser.add_argument("--max_sessions", type=int, default=4, help="Max DB sessions used by concurrent stages")
+    parser.add_argument("--ledger_path", type=str,
+                        help="SQLite file of scored users. Users scored after their feature window closed are skipped")
+    parser.add_argument("--event_intake", action='store_true',
+                        help="Take candidates from the outbox of event_intake.py instead of scanning 10 days")
+    parser.add_argument("--stages", nargs='+', choices=STAGE_NAMES, default=STAGE_NAMES,
+                        help="Stages to run. The model is loaded only for mobile_users and web_users")
+    parser.add_argument("--log_file", type=str, default=LOG_FILE, help="Log file ('' - log to stderr only)")
+    parser.add_argument("--profile_startup", action='store_true',
+                        help="Report import and initialization time up to the DB connections and exit")
+    parser.add_argument("--metrics_json", type=str,
+                        help="JSON file for the time, rows and bytes of every step, rewritten after every run")
+    parser.add_argument("--metrics_textfile", type=str,
+                        help="Prometheus textfile (*.prom) with the same metrics, for the node_exporter")
+    parser.add_argument("--daemon", action='store_true',
+                        help="Run as a service: stages repeat on their intervals until SIGTERM. "
+                             "SIGHUP reloads the model")
+    parser.add_argument("--interval", type=float, default=DEFAULT_STAGE_INTERVAL,
+                        help="Daemon mode: seconds between runs of stages missing in the [schedule] section")
     args = parser.parse_args()
     return args
 
 
+def read_config_file(config_path):
+    # Settings of the -c file, also read by the scoring server
+    config = configparser.ConfigParser()
+    config.read(config_path)
+    gp_user = config['main']['gp_user']
+    gp_pass = config['main']['gp_pass']
+    wp_user = config['main']['wp_user']
+    wp_pass = config['main']['wp_pass']
+    ver_ignore = config['main']['ver_ignore'].strip().lower() == 'true'
+    # Optional libpq connection strings instead of the production hosts, e.g. of a test database.
+    # Temp tables of plain PostgreSQL can't be distributed, so it also needs gp_distributed=False.
+    gp_dsn = config['main'].get('gp_dsn')
+    wpad_dsn = config['main'].get('wpad_dsn')
+    gp_distributed = config['main'].get('gp_distributed', 'True').strip().lower() == 'true'
+    # Optional [gp_session] and [wpad_session] sections, e.g. statement_timeout=30min, work_mem=256MB
+    gp_session = dict(config['gp_session']) if config.has_section('gp_session') else {}
+    wpad_session = dict(config['wpad_session']) if config.has_section('wpad_session') else {}
+    # Optional [schedule] section of the daemon mode, e.g. mobile_users=120, web_deponators=3600
+    intervals = {name: float(value) for name, value in config['schedule'].items()} \
+        if config.has_section('schedule') else {}
+    return dict(gp_user=gp_user, gp_pass=gp_pass, wp_user=wp_user, wp_pass=wp_pass, ver_ignore=ver_ignore,
+                gp_dsn=gp_dsn, wpad_dsn=wpad_dsn, gp_distributed=gp_distributed, gp_session=gp_session,
+                wpad_session=wpad_session, intervals=intervals)
+
+
 def get_config() -> AppConfig:
     args = parse_args()
     if hasattr(args, 'config'):
@@ -604,52 +840,48 @@ def get_config() -> AppConfig:
             model_path = args.model_path
         else:
             model_path = os.getcwd()
-
-        config = configparser.ConfigParser()
-        config.read(args.config)
-        gp_user = config['main']['gp_user']
-        gp_pass = config['main']['gp_pass']
-        wp_user = config['main']['wp_user']
-        wp_pass = config['main']['wp_pass']
-        ver_ignore = config['main']['ver_ignore'].strip().lower() == 'true'
-        return AppConfig(gp_user=gp_user, gp_pass=gp_pass, wp_user=wp_user, wp_pass=wp_pass, ver_ignore=ver_ignore,
-                         model_path=model_path)
+        return AppConfig(model_path=model_path, prefetch=args.prefetch, max_sessions=args.max_sessions,
+                         ledger_path=args.ledger_path, daemon=args.daemon, interval=args.interval,
+                         event_intake=args.event_intake, stages=args.stages, log_file=args.log_file,
+                         profile_startup=args.profile_startup, model_name=args.model_name,
+                         metrics_json=args.metrics_json, metrics_textfile=args.metrics_textfile,
+                         **read_config_file(args.config))
     else:
         logger.error("Can't find config arguments. Use -c or --config")
         sys.exit(1)
 
 
 if __name__ == "__main__":
-    logger.info("Launch")
+    profile = StartupProfile()
+    profile.mark("imports")
     config = get_config()
+    profile.mark("config")
+    setup_logging(config.log_file)
+    logger.info("Launch")
+    profile.mark("logging")
     try:
-        with connect_to_gp(config.gp_user, config.gp_pass) as gp_connect, \
-                connect_to_wpad(config.wp_user, config.wp_pass) as wpad_connect:
-            clf, main_threshold, _ = read_model(model_name=MODEL_NAME, model_path=config.model_path,
-                                                ignore_wrong_version=config.ver_ignore)
-            wpad_connect.autocommit = True
-            logger.info("Handle mobile users")
-            mobile_user_ids = get_mobile_users_for_prediction(wpad_connect)
-            mobile_users_with_mql: List[MQLData] = find_mqls(gp_connect, mobile_user_ids, CHUNK_SIZE)
-            logger.debug(mobile_users_with_mql)
-            save_mobile_mgl_data(wpad_connect, mobile_users_with_mql)
-
-            logger.info("Handle web users")
-            web_user_ids = get_web_users_for_prediction(wpad_connect)
-            web_users_with_mql: List[MQLData] = find_mqls(gp_connect, web_user_ids, CHUNK_SIZE)
-            save_web_mgl_data(wpad_connect, web_users_with_mql)
-
-            logger.info("Handle non predicted web deponators")
-
-            web_i_sql = sql_insert_web_non_predicted_deponators(MQL_WEB_TARGET_TABLE, hours_after_reg=HOURS_AFTER_REG,
-                                                                days_before_now=DAYS_BEFORE_NOW)
-            execute_common_insert_sql(web_i_sql)
-
-            logger.info("Handle non predicted mobile deponators")
-            mob_i_sql = sql_insert_mobile_predicted_deponators(MQL_MOBILE_TARGET_TABLE, hours_after_reg=HOURS_AFTER_REG,
-                                                               days_before_now=DAYS_BEFORE_NOW)
-            execute_common_insert_sql(mob_i_sql)
-
+        if set(config.stages) & set(SCORING_STAGES):
+            load_model(config)
+            profile.mark("model")
+        if config.profile_startup:
+            profile.report()
+        else:
+            ledger = PredictionLedger(config.ledger_path, config.model_name) if config.ledger_path else None
+            pools = make_pools(config)
+            tracer.enable()
+            try:
+                stages = make_stages(pools, ledger, config)
+                if config.daemon:
+                    run_service(stages, ledger, config)
+                else:
+                    run_stages(stages, config.max_sessions)
+                    export_metrics(config)
+            finally:
+                pools.gp.close()
+                pools.wpad.close()
+                if ledger is not None:
+                    ledger.prune()
+                    ledger.close()
 
     except Exception as e:
         logger.exception("Unexpected error.")
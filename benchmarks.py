@@ -0,0 +1,200 @@
+import argparse
+import json
+import logging
+import platform
+import resource
+import time
+import tracemalloc
+from collections import namedtuple
+from functools import partial
+
+import numpy as np
+import pandas as pd
+
+from adwords_mql_updater import read_model, get_field_from_cfg, make_class_prediction, chunker, \
+    combine_user_datasets, predict_mqls, CHUNK_SIZE
+from feature_encoder import FeatureEncoder
+from synthetic import synthetic_scoring_frames
+from utils import features_engineering
+
+# Models trained on the columns of the scoring queries. 01 and 02 use the older dataset layout.
+DEFAULT_MODELS = ['random_forest_03', 'random_forest_04']
+DEFAULT_ROWS = [10000, 100000]
+FIRST_USER_ID = 10 ** 8
+BENCHMARK_NAMES = ['combine_first', 'join', 'features_engineering', 'encode', 'predict', 'score_chunks']
+
+LOG_LEVEL = "INFO"
+
+logger = logging.getLogger()
+logger.setLevel(LOG_LEVEL)
+ch = logging.StreamHandler()
+ch.setLevel(LOG_LEVEL)
+formatter = logging.Formatter('%(asctime)s [%(filename)s.%(lineno)d] %(levelname)-1s %(name)s - %(message)s')
+ch.setFormatter(formatter)
+logger.addHandler(ch)
+
+# calls are timed one by one, each of them handles the rows at the same position
+Benchmark = namedtuple("Benchmark", "name model calls rows")
+BenchModel = namedtuple("BenchModel", "name clf threshold encoder")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmarks of the scoring hot path on synthetic GP frames")
+    parser.add_argument("--rows", type=int, nargs='+', default=DEFAULT_ROWS, help="Users per dataset, 10k..10M")
+    parser.add_argument("--models", type=str, nargs='+', default=DEFAULT_MODELS, help="Names of the model files")
+    parser.add_argument("--model_path", type=str, default='.', help="Path to models")
+    parser.add_argument("--ver_ignore", action='store_true', help="Ignore sklearn version of pickled models")
+    parser.add_argument("--benchmarks", type=str, nargs='+', default=BENCHMARK_NAMES, choices=BENCHMARK_NAMES)
+    parser.add_argument("--chunk_size", type=int, default=CHUNK_SIZE, help="Users per chunk of score_chunks")
+    parser.add_argument("--repeat", type=int, default=5, help="Timed runs of every benchmark")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the data generator")
+    parser.add_argument("--output", type=str, default='benchmarks.json', help="JSON file for the results")
+    parser.add_argument("--compare", type=str, help="Results of an earlier run to compare the throughput with")
+    return parser.parse_args()
+
+
+def load_models(model_names, model_path, ignore_wrong_version, columns):
+    models = []
+    for model_name in model_names:
+        clf, threshold, cfg_json = read_model(model_name, model_path, ignore_wrong_version)
+        encoder = FeatureEncoder(get_field_from_cfg(cfg_json, 'feature_columns'))
+        missing = set(encoder.source_columns) - set(columns)
+        if missing:
+            logger.warning(f"Skip {model_name}: the scoring queries don't return {len(missing)} of its columns, "
+                           f"e.g. {sorted(missing)[:3]}")
+            continue
+        models.append(BenchModel(model_name, clf, threshold, encoder))
+    return models
+
+
+def combine_first(user_data, user_tags):
+    # How the updater joined the frames before frame_join, kept as the reference
+    users_i = user_data.set_index('user_id')
+    tags_i = user_tags.set_index('user_id')
+    data = users_i.combine_first(tags_i).reset_index()
+    tags_columns = list(tags_i.columns)
+    data[tags_columns] = data[tags_columns].fillna(0)
+    return data
+
+
+def split_chunks(user_ids, frame, chunk_size):
+    # Rows of every chunker() chunk of user_ids, keeping the order of the frame inside a chunk
+    chunk_nums = pd.Index(user_ids).get_indexer(frame['user_id'].values) // chunk_size
+    order = np.argsort(chunk_nums, kind='stable')
+    bounds = np.searchsorted(chunk_nums[order], np.arange(1, -(-len(user_ids) // chunk_size)))
+    return [frame.take(rows).reset_index(drop=True) for rows in np.split(order, bounds)]
+
+
+def score_chunk(user_data, user_tags, model):
+    # Body of the find_mqls loop after the GP copy
+    return predict_mqls(combine_user_datasets(user_data, user_tags), model.encoder, model.clf, model.threshold)
+
+
+def make_benchmarks(names, user_ids, user_data, user_tags, models, chunk_size):
+    n_rows = len(user_ids)
+    joined = combine_user_datasets(user_data, user_tags)
+    benchmarks = []
+    if 'combine_first' in names:
+        benchmarks.append(Benchmark('combine_first', None, [partial(combine_first, user_data, user_tags)], [n_rows]))
+    if 'join' in names:
+        benchmarks.append(Benchmark('join', None, [partial(combine_user_datasets, user_data, user_tags)], [n_rows]))
+    if 'features_engineering' in names:
+        benchmarks.append(Benchmark('features_engineering', None, [partial(features_engineering, joined.copy())],
+                                    [n_rows]))
+    if 'score_chunks' in names:
+        chunks = list(zip(split_chunks(user_ids, user_data, chunk_size), split_chunks(user_ids, user_tags, chunk_size)))
+        chunk_rows = [len(chunk) for chunk in chunker(user_ids, chunk_size)]
+    for model in models:
+        if 'encode' in names:
+            benchmarks.append(Benchmark('encode', model.name, [partial(model.encoder.encode, joined)], [n_rows]))
+        if 'predict' in names:
+            X = model.encoder.encode(joined)
+            benchmarks.append(Benchmark('predict', model.name, [partial(make_class_prediction, model.clf, X,
+                                                                        model.threshold)], [n_rows]))
+        if 'score_chunks' in names:
+            calls = [partial(score_chunk, chunk_data, chunk_tags, model) for chunk_data, chunk_tags in chunks]
+            benchmarks.append(Benchmark('score_chunks', model.name, calls, chunk_rows))
+    return benchmarks
+
+
+def run_benchmark(benchmark, repeat):
+    # One untimed run warms caches and measures memory (tracemalloc slows allocations down), then `repeat` timed runs
+    tracemalloc.start()
+    for call in benchmark.calls:
+        call()
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    latencies = []
+    for _ in range(repeat):
+        for call in benchmark.calls:
+            started = time.perf_counter()
+            call()
+            latencies.append(time.perf_counter() - started)
+    latencies_ms = np.array(latencies) * 1000
+    rows = sum(benchmark.rows) * repeat
+    return {'benchmark': benchmark.name, 'model': benchmark.model, 'rows': sum(benchmark.rows),
+            'calls': len(benchmark.calls), 'repeat': repeat,
+            'throughput_rows_per_s': rows / latencies_ms.sum() * 1000,
+            'latency_ms': {'mean': latencies_ms.mean(), 'p50': np.percentile(latencies_ms, 50),
+                           'p90': np.percentile(latencies_ms, 90), 'p99': np.percentile(latencies_ms, 99),
+                           'max': latencies_ms.max()},
+            'peak_memory_mb': peak_memory / 2 ** 20}
+
+
+def environment():
+    return {'python': platform.python_version(), 'numpy': np.__version__, 'pandas': pd.__version__,
+            'machine': platform.machine(), 'processor': platform.processor(), 'system': platform.platform()}
+
+
+def result_key(result):
+    return result['benchmark'], result['model'], result['rows']
+
+
+def compare(results, baseline_file):
+    with open(baseline_file) as baseline_json:
+        baseline = {result_key(result): result for result in json.load(baseline_json)['results']}
+    for result in results:
+        before = baseline.get(result_key(result))
+        if before is None:
+            continue
+        speedup = result['throughput_rows_per_s'] / before['throughput_rows_per_s']
+        logger.info(f"{result['benchmark']:<20} {result['model'] or '':<18} {result['rows']:>9} rows: "
+                    f"x{speedup:.2f} throughput, p50 {before['latency_ms']['p50']:.2f} -> "
+                    f"{result['latency_ms']['p50']:.2f}ms")
+
+
+if __name__ == "__main__":
+    logger.info("Launch")
+    args = parse_args()
+    try:
+        results = []
+        models = None
+        for n_rows in args.rows:
+            user_ids = np.arange(FIRST_USER_ID, FIRST_USER_ID + n_rows, dtype=np.int64)
+            started = time.perf_counter()
+            user_data, user_tags = synthetic_scoring_frames(user_ids, random_state=args.seed)
+            logger.info(f"Generated {n_rows} users, {len(user_tags)} with tags in {time.perf_counter() - started:.1f}s")
+            if models is None:
+                models = load_models(args.models, args.model_path, args.ver_ignore,
+                                     set(user_data.columns) | set(user_tags.columns))
+            for benchmark in make_benchmarks(args.benchmarks, user_ids, user_data, user_tags, models, args.chunk_size):
+                result = run_benchmark(benchmark, args.repeat)
+                results.append(result)
+                logger.info(f"{result['benchmark']:<20} {result['model'] or '':<18} {n_rows:>9} rows: "
+                            f"{result['throughput_rows_per_s']:12.0f} rows/s, p50 {result['latency_ms']['p50']:.2f}ms "
+                            f"p99 {result['latency_ms']['p99']:.2f}ms, peak {result['peak_memory_mb']:.1f}MB")
+            del user_data, user_tags
+
+        with open(args.output, 'w') as output_file:
+            json.dump({'environment': environment(), 'seed': args.seed, 'chunk_size': args.chunk_size,
+                       'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 'results': results},
+                      output_file, indent=2)
+        logger.info(f"Results saved to {args.output}")
+        if args.compare:
+            compare(results, args.compare)
+
+    except Exception as e:
+        logger.exception("Unexpected error.")
+
+    logger.info("Complete")
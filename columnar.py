@@ -0,0 +1,88 @@
+import json
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+SCHEMA_FILE = 'schema.json'
+SCHEMA_VERSION = 1
+KIND_ARRAY = 'array'
+KIND_DATETIME = 'datetime'
+KIND_CATEGORY = 'category'
+KIND_BOOLEAN = 'boolean'
+
+
+def write_columnar(df, path):
+    # Writes every column as a separate .npy file plus schema.json. Object columns are stored as category
+    # codes in the dtype pandas picks for them (-1 for missing), nullable booleans as int8 (-1 for missing),
+    # datetimes as int64 nanoseconds. The directory is written next to the target and renamed into place,
+    # so readers never see a partial dataset.
+    tmp_path = path + '.tmp'
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+    columns = []
+    for idx, name in enumerate(df.columns):
+        series = df[name]
+        file_name = f"{idx:04d}.npy"
+        column = {'name': str(name), 'file': file_name}
+        if series.dtype.kind == 'M':
+            column['kind'] = KIND_DATETIME
+            values = series.values.astype('datetime64[ns]').view(np.int64)
+        elif str(series.dtype) == 'boolean':
+            column['kind'] = KIND_BOOLEAN
+            values = series.astype(object).map({True: 1, False: 0}).fillna(-1).values.astype(np.int8)
+        elif series.dtype.kind == 'O' or str(series.dtype) == 'category':
+            categorical = pd.Categorical(series)
+            column['kind'] = KIND_CATEGORY
+            column['categories'] = categorical.categories.tolist()
+            values = categorical.codes
+        else:
+            column['kind'] = KIND_ARRAY
+            values = series.values
+        column['dtype'] = values.dtype.str
+        np.save(os.path.join(tmp_path, file_name), np.ascontiguousarray(values), allow_pickle=False)
+        columns.append(column)
+    schema = {'version': SCHEMA_VERSION, 'n_rows': len(df), 'columns': columns}
+    with open(os.path.join(tmp_path, SCHEMA_FILE), 'w') as schema_file:
+        json.dump(schema, schema_file)
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.rename(tmp_path, path)
+
+
+def read_schema(path):
+    with open(os.path.join(path, SCHEMA_FILE)) as schema_file:
+        schema = json.load(schema_file)
+    if schema['version'] != SCHEMA_VERSION:
+        raise ValueError(f"Unsupported columnar schema version: {schema['version']}")
+    return schema
+
+
+def read_columnar(path, columns=None, mmap=True):
+    # Loads only the requested columns. With mmap the .npy files are mapped read-only and pages are
+    # read lazily on first access. The frame is built with copy=False, so array, datetime and category
+    # columns stay backed by the files (pandas >= 2; older versions consolidate the blocks into copies).
+    # Nullable booleans are decoded from their int8 form and always live on the heap.
+    schema = read_schema(path)
+    by_name = {column['name']: column for column in schema['columns']}
+    if columns is None:
+        columns = [column['name'] for column in schema['columns']]
+    missing = [name for name in columns if name not in by_name]
+    if missing:
+        raise KeyError(f"Columns not found in {path}: {missing}")
+
+    data = {}
+    for name in columns:
+        column = by_name[name]
+        values = np.load(os.path.join(path, column['file']), mmap_mode='r' if mmap else None, allow_pickle=False)
+        if column['kind'] == KIND_DATETIME:
+            data[name] = values.view('datetime64[ns]')
+        elif column['kind'] == KIND_BOOLEAN:
+            data[name] = pd.arrays.BooleanArray(values == 1, values < 0)
+        elif column['kind'] == KIND_CATEGORY:
+            data[name] = pd.Categorical.from_codes(values, column['categories'])
+        else:
+            data[name] = values
+    return pd.DataFrame(data, columns=columns, copy=False)
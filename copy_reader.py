@@ -0,0 +1,84 @@
+import csv
+import io
+
+import numpy as np
+import pandas as pd
+
+from schema import read_csv_options, apply_schema, DATETIME
+
+DEFAULT_BUFFER_SIZE = 8 * 1024 * 1024
+
+
+class CopyFrameWriter:
+    # File-like target for cursor.copy_expert(COPY ... TO STDOUT WITH CSV HEADER). Rows are parsed with
+    # the known dtypes as soon as buffer_size bytes are collected, so only one block of raw CSV is kept
+    # in memory and nothing is written to disk. dtypes defaults to the schema registry.
+    def __init__(self, dtypes=None, buffer_size=DEFAULT_BUFFER_SIZE):
+        self.dtypes = dtypes
+        self.buffer_size = buffer_size
+        self.bytes_read = 0
+        self.columns = None
+        self._buffer = bytearray()
+        self._chunks = None
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode()
+        self.bytes_read += len(data)
+        self._buffer += data
+        if len(self._buffer) >= self.buffer_size:
+            self._parse_buffer(final=False)
+        return len(data)
+
+    def to_dataframe(self):
+        self._parse_buffer(final=True)
+        if self.columns is None:
+            return pd.DataFrame()
+        data = {}
+        for column in self.columns:
+            chunks = self._chunks[column]
+            if len(chunks) == 1:
+                data[column] = chunks[0]
+            elif chunks and all(isinstance(chunk, np.ndarray) for chunk in chunks):
+                data[column] = np.concatenate(chunks)
+            elif chunks:
+                data[column] = pd.concat([pd.Series(chunk) for chunk in chunks], ignore_index=True).array
+            else:
+                data[column] = pd.Series([], dtype=self._empty_dtype(column)).array
+        return apply_schema(pd.DataFrame(data, columns=self.columns), self.dtypes)
+
+    def _parse_buffer(self, final):
+        if self.columns is None:
+            header_end = self._buffer.find(b'\n')
+            if header_end < 0:
+                return
+            self.columns = next(csv.reader([self._buffer[:header_end].decode()]))
+            self._chunks = {column: [] for column in self.columns}
+            del self._buffer[:header_end + 1]
+
+        if final:
+            end = len(self._buffer)
+        else:
+            # Cut on a record boundary: a newline outside of quoted values
+            end = self._buffer.rfind(b'\n') + 1
+            while end > 0 and self._buffer.count(b'"', 0, end) % 2:
+                end = self._buffer.rfind(b'\n', 0, end - 1) + 1
+        if end == 0:
+            return
+
+        block = pd.read_csv(io.BytesIO(self._buffer[:end]), header=None, names=self.columns,
+                            **read_csv_options(self.columns, self.dtypes))
+        del self._buffer[:end]
+        for column in self.columns:
+            self._chunks[column].append(block[column].values)
+
+    def _empty_dtype(self, column):
+        options = read_csv_options([column], self.dtypes)
+        return DATETIME if options['parse_dates'] else options['dtype'].get(column, object)
+
+
+def copy_query_to_dataframe(cursor, sql, dtypes=None, buffer_size=DEFAULT_BUFFER_SIZE):
+    outputquery = "COPY ({0}) TO STDOUT WITH CSV HEADER DELIMITER ','".format(sql)
+    writer = CopyFrameWriter(dtypes, buffer_size)
+    cursor.copy_expert(outputquery, writer)
+    return writer.to_dataframe(), writer.bytes_read
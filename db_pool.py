@@ -0,0 +1,153 @@
+import logging
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+
+logger = logging.getLogger(__name__)
+
+SETTING_NAME_RE = re.compile(r"^[a-z_]+$")
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class ConnectionPool:
+    # Thread-safe pool over a connection factory, e.g. partial(connect_to_gp, user, password).
+    # Idle connections are checked with SELECT 1 before reuse once they were idle for check_idle_after
+    # seconds. Session settings are applied per checkout and reset when the connection is returned.
+    def __init__(self, connect, name, minconn=1, maxconn=4, check_idle_after=30.0, checkout_timeout=None,
+                 session_settings=None):
+        if minconn > maxconn:
+            raise ValueError(f"minconn ({minconn}) > maxconn ({maxconn})")
+        self.name = name
+        self.maxconn = maxconn
+        self.check_idle_after = check_idle_after
+        self.checkout_timeout = checkout_timeout
+        self.session_settings = session_settings or {}
+        self._connect = connect
+        self._idle = []
+        self._size = 0
+        self._closed = False
+        self._cond = threading.Condition()
+        for _ in range(minconn):
+            self._idle.append((self._new_connection(), time.monotonic()))
+
+    @property
+    def size(self):
+        return self._size
+
+    @contextmanager
+    def connection(self, autocommit=False, **settings):
+        session_settings = dict(self.session_settings, **settings)
+        for name in session_settings:
+            if not SETTING_NAME_RE.match(name):
+                raise ValueError(f"Wrong setting name: {name}")
+        conn = self._checkout()
+        try:
+            self._apply_session(conn, autocommit, session_settings)
+            yield conn
+        finally:
+            self._release(conn, session_settings)
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            for conn, _ in self._idle:
+                conn.close()
+            self._size -= len(self._idle)
+            self._idle = []
+            self._cond.notify_all()
+
+    def _new_connection(self):
+        logger.info(f"Open connection to {self.name}")
+        conn = self._connect()
+        self._size += 1
+        return conn
+
+    def _checkout(self):
+        deadline = None if self.checkout_timeout is None else time.monotonic() + self.checkout_timeout
+        while True:
+            conn = None
+            with self._cond:
+                while True:
+                    if self._closed:
+                        raise PoolTimeout(f"Pool {self.name} is closed")
+                    if self._idle:
+                        conn, released_at = self._idle.pop()
+                        break
+                    if self._size < self.maxconn:
+                        # Reserve the slot and connect outside of the lock
+                        self._size += 1
+                        break
+                    timeout = None if deadline is None else deadline - time.monotonic()
+                    if timeout is not None and timeout <= 0:
+                        raise PoolTimeout(f"No free connection in {self.name} pool for {self.checkout_timeout}s")
+                    self._cond.wait(timeout)
+
+            if conn is None:
+                try:
+                    logger.info(f"Open connection to {self.name}")
+                    return self._connect()
+                except Exception:
+                    with self._cond:
+                        self._size -= 1
+                        self._cond.notify()
+                    raise
+            if self._is_alive(conn, time.monotonic() - released_at):
+                return conn
+            with self._cond:
+                self._discard(conn)
+
+    def _release(self, conn, session_settings):
+        try:
+            if not conn.closed:
+                if conn.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+                if session_settings:
+                    conn.autocommit = True
+                    with conn.cursor() as cur:
+                        for name in session_settings:
+                            cur.execute(f"RESET {name}")
+                conn.autocommit = False
+        except psycopg2.Error:
+            logger.warning(f"Connection to {self.name} is broken, discard it", exc_info=True)
+            conn.close()
+        with self._cond:
+            if conn.closed or self._closed:
+                self._discard(conn)
+            else:
+                self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def _discard(self, conn):
+        if not conn.closed:
+            conn.close()
+        self._size -= 1
+
+    def _is_alive(self, conn, idle_for):
+        if conn.closed:
+            return False
+        if idle_for < self.check_idle_after:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            logger.warning(f"Idle connection to {self.name} is dead, reconnect")
+            return False
+
+    @staticmethod
+    def _apply_session(conn, autocommit, settings):
+        conn.autocommit = True
+        if settings:
+            with conn.cursor() as cur:
+                for name, value in settings.items():
+                    cur.execute(f"SET {name} = %s", (str(value),))
+        conn.autocommit = autocommit
@@ -0,0 +1,116 @@
+import numpy as np
+
+THRESHOLD_YOUDEN = 'youden'
+THRESHOLD_F1 = 'f1'
+THRESHOLD_PRECISION = 'precision'
+THRESHOLD_RECALL = 'recall'
+THRESHOLD_METHODS = [THRESHOLD_YOUDEN, THRESHOLD_F1, THRESHOLD_PRECISION, THRESHOLD_RECALL]
+
+DEFAULT_BOOTSTRAP = 200
+
+
+class ThresholdSweep:
+    # Sorts the scores once and gets TP/FP at every distinct threshold from cumulative sums.
+    # Thresholds follow the serving rule `proba > threshold`: at thresholds[k] the first k groups of equal
+    # scores (in descending order) are predicted positive.
+    def __init__(self, y_true, scores):
+        scores = np.asarray(scores, dtype=np.float64)
+        order = np.argsort(-scores, kind='mergesort')
+        self.sorted_scores = scores[order]
+        self.sorted_y = np.asarray(y_true)[order].astype(bool)
+        self.n_samples = len(scores)
+        # Index one past the last sample of every group of equal scores
+        self.group_ends = np.append(np.flatnonzero(np.diff(self.sorted_scores)) + 1, self.n_samples)
+        self.thresholds = self.sorted_scores[self.group_ends - 1]
+        self.tp, self.fp = self._counts(np.ones(self.n_samples))
+        self.positives = int(self.sorted_y.sum())
+        self.negatives = self.n_samples - self.positives
+
+    def metrics(self):
+        return self._metrics(self.tp, self.fp, self.positives, self.negatives)
+
+    def select(self, method=THRESHOLD_YOUDEN, target=None):
+        # Index into self.thresholds
+        metrics = self.metrics()
+        if method == THRESHOLD_YOUDEN:
+            return int(np.argmax(metrics['youden']))
+        if method == THRESHOLD_F1:
+            return int(np.argmax(metrics['f1']))
+        if target is None:
+            raise ValueError(f"Threshold method {method} needs a target")
+        if method == THRESHOLD_PRECISION:
+            # The lowest threshold (highest recall) that still reaches the precision
+            candidates = np.flatnonzero((metrics['precision'] >= target) & (self.tp > 0))
+            index = candidates[-1] if len(candidates) else None
+        elif method == THRESHOLD_RECALL:
+            # The highest threshold (fewest positives) that reaches the recall
+            candidates = np.flatnonzero(metrics['recall'] >= target)
+            index = candidates[0] if len(candidates) else None
+        else:
+            raise ValueError(f"Unknown threshold method: {method}")
+        if index is None:
+            raise ValueError(f"No threshold reaches {method} {target}")
+        return int(index)
+
+    def at(self, index):
+        metrics = self.metrics()
+        result = {name: float(values[index]) for name, values in metrics.items()}
+        result['threshold'] = float(self.thresholds[index])
+        result['roc_auc'] = self.auc()
+        return result
+
+    def confusion_matrix(self, index):
+        tp, fp = int(self.tp[index]), int(self.fp[index])
+        fn, tn = self.positives - tp, self.negatives - fp
+        return np.array([[tn, fp], [fn, tp]])
+
+    def auc(self):
+        return self._auc(self.tp, self.fp, self.positives, self.negatives)
+
+    def bootstrap(self, index, n_boot=DEFAULT_BOOTSTRAP, alpha=0.05, random_state=0):
+        # Resampling with replacement is a vector of per-sample counts, applied as weights to the
+        # already sorted order, so no replicate sorts again. Returns {metric: (low, high)}.
+        rng = np.random.RandomState(random_state)
+        names = ['roc_auc', 'accuracy', 'precision', 'recall', 'f1']
+        samples = {name: np.empty(n_boot) for name in names}
+        for replicate in range(n_boot):
+            weights = np.bincount(rng.randint(0, self.n_samples, self.n_samples), minlength=self.n_samples)
+            tp, fp = self._counts(weights)
+            positives = float(weights[self.sorted_y].sum())
+            negatives = float(weights.sum()) - positives
+            metrics = self._metrics(tp[index:index + 1], fp[index:index + 1], positives, negatives)
+            for name in names[1:]:
+                samples[name][replicate] = metrics[name][0]
+            samples['roc_auc'][replicate] = self._auc(tp, fp, positives, negatives)
+        low, high = 100 * alpha / 2, 100 * (1 - alpha / 2)
+        return {name: (float(np.percentile(values, low)), float(np.percentile(values, high)))
+                for name, values in samples.items()}
+
+    def _counts(self, weights):
+        # Predicted positives at thresholds[k] are the samples before group k
+        cum_tp = np.concatenate([[0.0], np.cumsum(weights * self.sorted_y)])
+        cum_all = np.concatenate([[0.0], np.cumsum(weights)])
+        starts = np.append(0, self.group_ends[:-1])
+        tp = cum_tp[starts]
+        return tp, cum_all[starts] - tp
+
+    @staticmethod
+    def _metrics(tp, fp, positives, negatives):
+        fn = positives - tp
+        tn = negatives - fp
+        with np.errstate(invalid='ignore', divide='ignore'):
+            tpr = np.where(positives > 0, tp / positives, 0.0)
+            fpr = np.where(negatives > 0, fp / negatives, 0.0)
+            precision = np.where(tp + fp > 0, tp / (tp + fp), 0.0)
+            f1 = np.where(2 * tp + fp + fn > 0, 2 * tp / (2 * tp + fp + fn), 0.0)
+        return {'tp': tp, 'fp': fp, 'tn': tn, 'fn': fn,
+                'accuracy': (tp + tn) / (positives + negatives),
+                'precision': precision, 'recall': tpr, 'fpr': fpr, 'f1': f1, 'youden': tpr - fpr}
+
+    @staticmethod
+    def _auc(tp, fp, positives, negatives):
+        if positives == 0 or negatives == 0:
+            return float('nan')
+        tpr = np.append(tp / positives, 1.0)
+        fpr = np.append(fp / negatives, 1.0)
+        return float(np.sum(np.diff(fpr) * (tpr[1:] + tpr[:-1]) / 2))
@@ -0,0 +1,152 @@
+import argparse
+import logging
+from contextlib import closing
+from typing import List
+
+import psycopg2
+
+logger = logging.getLogger(__name__)
+
+EVENTS_TABLE = 'mql_candidate_events'
+PLATFORM_MOBILE = 'mobile'
+PLATFORM_WEB = 'web'
+MOBILE_AFF_IDS = (166, 162)
+WEB_USER_AFF_IDS = (168, 1)
+# Events of users that never got scored (e.g. not in GP yet, other aff_id) are dropped like the old 10-day scan did
+EVENT_RETENTION_DAYS = 10
+
+
+def sql_create_event_intake(apps_flyer_tname, click_history_tname):
+    # Outbox of candidates filled by triggers: one row per platform and user until the user is scored
+    mobile_aff_ids = ', '.join(str(aff_id) for aff_id in MOBILE_AFF_IDS)
+    return f"""
+    CREATE TABLE IF NOT EXISTS {EVENTS_TABLE} (
+      platform   TEXT        NOT NULL,
+      user_id    BIGINT      NOT NULL,
+      created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+      PRIMARY KEY (platform, user_id)
+    );
+
+    CREATE OR REPLACE FUNCTION {EVENTS_TABLE}_mobile() RETURNS TRIGGER AS $$
+    BEGIN
+      IF NEW.first_connected_user IS NOT NULL AND NEW.aff_id IN ({mobile_aff_ids}) THEN
+        INSERT INTO {EVENTS_TABLE} (platform, user_id) VALUES ('{PLATFORM_MOBILE}', NEW.first_connected_user)
+        ON CONFLICT DO NOTHING;
+      END IF;
+      RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql;
+
+    CREATE OR REPLACE FUNCTION {EVENTS_TABLE}_web() RETURNS TRIGGER AS $$
+    BEGIN
+      INSERT INTO {EVENTS_TABLE} (platform, user_id) VALUES ('{PLATFORM_WEB}', NEW.user_id)
+      ON CONFLICT DO NOTHING;
+      RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql;
+
+    DROP TRIGGER IF EXISTS {EVENTS_TABLE}_mobile ON {apps_flyer_tname};
+    CREATE TRIGGER {EVENTS_TABLE}_mobile
+      AFTER INSERT OR UPDATE OF first_connected_user ON {apps_flyer_tname}
+      FOR EACH ROW EXECUTE PROCEDURE {EVENTS_TABLE}_mobile();
+
+    DROP TRIGGER IF EXISTS {EVENTS_TABLE}_web ON {click_history_tname};
+    CREATE TRIGGER {EVENTS_TABLE}_web
+      AFTER INSERT ON {click_history_tname}
+      FOR EACH ROW WHEN (NEW.operation_type = 'register') EXECUTE PROCEDURE {EVENTS_TABLE}_web();
+    """
+
+
+def sql_backfill_events(apps_flyer_tname, click_history_tname, days):
+    # Candidates that registered before the triggers existed, same window as the old scans
+    mobile_aff_ids = ', '.join(str(aff_id) for aff_id in MOBILE_AFF_IDS)
+    return f"""
+    INSERT INTO {EVENTS_TABLE} (platform, user_id)
+    SELECT DISTINCT '{PLATFORM_MOBILE}', first_connected_user
+    FROM {apps_flyer_tname}
+    WHERE install_time >= now() - INTERVAL '{days} days'
+      AND aff_id IN ({mobile_aff_ids})
+      AND first_connected_user IS NOT NULL
+    ON CONFLICT DO NOTHING;
+
+    INSERT INTO {EVENTS_TABLE} (platform, user_id)
+    SELECT DISTINCT '{PLATFORM_WEB}', user_id
+    FROM {click_history_tname}
+    WHERE operation_type = 'register' AND created >= now() - INTERVAL '{days} days'
+    ON CONFLICT DO NOTHING;
+    """
+
+
+def sql_ready_candidates(platform, adwords_queue_tname, window_grace_hours, user_aff_ids=None):
+    # Users whose feature window (created + 1 day) closed and who are not queued yet.
+    # Reads only the pending events, so the cost follows the number of new users.
+    aff_filter = f"AND u.aff_id IN ({', '.join(str(aff_id) for aff_id in user_aff_ids)})" if user_aff_ids else ""
+    return f"""
+    SELECT e.user_id
+    FROM {EVENTS_TABLE} e
+      INNER JOIN users u ON e.user_id = u.user_id
+      LEFT JOIN {adwords_queue_tname} q ON e.user_id = q.user_id AND q.conversion_name = 'mql_backend'
+    WHERE e.platform = '{platform}'
+      AND u.created + INTERVAL '1 day' + INTERVAL '{window_grace_hours} hours' <= now()
+      AND q.user_id IS NULL
+      {aff_filter}
+    """
+
+
+def sql_prune_events(platform, adwords_queue_tname, retention_days=EVENT_RETENTION_DAYS):
+    return f"""
+    DELETE FROM {EVENTS_TABLE} e
+    WHERE e.platform = '{platform}'
+      AND (e.created_at < now() - INTERVAL '{retention_days} days'
+           OR EXISTS(SELECT 1
+                     FROM {adwords_queue_tname} q
+                     WHERE q.user_id = e.user_id AND q.conversion_name = 'mql_backend'))
+    """
+
+
+def acknowledge_events(wpad_connect, platform, user_ids: List[int]):
+    # Scored users leave the outbox. Called after their predictions are saved, so a failed run scores them again.
+    if not user_ids:
+        return 0
+    with wpad_connect.cursor() as cur:
+        cur.execute(f"DELETE FROM {EVENTS_TABLE} WHERE platform = %s AND user_id = ANY(%s)",
+                    (platform, [int(user_id) for user_id in user_ids]))
+        deleted = cur.rowcount
+    logger.info(f"Acknowledged {platform} events: {deleted}")
+    return deleted
+
+
+def prune_events(wpad_connect, platform, adwords_queue_tname, retention_days=EVENT_RETENTION_DAYS):
+    with wpad_connect.cursor() as cur:
+        cur.execute(sql_prune_events(platform, adwords_queue_tname, retention_days))
+        deleted = cur.rowcount
+    logger.info(f"Pruned {platform} events: {deleted}")
+    return deleted
+
+
+def install_event_intake(connect, apps_flyer_tname, click_history_tname, backfill_days=EVENT_RETENTION_DAYS):
+    with connect.cursor() as cur:
+        logger.info(f"Create {EVENTS_TABLE} and triggers")
+        cur.execute(sql_create_event_intake(apps_flyer_tname, click_history_tname))
+        if backfill_days > 0:
+            cur.execute(sql_backfill_events(apps_flyer_tname, click_history_tname, backfill_days))
+            logger.info(f"Backfilled {backfill_days} days of candidates")
+    connect.commit()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dsn", type=str, required=True, help="libpq connection string of the WPAD database")
+    parser.add_argument("--apps_flyer_table", type=str, default='apps_flyer')
+    parser.add_argument("--click_history_table", type=str, default='user_adwords_click_history')
+    parser.add_argument("--backfill_days", type=int, default=EVENT_RETENTION_DAYS,
+                        help="Add candidates of the last days that registered before the triggers (0 - off)")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s [%(filename)s.%(lineno)d] %(levelname)-1s %(name)s - %(message)s')
+    args = parse_args()
+    with closing(psycopg2.connect(args.dsn)) as connection:
+        install_event_intake(connection, args.apps_flyer_table, args.click_history_table, args.backfill_days)
@@ -0,0 +1,137 @@
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+# Feature set of the MQL models (random_forest_03, random_forest_04)
+MQL_FEATURE_COLUMNS = ['age_18_24', 'age_24_30', 'age_30_40', 'age_40_50', 'age_50_80', 'age_trash',
+                       'gender_1', 'gender_2',
+                       'currency_id_5', 'currency_id_1', 'currency_id_2', 'currency_id_6', 'currency_id_7',
+                       'currency_id_4', 'currency_id_8',
+                       'client_platform_id_2', 'client_platform_id_9', 'client_platform_id_3',
+                       'client_platform_id_12',
+                       'used_historical_prices', 'tried_to_change_asset', 'changed_deal_amount_manualy',
+                       'visit_traderoom', 'button_deposit_pag', 'visited_withdrawal_page',
+                       'added_technical_analysis', 'changed_chart_type', 'open_video_tutorial', 'sell_option_used',
+                       'refreshed_demo', 'phone_confirmed', 'user_use_buyback', 'trading_indicator_added',
+                       'volume_train_digital', 'pnl_train_digital', 'volume_train_cfd', 'pnl_train_cfd',
+                       'volume_train_forex', 'pnl_train_forex', 'volume_train_crypto', 'pnl_train_crypto',
+                       'closed_count', 'instrument_actives_count', 'instrument_actives_digital_count',
+                       'instrument_actives_cfd_count', 'instrument_actives_forex_count',
+                       'instrument_actives_crypto_count', 'digital_count', 'cfd_count', 'forex_count',
+                       'crypto_count', 'bin_count', 'volume_train_bin', 'pnl_train_bin',
+                       'instrument_actives_bin_count']
+
+IntervalRule = namedtuple("IntervalRule", "column low high high_inclusive inside")
+
+INTERVAL_RULES = {
+    'age_18_24': IntervalRule('age', 18, 24, high_inclusive=False, inside=True),
+    'age_24_30': IntervalRule('age', 24, 30, high_inclusive=False, inside=True),
+    'age_18_30': IntervalRule('age', 18, 30, high_inclusive=False, inside=True),
+    'age_30_40': IntervalRule('age', 30, 40, high_inclusive=False, inside=True),
+    'age_40_50': IntervalRule('age', 40, 50, high_inclusive=False, inside=True),
+    'age_50_80': IntervalRule('age', 50, 80, high_inclusive=True, inside=True),
+    'age_trash': IntervalRule('age', 18, 80, high_inclusive=True, inside=False),
+}
+
+# One-hot columns are named <column>_<value>
+ONE_HOT_VALUE_PARSERS = {
+    'client_platform_id': int,
+    'currency_id': int,
+    'country_id': int,
+    'gender': int,
+    'locale': str,
+    'is_public': lambda value: value == '1',
+}
+
+# Values used for missing data before one-hot comparison. Passthrough columns always fill NA with 0.
+ONE_HOT_FILL_VALUES = {
+    'is_public': False,
+}
+
+
+def float_values(series, dtype=np.float64):
+    # Also handles nullable boolean and numeric category columns, missing values become NaN
+    return series.to_numpy(dtype=dtype, na_value=np.nan)
+
+
+def parse_one_hot(feature_column):
+    for column in sorted(ONE_HOT_VALUE_PARSERS, key=len, reverse=True):
+        prefix = column + '_'
+        if feature_column.startswith(prefix):
+            return column, ONE_HOT_VALUE_PARSERS[column](feature_column[len(prefix):])
+    return None
+
+
+class FeatureEncoder:
+    # Compiles the feature_columns list once into interval, one-hot and passthrough rules and fills a
+    # preallocated float32 matrix with one vectorized operation per source column.
+    def __init__(self, feature_columns):
+        self.feature_columns = list(feature_columns)
+        self._intervals = []
+        self._one_hot = {}
+        passthrough = []
+        for idx, feature_column in enumerate(self.feature_columns):
+            one_hot = parse_one_hot(feature_column)
+            if feature_column in INTERVAL_RULES:
+                self._intervals.append((idx, INTERVAL_RULES[feature_column]))
+            elif one_hot is not None:
+                column, value = one_hot
+                indexes, values = self._one_hot.setdefault(column, ([], []))
+                indexes.append(idx)
+                values.append(value)
+            else:
+                passthrough.append((idx, feature_column))
+        self._passthrough_index = np.array([idx for idx, _ in passthrough], dtype=np.intp)
+        self._passthrough_columns = [column for _, column in passthrough]
+        self._one_hot = {column: (np.array(indexes, dtype=np.intp), np.array(values))
+                         for column, (indexes, values) in self._one_hot.items()}
+
+    @property
+    def source_columns(self):
+        columns = list(self._passthrough_columns)
+        columns += [rule.column for _, rule in self._intervals]
+        columns += list(self._one_hot)
+        return list(dict.fromkeys(columns))
+
+    def encode(self, df):
+        n_samples = len(df)
+        result = np.empty((n_samples, len(self.feature_columns)), dtype=np.float32)
+
+        if self._passthrough_columns:
+            result[:, self._passthrough_index] = self._passthrough_values(df)
+
+        interval_cache = {}
+        for idx, rule in self._intervals:
+            if rule.column not in interval_cache:
+                interval_cache[rule.column] = float_values(df[rule.column])
+            values = interval_cache[rule.column]
+            upper = values <= rule.high if rule.high_inclusive else values < rule.high
+            mask = (values >= rule.low) & upper
+            if not rule.inside:
+                # NaN is neither inside nor outside of the interval
+                mask = ~mask & ~np.isnan(values)
+            result[:, idx] = mask
+
+        for column, (indexes, values) in self._one_hot.items():
+            series = df[column]
+            if column in ONE_HOT_FILL_VALUES:
+                series = series.fillna(ONE_HOT_FILL_VALUES[column])
+            if values.dtype.kind in 'iuf':
+                source = float_values(series)
+            else:
+                source, values = series.values.astype(object), values.astype(object)
+            result[:, indexes] = source[:, np.newaxis] == values[np.newaxis, :]
+        return result
+
+    def encode_frame(self, df):
+        return pd.DataFrame(self.encode(df), index=df.index, columns=self.feature_columns)
+
+    def _passthrough_values(self, df):
+        frame = df[self._passthrough_columns]
+        if all(isinstance(dtype, np.dtype) and dtype.kind in 'biuf' for dtype in frame.dtypes):
+            values = frame.values.astype(np.float32)
+        else:
+            values = np.column_stack([float_values(frame[column], np.float32) for column in frame.columns])
+        values[np.isnan(values)] = 0
+        return values
@@ -0,0 +1,91 @@
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+JoinSource = namedtuple("JoinSource", "df fill_value")
+
+
+def join_on_key(sources, key='user_id'):
+    # Outer join of N frames on a unique key column. The sorted union of keys is built once and every
+    # source column is scattered into a preallocated array. Rows missing in a source get its fill_value;
+    # with fill_value=None they stay NaN/NaT (ints are widened to float64, bools to object).
+    # Like combine_first, an earlier source wins for a column present in several sources and later
+    # sources only fill its missing values.
+    sources = [source if isinstance(source, JoinSource) else JoinSource(source, None) for source in sources]
+    sorted_sources = [__sort_keys(source.df[key].values, key) for source in sources]
+    keys = __merge_keys([sorted_keys for _, sorted_keys in sorted_sources])
+
+    data = {key: keys}
+    for source, (order, sorted_keys) in zip(sources, sorted_sources):
+        positions = np.empty(len(order), dtype=np.intp)
+        positions[order] = np.searchsorted(keys, sorted_keys)
+        covers_all = len(sorted_keys) == len(keys)
+        for column in source.df.columns:
+            if column == key:
+                continue
+            values = source.df[column].values
+            if not isinstance(values, np.ndarray):
+                # Categorical and nullable columns keep their type
+                data[column] = __take_extension(data.get(column), values, positions, len(keys), source.fill_value)
+                continue
+            if column in data:
+                target = data[column]
+                missing = pd.isnull(target[positions])
+                target[positions[missing]] = values[missing]
+            elif covers_all:
+                target = np.empty(len(keys), dtype=values.dtype)
+                target[positions] = values
+                data[column] = target
+            else:
+                data[column] = __scatter(values, positions, len(keys), source.fill_value)
+    return pd.DataFrame(data, columns=list(data))
+
+
+def __sort_keys(keys, key):
+    order = np.argsort(keys, kind='stable')
+    sorted_keys = keys[order]
+    if len(sorted_keys) > 1 and (sorted_keys[1:] == sorted_keys[:-1]).any():
+        raise ValueError(f"Duplicate values of '{key}' in join source")
+    return order, sorted_keys
+
+
+def __merge_keys(sorted_keys):
+    # Stable sort of concatenated sorted runs is a merge, then adjacent duplicates are dropped
+    if not sorted_keys:
+        return np.array([], dtype=np.int64)
+    merged = np.sort(np.concatenate(sorted_keys), kind='stable')
+    unique = np.ones(len(merged), dtype=bool)
+    unique[1:] = merged[1:] != merged[:-1]
+    return merged[unique]
+
+
+def __take_extension(current, values, positions, size, fill_value):
+    indexer = np.full(size, -1, dtype=np.intp)
+    indexer[positions] = np.arange(len(positions))
+    taken = pd.Series(values.take(indexer, allow_fill=True))
+    if current is not None:
+        return pd.Series(current).combine_first(taken).array
+    if fill_value is not None:
+        taken = taken.fillna(fill_value)
+    return taken.array
+
+
+def __scatter(values, positions, size, fill_value):
+    if fill_value is None:
+        if values.dtype.kind in 'iu':
+            dtype, fill = np.float64, np.nan
+        elif values.dtype.kind == 'b':
+            dtype, fill = object, np.nan
+        elif values.dtype.kind in 'mM':
+            dtype, fill = values.dtype, np.datetime64('NaT')
+        elif values.dtype.kind == 'f':
+            dtype, fill = values.dtype, np.nan
+        else:
+            dtype, fill = object, None
+    else:
+        fill = fill_value
+        dtype = values.dtype if np.can_cast(np.min_scalar_type(fill_value), values.dtype) else object
+    target = np.full(size, fill, dtype=dtype)
+    target[positions] = values
+    return target
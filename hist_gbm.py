@@ -0,0 +1,252 @@
+import logging
+import time
+from collections import namedtuple
+
+import numpy as np
+
+from tree_engine import CompiledBoosting
+
+logger = logging.getLogger(__name__)
+
+MAX_BINS = 256
+BINNING_SAMPLE_SIZE = 200000
+ALWAYS_LEFT_BIN = MAX_BINS - 1
+
+# gain: split gain of the tree per feature, summed into feature_importances_ over the kept trees
+BinnedTree = namedtuple("BinnedTree", "split_feature split_bin leaf_value gain")
+
+
+def compute_bin_edges(X, max_bins=MAX_BINS, sample_size=BINNING_SAMPLE_SIZE, random_state=0):
+    # Edges are actual float32 values of the data, so "bin <= b" is exactly "x <= edges[b]" for any
+    # float32 x. NaN lands in the last bin and goes right at a split like in the compiled traversal.
+    if len(X) > sample_size:
+        X = X[np.random.RandomState(random_state).choice(len(X), sample_size, replace=False)]
+    edges = []
+    for feature in range(X.shape[1]):
+        column = np.sort(X[:, feature][~np.isnan(X[:, feature])])
+        distinct = np.unique(column)
+        if len(distinct) <= max_bins:
+            feature_edges = distinct[:-1]
+        else:
+            positions = (np.arange(1, max_bins) * len(column)) // max_bins
+            feature_edges = np.unique(column[positions])[:max_bins - 1]
+        edges.append(feature_edges.astype(np.float32))
+    return edges
+
+
+def bin_data(X, edges):
+    binned = np.empty(X.shape, dtype=np.uint8, order='F')
+    for feature, feature_edges in enumerate(edges):
+        binned[:, feature] = np.searchsorted(feature_edges, X[:, feature], side='left')
+    return binned
+
+
+def log_loss(y, raw):
+    # Logistic loss computed from raw scores without overflow
+    return float(np.mean(np.logaddexp(0.0, raw) - y * raw))
+
+
+def expit(raw):
+    return 1.0 / (1.0 + np.exp(-raw))
+
+
+class HistGradientBoostingTrainer:
+    # Gradient boosting with logistic loss over features pre-binned into uint8 once. Trees are grown
+    # level by level straight into the heap layout of tree_engine, split search uses per-node gradient
+    # histograms and the sibling of the smaller child is derived by subtraction from the parent.
+    def __init__(self, learning_rate=0.1, max_iter=300, max_depth=6, min_samples_leaf=100, l2_regularization=1.0,
+                 max_bins=MAX_BINS, validation_fraction=0.1, n_iter_no_change=20, tol=1e-7, random_state=0):
+        self.learning_rate = learning_rate
+        self.max_iter = max_iter
+        self.max_depth = max_depth
+        self.min_samples_leaf = min_samples_leaf
+        self.l2_regularization = l2_regularization
+        self.max_bins = max_bins
+        self.validation_fraction = validation_fraction
+        self.n_iter_no_change = n_iter_no_change
+        self.tol = tol
+        self.random_state = random_state
+
+    def fit(self, X, y):
+        started = time.monotonic()
+        X = np.ascontiguousarray(X, dtype=np.float32)
+        self.classes_, y = np.unique(y, return_inverse=True)
+        if len(self.classes_) != 2:
+            raise ValueError(f"Binary target expected, got classes {self.classes_}")
+        y = y.astype(np.float64)
+        X_train, y_train, X_val, y_val = self._split(X, y)
+
+        self.n_features_ = X.shape[1]
+        self.bin_edges_ = compute_bin_edges(X_train, self.max_bins, random_state=self.random_state)
+        self._valid_bins = np.arange(MAX_BINS)[np.newaxis, :] < \
+            np.array([len(edges) for edges in self.bin_edges_])[:, np.newaxis]
+        binned = bin_data(X_train, self.bin_edges_)
+        binned_val = bin_data(X_val, self.bin_edges_) if X_val is not None else None
+        logger.info(f"Binned {binned.shape[0]} rows x {binned.shape[1]} features in {time.monotonic() - started:.1f}s")
+
+        prior = np.clip(y_train.mean(), 1e-15, 1 - 1e-15)
+        self.baseline_ = float(np.log(prior / (1 - prior)))
+        raw = np.full(len(y_train), self.baseline_)
+        raw_val = np.full(len(y_val), self.baseline_) if X_val is not None else None
+        trees = []
+        best_loss, best_iter = np.inf, 0
+        for iteration in range(self.max_iter):
+            proba = expit(raw)
+            tree, leaves = self._grow_tree(binned, proba - y_train, proba * (1 - proba))
+            trees.append(tree)
+            raw += tree.leaf_value[leaves]
+            if raw_val is None:
+                best_iter = iteration + 1
+                continue
+            raw_val += tree.leaf_value[self._apply_binned(tree, binned_val)]
+            loss = log_loss(y_val, raw_val)
+            if loss < best_loss - self.tol:
+                best_loss, best_iter = loss, iteration + 1
+            elif iteration + 1 - best_iter >= self.n_iter_no_change:
+                logger.info(f"Early stopping at iteration {iteration + 1}, best {best_iter}: val_loss={best_loss:.6f}")
+                break
+            if (iteration + 1) % 10 == 0:
+                logger.info(f"Iteration {iteration + 1}: train_loss={log_loss(y_train, raw):.6f} "
+                            f"val_loss={loss:.6f} ({time.monotonic() - started:.1f}s)")
+        self.trees_ = trees[:best_iter]
+        self.n_iter_ = best_iter
+        # Only the trees kept after early stopping, the dropped ones are not part of the model
+        self.feature_importances_ = np.sum([tree.gain for tree in self.trees_], axis=0) if self.trees_ \
+            else np.zeros(self.n_features_)
+        total_gain = self.feature_importances_.sum()
+        if total_gain > 0:
+            self.feature_importances_ /= total_gain
+        logger.info(f"Fit {self.n_iter_} trees in {time.monotonic() - started:.1f}s")
+        return self
+
+    def to_compiled(self):
+        # The binned traversal sends every row left at an unsplit node, while NaN fails the inf threshold of the
+        # compiled one. As in CompiledForest.from_sklearn, both children of an unsplit node copy its left subtree.
+        n_splits = 2 ** self.max_depth - 1
+        feature = np.zeros((len(self.trees_), n_splits), dtype=np.intp)
+        threshold = np.full((len(self.trees_), n_splits), np.inf, dtype=np.float32)
+        leaf_values = []
+        for tree_num, tree in enumerate(self.trees_):
+            # source: node of the binned tree copied to every compiled slot of the level
+            source = np.zeros(1, dtype=np.intp)
+            for depth in range(self.max_depth):
+                slots = 2 ** depth - 1 + np.arange(2 ** depth)
+                is_split = tree.split_bin[source] != ALWAYS_LEFT_BIN
+                for slot, node in zip(slots[is_split], source[is_split]):
+                    feature[tree_num, slot] = tree.split_feature[node]
+                    threshold[tree_num, slot] = self.bin_edges_[tree.split_feature[node]][tree.split_bin[node]]
+                children = np.empty(2 * len(source), dtype=np.intp)
+                children[0::2] = 2 * source + 1
+                children[1::2] = np.where(is_split, 2 * source + 2, 2 * source + 1)
+                source = children
+            leaf_values.append(tree.leaf_value[source - n_splits])
+        value = np.concatenate(leaf_values) if leaf_values else np.zeros(0)
+        return CompiledBoosting(feature=feature.ravel(), threshold=threshold.ravel(), value=value,
+                                max_depth=self.max_depth, n_features=self.n_features_, classes=self.classes_,
+                                baseline=self.baseline_, feature_importances=self.feature_importances_)
+
+    def predict_proba(self, X):
+        return self.to_compiled().predict_proba(X)
+
+    def _split(self, X, y):
+        if not self.validation_fraction:
+            return X, y, None, None
+        rng = np.random.RandomState(self.random_state)
+        is_val = np.zeros(len(y), dtype=bool)
+        # Stratified: the same share of each class goes to validation
+        for label in (0.0, 1.0):
+            index = np.flatnonzero(y == label)
+            is_val[rng.choice(index, int(round(len(index) * self.validation_fraction)), replace=False)] = True
+        return X[~is_val], y[~is_val], X[is_val], y[is_val]
+
+    def _grow_tree(self, binned, gradient, hessian):
+        n_samples, n_features = binned.shape
+        n_splits = 2 ** self.max_depth - 1
+        split_feature = np.zeros(n_splits, dtype=np.intp)
+        split_bin = np.full(n_splits, ALWAYS_LEFT_BIN, dtype=np.uint8)
+        tree_gain = np.zeros(n_features)
+        rows = np.arange(n_samples)
+        slots = np.zeros(n_samples, dtype=np.intp)
+        histograms = None
+        for depth in range(self.max_depth):
+            first_slot = 2 ** depth - 1
+            local = slots - first_slot
+            histograms = self._level_histograms(binned, gradient, hessian, local, 2 ** depth, histograms)
+            gain, best_feature, best_bin = self._best_splits(*histograms)
+            do_split = gain > self.tol
+            level_slots = first_slot + np.flatnonzero(do_split)
+            split_feature[level_slots] = best_feature[do_split]
+            split_bin[level_slots] = best_bin[do_split]
+            np.add.at(tree_gain, best_feature[do_split], gain[do_split])
+            go_left = binned[rows, split_feature[slots]] <= split_bin[slots]
+            slots = 2 * slots + 2 - go_left
+
+        leaves = slots - n_splits
+        n_leaves = n_splits + 1
+        leaf_gradient = np.bincount(leaves, weights=gradient, minlength=n_leaves)
+        leaf_hessian = np.bincount(leaves, weights=hessian, minlength=n_leaves)
+        leaf_value = -self.learning_rate * leaf_gradient / (leaf_hessian + self.l2_regularization)
+        return BinnedTree(split_feature, split_bin, leaf_value, tree_gain), leaves
+
+    def _level_histograms(self, binned, gradient, hessian, local, n_nodes, parent_histograms):
+        # Returns (gradient, hessian, count) histograms with shape (n_nodes, n_features, MAX_BINS)
+        if parent_histograms is None:
+            return self._histograms(binned, gradient, hessian, local, n_nodes)
+        counts = np.bincount(local, minlength=n_nodes)
+        smaller_is_left = counts[0::2] <= counts[1::2]
+        is_smaller = np.empty(n_nodes, dtype=bool)
+        is_smaller[0::2] = smaller_is_left
+        is_smaller[1::2] = ~smaller_is_left
+        selected = np.flatnonzero(is_smaller[local])
+        smaller = self._histograms(binned[selected], gradient[selected], hessian[selected],
+                                   local[selected] // 2, n_nodes // 2)
+        result = []
+        for parent, child in zip(parent_histograms, smaller):
+            level = np.empty((n_nodes,) + parent.shape[1:])
+            sibling = parent - child
+            level[0::2] = np.where(smaller_is_left[:, np.newaxis, np.newaxis], child, sibling)
+            level[1::2] = np.where(smaller_is_left[:, np.newaxis, np.newaxis], sibling, child)
+            result.append(level)
+        return tuple(result)
+
+    @staticmethod
+    def _histograms(binned, gradient, hessian, node, n_nodes):
+        n_features = binned.shape[1]
+        shape = (n_nodes, n_features, MAX_BINS)
+        hist_gradient, hist_hessian, hist_count = np.empty(shape), np.empty(shape), np.empty(shape)
+        offset = node * MAX_BINS
+        for feature in range(n_features):
+            index = offset + binned[:, feature]
+            size = n_nodes * MAX_BINS
+            hist_gradient[:, feature] = np.bincount(index, weights=gradient, minlength=size).reshape(n_nodes, -1)
+            hist_hessian[:, feature] = np.bincount(index, weights=hessian, minlength=size).reshape(n_nodes, -1)
+            hist_count[:, feature] = np.bincount(index, minlength=size).reshape(n_nodes, -1)
+        return hist_gradient, hist_hessian, hist_count
+
+    def _best_splits(self, hist_gradient, hist_hessian, hist_count):
+        # Left child of a split at bin b holds bins 0..b
+        left_gradient = np.cumsum(hist_gradient, axis=2)
+        left_hessian = np.cumsum(hist_hessian, axis=2)
+        left_count = np.cumsum(hist_count, axis=2)
+        total_gradient = left_gradient[:, :, -1:]
+        total_hessian = left_hessian[:, :, -1:]
+        total_count = left_count[:, :, -1:]
+        right_gradient = total_gradient - left_gradient
+        right_hessian = total_hessian - left_hessian
+        right_count = total_count - left_count
+        l2 = self.l2_regularization
+        with np.errstate(invalid='ignore', divide='ignore'):
+            gain = (left_gradient ** 2 / (left_hessian + l2) + right_gradient ** 2 / (right_hessian + l2) -
+                    total_gradient ** 2 / (total_hessian + l2))
+        valid = (left_count >= self.min_samples_leaf) & (right_count >= self.min_samples_leaf) & self._valid_bins
+        gain = np.where(valid, gain, -np.inf).reshape(len(gain), -1)
+        best = np.argmax(gain, axis=1)
+        return gain[np.arange(len(gain)), best], best // MAX_BINS, best % MAX_BINS
+
+    def _apply_binned(self, tree, binned):
+        rows = np.arange(len(binned))
+        slots = np.zeros(len(binned), dtype=np.intp)
+        for _ in range(self.max_depth):
+            go_left = binned[rows, tree.split_feature[slots]] <= tree.split_bin[slots]
+            slots = 2 * slots + 2 - go_left
+        return slots - (2 ** self.max_depth - 1)
@@ -0,0 +1,27 @@
+import io
+from contextlib import contextmanager
+
+USER_IDS_TABLE = 'tmp_user_ids'
+
+
+@contextmanager
+def bound_user_ids(connection, user_ids, table_name=USER_IDS_TABLE, distributed=False):
+    # Loads user_ids with COPY into a temp table that lives until the end of the transaction.
+    # Queries inside the block select from the yielded table name instead of inlining an IN list.
+    # Everything runs in one transaction, so it is safe behind a pgbouncer in transaction mode.
+    autocommit = connection.autocommit
+    connection.autocommit = False
+    try:
+        with connection.cursor() as cur:
+            distribution = " DISTRIBUTED BY (user_id)" if distributed else ""
+            cur.execute(f"CREATE TEMP TABLE {table_name} (user_id BIGINT) ON COMMIT DROP{distribution}")
+            ids_file = io.StringIO("\n".join(str(user_id) for user_id in user_ids))
+            cur.copy_expert(f"COPY {table_name} (user_id) FROM STDIN", ids_file)
+            cur.execute(f"ANALYZE {table_name}")
+        yield table_name
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        connection.autocommit = autocommit
@@ -0,0 +1,59 @@
+import logging
+import sqlite3
+import threading
+from datetime import datetime, timedelta
+
+logger = logging.getLogger(__name__)
+
+LEDGER_RETENTION = timedelta(days=30)
+
+
+class PredictionLedger:
+    # Local SQLite record of scored users keyed by (user_id, model_name, window_end).
+    # A prediction made after the user's feature window had closed can't change anymore,
+    # so such users are skipped on later runs instead of being aggregated in GP again.
+    def __init__(self, path, model_name):
+        self.path = path
+        self.model_name = model_name
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS predictions (
+              user_id       INTEGER NOT NULL,
+              model_name    TEXT    NOT NULL,
+              window_end    TEXT    NOT NULL,
+              window_closed INTEGER NOT NULL,
+              is_mql        INTEGER NOT NULL,
+              proba         REAL    NOT NULL,
+              scored_at     TEXT    NOT NULL,
+              PRIMARY KEY (user_id, model_name, window_end)
+            )""")
+        self._conn.commit()
+
+    def frozen_user_ids(self):
+        with self._lock:
+            rows = self._conn.execute("SELECT user_id FROM predictions WHERE model_name = ? AND window_closed = 1",
+                                      (self.model_name,))
+            return {row[0] for row in rows}
+
+    def record(self, predictions):
+        # predictions: iterable of MQLData
+        scored_at = datetime.utcnow().isoformat(sep=' ')
+        rows = [(int(p.user_id), self.model_name, str(p.window_end), int(bool(p.window_closed)), int(bool(p.is_mql)),
+                 float(p.proba), scored_at) for p in predictions]
+        with self._lock:
+            with self._conn:
+                self._conn.executemany("INSERT OR REPLACE INTO predictions VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+        logger.info(f"Ledger: recorded {len(rows)} predictions")
+
+    def prune(self, retention=LEDGER_RETENTION):
+        scored_before = (datetime.utcnow() - retention).isoformat(sep=' ')
+        with self._lock:
+            with self._conn:
+                deleted = self._conn.execute("DELETE FROM predictions WHERE scored_at < ?", (scored_before,)).rowcount
+        logger.info(f"Ledger: pruned {deleted} predictions")
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
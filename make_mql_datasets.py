@@ -1,29 +1,48 @@
+from startup_profile import StartupProfile
+
 import argparse
 import configparser
-import gzip
 import logging
 import os
+import shutil
 import sys
+import time
 from collections import namedtuple
+from contextlib import closing
+from datetime import datetime
+from functools import partial
 from pathlib import Path
 
-import pandas as pd
 import psycopg2
 
+from parallel_gzip import ParallelGzipWriter
+from stage_scheduler import Stage, run_stages, STATUS_OK
 from utils import sql_stat_tags_dataset
 
+DATASET_PATH = "mql_data/mql_dataset"
+PROGRESS_INTERVAL = 30.0
+RETRY_DELAY = 10.0
+COPY_BUFFER_SIZE = 8 * 1024 * 1024
+REGISTRATION_FROM = '2017-12-01'
+REGISTRATION_TO = '2018-02-01'
+DATE_FORMAT = '%Y-%m-%d'
+
 LOG_LEVEL = "DEBUG"
 
 logger = logging.getLogger()
-logger.setLevel(LOG_LEVEL)
-ch = logging.StreamHandler()
-ch.setLevel(LOG_LEVEL)
-formatter = logging.Formatter(
-    '%(asctime)s [%(filename)s.%(lineno)d] %(processName)s %(levelname)-1s %(name)s - %(message)s')
-ch.setFormatter(formatter)
-logger.addHandler(ch)
 
-AppConfig = namedtuple("AppConfig", "gp_user gp_pass wp_user wp_pass ver_ignore model_path reload gzip")
+
+def setup_logging():
+    logger.setLevel(LOG_LEVEL)
+    ch = logging.StreamHandler()
+    ch.setLevel(LOG_LEVEL)
+    formatter = logging.Formatter(
+        '%(asctime)s [%(filename)s.%(lineno)d] %(processName)s %(levelname)-1s %(name)s - %(message)s')
+    ch.setFormatter(formatter)
+    logger.addHandler(ch)
+
+AppConfig = namedtuple("AppConfig", "gp_user gp_pass wp_user wp_pass ver_ignore model_path reload gzip jobs "
+                                    "shards retries gzip_level gzip_threads profile_startup")
 
 
 def connect_to_gp(gp_user, gp_pass):
@@ -48,8 +67,15 @@ def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument("-c", "--config", type=str, help="App config", required=True)
     parser.add_argument("-z", "--gzip", help="Use gzip compression", required=False, action="store_true")
+    parser.add_argument("--gzip_level", type=int, default=6, help="Gzip level, 1 is the fastest")
+    parser.add_argument("--gzip_threads", type=int, help="Compression threads (default: CPU count)")
     parser.add_argument("-r", "--reload", help="Reload existed files", required=False, action="store_true")
     parser.add_argument("--model_path", type=str, help="Path to model")
+    parser.add_argument("-j", "--jobs", type=int, default=3, help="Extractions running in parallel")
+    parser.add_argument("--shards", type=int, default=1, help="Split user data extraction by registration date")
+    parser.add_argument("--retries", type=int, default=2, help="Retries of a failed extraction or shard")
+    parser.add_argument("--profile_startup", action='store_true',
+                        help="Report import and initialization time and exit")
     args = parser.parse_args()
     return args
 
@@ -70,7 +96,10 @@ def get_config() -> AppConfig:
         wp_pass = config['main']['wp_pass']
         ver_ignore = config['main']['ver_ignore'].strip().lower() == 'true'
         return AppConfig(gp_user=gp_user, gp_pass=gp_pass, wp_user=wp_user, wp_pass=wp_pass, ver_ignore=ver_ignore,
-                         model_path=model_path, reload=args.reload, gzip=args.gzip)
+                         model_path=model_path, reload=args.reload, gzip=args.gzip, jobs=args.jobs,
+                         shards=args.shards, retries=args.retries,
+                         gzip_level=args.gzip_level, gzip_threads=args.gzip_threads,
+                         profile_startup=args.profile_startup)
     else:
         logger.error("Can't find config arguments. Use -c or --config")
         sys.exit(1)
@@ -84,38 +113,123 @@ def sizeof_fmt(num, suffix='b'):
     return "%.1f%s%s" % (num, 'Yi', suffix)
 
 
-def load_sql_result_to_file(connect, sql, file_path, config):
-    if config.gzip:
-        file_path = file_path + ".gz"
+class ProgressWriter:
+    # Counts bytes passed to the wrapped file and logs throughput every report_interval seconds
+    def __init__(self, file, name, report_interval=PROGRESS_INTERVAL):
+        self.file = file
+        self.name = name
+        self.report_interval = report_interval
+        self.bytes_written = 0
+        self.started = time.monotonic()
+        self._reported = self.started
+
+    def write(self, data):
+        self.bytes_written += len(data)
+        now = time.monotonic()
+        if now - self._reported >= self.report_interval:
+            self._reported = now
+            self.report("Progress")
+        return self.file.write(data)
+
+    def report(self, prefix):
+        elapsed = max(time.monotonic() - self.started, 1e-9)
+        logger.info(f"{prefix} {self.name}: {sizeof_fmt(self.bytes_written)} in {elapsed:.1f}s "
+                    f"({sizeof_fmt(self.bytes_written / elapsed)}/s)")
+
+
+def output_path(file_path, config):
+    return file_path + ".gz" if config.gzip else file_path
+
+
+def load_sql_result_to_file(connect, sql, file_path, config, header=True):
+    file_path = output_path(file_path, config)
 
     path = Path(file_path)
     if not config.reload and path.exists() and path.is_file():
         logger.info(f"No reload for:{file_path}")
     else:
-        outputquery = "COPY ({0}) TO STDOUT WITH CSV HEADER DELIMITER ','".format(sql)
+        header_option = " HEADER" if header else ""
+        outputquery = "COPY ({0}) TO STDOUT WITH CSV{1} DELIMITER ','".format(sql, header_option)
+        # Written to a .part file first, so a failed COPY never leaves a file that looks complete
+        part_path = file_path + ".part"
         file = None
         try:
             if config.gzip:
-                file = gzip.open(file_path, "wb")
+                file = ParallelGzipWriter(part_path, level=config.gzip_level, threads=config.gzip_threads)
             else:
-                file = open(file_path, "w")
+                file = open(part_path, "wb")
 
             with connect.cursor() as cur:
                 logger.info(f"Collect data for {file_path} ...")
-                cur.copy_expert(outputquery, file)
+                writer = ProgressWriter(file, file_path)
+                cur.copy_expert(outputquery, writer)
+                writer.report("Collected")
         finally:
             if file:
                 file.close()
             connect.commit()
+        os.replace(part_path, file_path)
     logger.info(f"Final file size: {sizeof_fmt(os.path.getsize(path))}")
 
 
+def extract(connect_fn, sql, file_path, config, header=True):
+    for attempt in range(config.retries + 1):
+        try:
+            with closing(connect_fn()) as connect:
+                load_sql_result_to_file(connect, sql, file_path, config, header)
+            return
+        except psycopg2.Error:
+            if attempt == config.retries:
+                raise
+            logger.warning(f"Extraction of {file_path} failed, retry {attempt + 1}/{config.retries}", exc_info=True)
+            time.sleep(RETRY_DELAY * (attempt + 1))
+
+
+def concat_shards(shard_paths, file_path, config):
+    # Shards after the first one have no header. Gzip members can be concatenated as is.
+    file_path = output_path(file_path, config)
+    part_path = file_path + ".part"
+    with open(part_path, "wb") as file:
+        for shard_path in shard_paths:
+            with open(output_path(shard_path, config), "rb") as shard_file:
+                shutil.copyfileobj(shard_file, file, COPY_BUFFER_SIZE)
+    os.replace(part_path, file_path)
+    for shard_path in shard_paths:
+        os.remove(output_path(shard_path, config))
+    logger.info(f"Concatenated {len(shard_paths)} shards into {file_path} ({sizeof_fmt(os.path.getsize(file_path))})")
+
+
+def extraction_stages(connect_fn, sql, file_path, config):
+    return [Stage(file_path, partial(extract, connect_fn, sql, file_path, config), 1, [])]
+
+
+def sharded_extraction_stages(connect_fn, sql_for_range, ranges, file_path, config):
+    # One stage per range plus a concatenation stage. A failed shard is retried on its own and
+    # finished shards are kept, so a rerun without --reload only extracts the missing ones.
+    path = Path(output_path(file_path, config))
+    if not config.reload and path.exists() and path.is_file():
+        logger.info(f"No reload for:{path}")
+        return []
+    shard_paths = [f"{file_path}.shard{i:03d}" for i in range(len(ranges))]
+    stages = [Stage(shard_path, partial(extract, connect_fn, sql_for_range(low, high, i > 0), shard_path, config,
+                                        header=i == 0), 1, [])
+              for i, (shard_path, (low, high)) in enumerate(zip(shard_paths, ranges))]
+    stages.append(Stage(file_path, partial(concat_shards, shard_paths, file_path, config), 0, shard_paths))
+    return stages
+
+
+def run_extractions(stages, config):
+    # Each extraction holds its own connection, so the number of parallel COPYs is bounded by --jobs
+    failed = [result.name for result in run_stages(stages, config.jobs) if result.status != STATUS_OK]
+    if failed:
+        raise RuntimeError(f"Extractions failed: {failed}")
+
+
 def read_user_ids(user_file):
+    from schema import read_csv
+
     logger.info("Read user_id list")
-    if config.gzip:
-        user_df = pd.read_csv(user_file + ".gz", compression='gzip')
-    else:
-        user_df = pd.read_csv(user_file)
+    user_df = read_csv(output_path(user_file, config))
     user_ids = list(user_df['user_id'])
     return user_ids
 
@@ -125,7 +239,9 @@ def rename(prefix, df):
     return df.rename(index=str, columns=column_mapper)
 
 
-user_data_sql = """
+def sql_user_data(created_from, created_to, from_inclusive=False):
+    from_op = ">=" if from_inclusive else ">"
+    return f"""
 WITH 
     required_users AS (
       SELECT
@@ -142,7 +258,8 @@ WITH
         (u.nickname IS NOT NULL)            AS has_nik,
         u.created                           AS created
       FROM users u
-      WHERE u.created > '2017-12-01' AND u.created < '2018-02-01' AND client_platform_id IN (1,2,3,4,5,6,7,8,9,11,12)),
+      WHERE u.created {from_op} '{created_from}' AND u.created < '{created_to}'
+        AND client_platform_id IN (1,2,3,4,5,6,7,8,9,11,12)),
     ni_data AS (SELECT
                   ap.user_id,
                   --   extract(EPOCH FROM (min(ap.create_at) - u.created)) AS first_deal_interval,
@@ -291,68 +408,94 @@ FROM required_users u LEFT JOIN ni_data n ON u.user_id = n.user_id
   LEFT JOIN b_data b ON u.user_id = b.user_id
 """
 
-transactions_sql = """SELECT
+
+def created_ranges(created_from, created_to, shards):
+    # Splits [created_from, created_to) into equal time ranges for sharded extraction
+    begin, end = datetime.strptime(created_from, DATE_FORMAT), datetime.strptime(created_to, DATE_FORMAT)
+    step = (end - begin) / shards
+    bounds = [begin + step * i for i in range(shards)] + [end]
+    return [(str(low), str(high)) for low, high in zip(bounds[:-1], bounds[1:])]
+
+transactions_sql = f"""SELECT
       user_id,
       count(user_id) AS deposits
     FROM stat_transactions_data
     WHERE
-      registration_date > '2017-12-01'
-      AND registration_date < '2018-02-01'
+      registration_date > '{REGISTRATION_FROM}'
+      AND registration_date < '{REGISTRATION_TO}'
       AND transaction_date < registration_date + INTERVAL '30 days'
       AND balance_type = 1
     GROUP BY user_id
     """
 
+def build_dataset(user_file, transactions_file, tags_file, config):
+    # pandas and numpy are needed only here, after the extractions
+    from columnar import write_columnar
+    from frame_join import join_on_key, JoinSource
+    from schema import read_csv
+
+    logger.info("Read files ...")
+    ds_users = read_csv(output_path(user_file, config))
+    ds_transactions = read_csv(output_path(transactions_file, config))
+    ds_stat_tags = read_csv(output_path(tags_file, config))
+    logger.info(f"Memory usage: users {sizeof_fmt(ds_users.memory_usage(deep=True).sum())}, "
+                f"transactions {sizeof_fmt(ds_transactions.memory_usage(deep=True).sum())}, "
+                f"stat tags {sizeof_fmt(ds_stat_tags.memory_usage(deep=True).sum())}")
+    # ds_binary_d1 = rename("b_", pd.read_csv('mql_data/binary_data_d1.csv'))
+    # ds_newinstr_d1 = rename("n_", pd.read_csv('mql_data/ni_data_d1.csv'))
+
+    logger.info("Join file to one dataset ...")
+    data = join_on_key([JoinSource(ds_users, None), JoinSource(ds_stat_tags, 0), JoinSource(ds_transactions, 0)])
+
+    logger.info("Find NA")
+    for col_name in data.columns.values:
+        null_count = data[col_name].isnull().sum()
+        if null_count > 0:
+            logger.info(f"{col_name}, {null_count}")
+
+    logger.info(f"Save data ({DATASET_PATH})...")
+    write_columnar(data, DATASET_PATH)
+    logger.info("File saved")
+
+
 if __name__ == "__main__":
-    logger.info("Launch")
+    profile = StartupProfile()
+    profile.mark("imports")
     config = get_config()
+    profile.mark("config")
+    setup_logging()
+    logger.info("Launch")
+    profile.mark("logging")
     try:
-        with connect_to_wpad(config.wp_user, config.wp_pass) as wpad_connect, \
-                connect_to_gp(config.gp_user, config.gp_pass) as gp_conect:
+        if config.profile_startup:
+            profile.report()
+        else:
+            connect_gp = partial(connect_to_gp, config.gp_user, config.gp_pass)
+            connect_wpad = partial(connect_to_wpad, config.wp_user, config.wp_pass)
             days_after_reg = 1
             user_file = f"mql_data/user_data.csv"
-            load_sql_result_to_file(gp_conect, user_data_sql, user_file, config)
             transactions_file = f"mql_data/transactions.csv"
-            load_sql_result_to_file(wpad_connect, transactions_sql, transactions_file, config)
             tags_file = f"mql_data/stat_tags_data_d{days_after_reg}.csv"
-            load_sql_result_to_file(wpad_connect, sql_stat_tags_dataset(days_after_reg), tags_file, config)
+            if config.shards > 1:
+                ranges = created_ranges(REGISTRATION_FROM, REGISTRATION_TO, config.shards)
+                user_data_stages = sharded_extraction_stages(connect_gp, sql_user_data, ranges, user_file, config)
+            else:
+                user_data_stages = extraction_stages(connect_gp, sql_user_data(REGISTRATION_FROM, REGISTRATION_TO),
+                                                     user_file, config)
+            run_extractions(user_data_stages +
+                            extraction_stages(connect_wpad, transactions_sql, transactions_file, config) +
+                            extraction_stages(connect_wpad, sql_stat_tags_dataset(days_after_reg), tags_file, config),
+                            config)
             # user_ids = read_user_ids(user_file)
             # logger.info(f"User ids found: {len(user_ids)}")
             # ni_file = f"mql_data/ni_data_d{days_after_reg}.csv"
-            # load_sql_result_to_file(gp_conect, sql_new_instruments_dataset_for_users(user_ids, days_after_reg), ni_file,
-            #                         config)
+            # load_sql_result_to_file(gp_conect, sql_new_instruments_dataset_for_users(user_ids, days_after_reg),
+            #                         ni_file, config)
             # binary_file = f"mql_data/binary_data_d{days_after_reg}.csv"
             # load_sql_result_to_file(gp_conect, sql_binary_dataset_for_users(user_ids, days_after_reg), binary_file,
             #                         config)
 
-            logger.info("Read files ...")
-            ds_users = pd.read_csv('mql_data/user_data.csv')
-            ds_transactions = pd.read_csv('mql_data/transactions.csv')
-            ds_stat_tags = pd.read_csv('mql_data/stat_tags_data_d1.csv')
-            # ds_binary_d1 = rename("b_", pd.read_csv('mql_data/binary_data_d1.csv'))
-            # ds_newinstr_d1 = rename("n_", pd.read_csv('mql_data/ni_data_d1.csv'))
-
-            logger.info("Join file to one dataset ...")
-            ds_users_i = ds_users.set_index('user_id')
-            ds_transactions_i = ds_transactions.set_index('user_id')
-            ds_stat_tags_i = ds_stat_tags.set_index('user_id')
-
-            data_i = ds_users_i.combine_first(ds_stat_tags_i).combine_first(ds_transactions_i)
-            data = data_i.reset_index()
-            data[ds_stat_tags_i.columns.values] = data[ds_stat_tags_i.columns.values].fillna(0)
-            data[ds_transactions_i.columns.values] = data[ds_transactions_i.columns.values].fillna(0)
-
-            logger.info("Find NA")
-            for col_name in data.columns.values:
-                null_count = data[col_name].isnull().sum()
-                if null_count > 0:
-                    logger.info(f"{col_name}, {null_count}")
-
-            dataset_path = "mql_data/mql_dataset.gzip"
-            logger.info(f"Save data ({dataset_path})...")
-            data.to_pickle(dataset_path, protocol=4, compression='gzip')
-            logger.info("File saved")
-
+            build_dataset(user_file, transactions_file, tags_file, config)
 
     except Exception as e:
         logger.exception("Unexpected error.")
@@ -0,0 +1,181 @@
+import argparse
+import csv
+import json
+import logging
+import os
+import resource
+import shutil
+import tempfile
+import time
+from collections import namedtuple
+import multiprocessing
+
+import numpy as np
+from sklearn.metrics import roc_auc_score
+from sklearn.model_selection import ParameterGrid, ParameterSampler, StratifiedKFold, train_test_split
+
+from feature_encoder import FeatureEncoder, MQL_FEATURE_COLUMNS
+from training import load_training_data, make_forest, evaluate_and_save, TEST_SIZE, SPLIT_RANDOM_STATE
+from tree_engine import ENGINE_RANDOM_FOREST
+
+DEFAULT_GRID = {'max_depth': [4, 6, 8],
+                'n_estimators': [100, 300],
+                'min_samples_leaf': [1, 100]}
+RESULTS_FILE = 'model_search_results.csv'
+
+LOG_LEVEL = "INFO"
+
+logger = logging.getLogger()
+logger.setLevel(LOG_LEVEL)
+ch = logging.StreamHandler()
+ch.setLevel(LOG_LEVEL)
+formatter = logging.Formatter(
+    '%(asctime)s [%(filename)s.%(lineno)d] %(processName)s %(levelname)-1s %(name)s - %(message)s')
+ch.setFormatter(formatter)
+logger.addHandler(ch)
+
+FoldTask = namedtuple("FoldTask", "candidate fold params data_dir n_folds random_state")
+FoldResult = namedtuple("FoldResult", "candidate fold auc duration peak_rss_mb")
+CandidateResult = namedtuple("CandidateResult", "rank params mean_auc std_auc duration peak_rss_mb")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--param", action="append", default=[],
+                        help="Grid values of a forest parameter, e.g. --param max_depth=4,6,8")
+    parser.add_argument("--n_iter", type=int, help="Random search: number of sampled candidates (default: full grid)")
+    parser.add_argument("--folds", type=int, default=5, help="Stratified k-fold splits")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(), help="Worker processes")
+    parser.add_argument("--model_name", type=str, default='random_forest_05', help="Name of the winning model files")
+    parser.add_argument("--fit_jobs", type=int, default=4, help="n_jobs of the final fit")
+    parser.add_argument("--tmp_dir", type=str, help="Directory for the memory-mapped feature matrix")
+    return parser.parse_args()
+
+
+def parse_value(value):
+    if value == 'None':
+        return None
+    for parse in (int, float):
+        try:
+            return parse(value)
+        except ValueError:
+            pass
+    return value
+
+
+def parse_grid(params):
+    if not params:
+        return DEFAULT_GRID
+    grid = {}
+    for param in params:
+        name, values = param.split('=', 1)
+        grid[name.strip()] = [parse_value(value.strip()) for value in values.split(',')]
+    return grid
+
+
+def make_candidates(grid, n_iter=None, random_state=0):
+    if n_iter is None:
+        return list(ParameterGrid(grid))
+    return list(ParameterSampler(grid, n_iter=n_iter, random_state=random_state))
+
+
+def peak_rss_mb():
+    # VmHWM belongs to the address space, which exec replaces; ru_maxrss survives the fork+exec of a spawned worker
+    # and would report the peak of the parent
+    try:
+        with open('/proc/self/status') as status_file:
+            for line in status_file:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def evaluate_fold(task):
+    # Runs in a fresh worker process: X and y are memory-mapped, only the fold rows are copied
+    started = time.monotonic()
+    X = np.load(os.path.join(task.data_dir, 'X.npy'), mmap_mode='r')
+    y = np.load(os.path.join(task.data_dir, 'y.npy'), mmap_mode='r')
+    folds = StratifiedKFold(n_splits=task.n_folds, shuffle=True, random_state=task.random_state)
+    train_index, test_index = list(folds.split(np.zeros(len(y)), y))[task.fold]
+    clf = make_forest(task.params, n_jobs=1, random_state=task.random_state)
+    clf.fit(X[train_index], y[train_index])
+    auc = roc_auc_score(y[test_index], clf.predict_proba(X[test_index])[:, 1])
+    return FoldResult(task.candidate, task.fold, auc, time.monotonic() - started, peak_rss_mb())
+
+
+def run_search(X, y, candidates, n_folds, jobs, tmp_dir=None, random_state=SPLIT_RANDOM_STATE):
+    data_dir = tempfile.mkdtemp(prefix='model_search_', dir=tmp_dir)
+    try:
+        np.save(os.path.join(data_dir, 'X.npy'), X)
+        np.save(os.path.join(data_dir, 'y.npy'), y)
+        tasks = [FoldTask(candidate, fold, params, data_dir, n_folds, random_state)
+                 for candidate, params in enumerate(candidates) for fold in range(n_folds)]
+        fold_results = {}
+        # Spawned, not forked: a forked child starts with the memory of the parent, which holds the whole dataset.
+        # With maxtasksperchild=1 every fold gets a fresh interpreter, so its peak RSS is the peak of that fold.
+        with multiprocessing.get_context('spawn').Pool(processes=jobs, maxtasksperchild=1) as pool:
+            for result in pool.imap_unordered(evaluate_fold, tasks):
+                logger.info(f"Candidate {result.candidate} fold {result.fold}: auc={result.auc:.4f} "
+                            f"time={result.duration:.1f}s peak_rss={result.peak_rss_mb:.0f}MB")
+                fold_results.setdefault(result.candidate, []).append(result)
+    finally:
+        shutil.rmtree(data_dir)
+
+    results = []
+    for candidate, params in enumerate(candidates):
+        folds = fold_results[candidate]
+        aucs = [fold.auc for fold in folds]
+        results.append(CandidateResult(rank=None, params=params, mean_auc=float(np.mean(aucs)),
+                                       std_auc=float(np.std(aucs)),
+                                       duration=sum(fold.duration for fold in folds),
+                                       peak_rss_mb=max(fold.peak_rss_mb for fold in folds)))
+    results.sort(key=lambda result: -result.mean_auc)
+    return [result._replace(rank=rank) for rank, result in enumerate(results, 1)]
+
+
+def write_results(results, path=RESULTS_FILE):
+    with open(path, 'w', newline='') as results_file:
+        writer = csv.writer(results_file)
+        writer.writerow(CandidateResult._fields)
+        for result in results:
+            writer.writerow([result.rank, json.dumps(result.params, sort_keys=True), f"{result.mean_auc:.6f}",
+                             f"{result.std_auc:.6f}", f"{result.duration:.1f}", f"{result.peak_rss_mb:.0f}"])
+    logger.info(f"Results saved to {path}")
+
+
+def log_results(results):
+    logger.info("Ranked candidates:")
+    for result in results:
+        logger.info(f"{result.rank:>3} auc={result.mean_auc:.4f}+-{result.std_auc:.4f} "
+                    f"time={result.duration:8.1f}s peak_rss={result.peak_rss_mb:6.0f}MB "
+                    f"{json.dumps(result.params, sort_keys=True)}")
+
+
+if __name__ == "__main__":
+    logger.info("Launch")
+    args = parse_args()
+    try:
+        encoder = FeatureEncoder(MQL_FEATURE_COLUMNS)
+        X, y = load_training_data(encoder)
+        X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=TEST_SIZE,
+                                                            random_state=SPLIT_RANDOM_STATE)
+        candidates = make_candidates(parse_grid(args.param), args.n_iter)
+        logger.info(f"Search over {len(candidates)} candidates x {args.folds} folds with {args.jobs} workers")
+        results = run_search(X_train, y_train, candidates, args.folds, args.jobs, args.tmp_dir)
+        log_results(results)
+        write_results(results)
+
+        best = results[0]
+        logger.info(f"Fit winner {best.params}...")
+        clf = make_forest(best.params, n_jobs=args.fit_jobs, random_state=0)
+        clf.fit(X_train, y_train)
+        evaluate_and_save(clf, X_test, y_test, encoder.feature_columns, args.model_name,
+                          extra_fields={"engine": ENGINE_RANDOM_FOREST, "params": best.params,
+                                        "cv_auc": best.mean_auc})
+
+    except Exception as e:
+        logger.exception("Unexpected error.")
+
+    logger.info("Complete")
@@ -0,0 +1,76 @@
+import gzip
+import logging
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BLOCK_SIZE = 4 * 1024 * 1024
+DEFAULT_LEVEL = 6
+
+
+class ParallelGzipWriter:
+    # Binary file object that cuts the stream into blocks and compresses them on a thread pool
+    # (zlib releases the GIL). Every block becomes a separate gzip member, so the output is a regular
+    # multi-member .gz readable by gzip, zcat and pandas. At most max_pending blocks are in flight,
+    # the writer blocks on the oldest one beyond that.
+    def __init__(self, path, level=DEFAULT_LEVEL, threads=None, block_size=DEFAULT_BLOCK_SIZE, max_pending=None):
+        self.path = path
+        self.level = level
+        self.block_size = block_size
+        self.threads = threads or os.cpu_count() or 1
+        self.max_pending = max_pending or 2 * self.threads
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.closed = False
+        self._file = open(path, "wb")
+        self._buffer = bytearray()
+        self._pending = deque()
+        self._executor = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix="gzip")
+        self._started = time.monotonic()
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode()
+        self.bytes_in += len(data)
+        self._buffer += data
+        if len(self._buffer) >= self.block_size:
+            self._submit()
+        return len(data)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            if self._buffer:
+                self._submit()
+            while self._pending:
+                self._write_oldest()
+        finally:
+            self._executor.shutdown(wait=True)
+            self._file.close()
+        elapsed = max(time.monotonic() - self._started, 1e-9)
+        ratio = self.bytes_in / self.bytes_out if self.bytes_out else 0.0
+        logger.info(f"Compressed {self.path}: {self.bytes_in / 2 ** 20:.1f}MB -> {self.bytes_out / 2 ** 20:.1f}MB "
+                    f"(x{ratio:.1f}) at {self.bytes_in / 2 ** 20 / elapsed:.1f}MB/s with {self.threads} threads")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _submit(self):
+        block = bytes(self._buffer)
+        self._buffer = bytearray()
+        self._pending.append(self._executor.submit(gzip.compress, block, self.level))
+        while len(self._pending) > self.max_pending:
+            self._write_oldest()
+
+    def _write_oldest(self):
+        compressed = self._pending.popleft().result()
+        self._file.write(compressed)
+        self.bytes_out += len(compressed)
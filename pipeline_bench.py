@@ -0,0 +1,353 @@
+import argparse
+import json
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+from contextlib import closing
+
+import psycopg2
+from psycopg2.extensions import make_dsn, parse_dsn
+
+import adwords_mql_updater as updater
+from event_intake import install_event_intake, sql_ready_candidates, PLATFORM_MOBILE, PLATFORM_WEB, \
+    WEB_USER_AFF_IDS
+from stage_scheduler import run_stages, select_stages, STATUS_OK
+from synthetic import LOCALES, CURRENCY_IDS, CLIENT_PLATFORM_IDS
+from tracing import tracer
+from utils import sql_get_unhandled_mobile_users, sql_get_unhandled_web_users
+
+BENCH_SCHEMA = 'ltv_bench'
+DEFAULT_USERS = [10000, 100000]
+FIRST_USER_ID = 10 ** 8
+MOBILE_AFF_IDS = (166, 162)
+WEB_AFF_IDS = (168, 1)
+OTHER_AFF_ID = 100
+# The stat tags the queries count, matched by name, and a few they ignore
+TAG_NAMES = ['used historical prices', 'tried to change asset', 'changed deal amount manualy', 'visit_traderoom',
+             'button deposit page', 'visited withdrawal page', 'added technical analysis', 'changed chart type',
+             'open video tutorial', 'sell option used', 'refreshed demo', 'phone confirmed', 'user use buyback',
+             'trading indicator added macd', 'opened settings', 'changed language', 'viewed news']
+
+LOG_LEVEL = "INFO"
+
+logger = logging.getLogger()
+logger.setLevel(LOG_LEVEL)
+ch = logging.StreamHandler()
+ch.setLevel(LOG_LEVEL)
+formatter = logging.Formatter(
+    '%(asctime)s [%(filename)s.%(lineno)d] %(threadName)s %(levelname)-1s %(name)s - %(message)s')
+ch.setFormatter(formatter)
+logger.addHandler(ch)
+
+# Tables read and written by the updater, with the columns its queries use. Queue tables are filled by
+# INSERT ... SELECT without a column list, so their column order follows the insert queries.
+SQL_CREATE_TABLES = f"""
+CREATE TABLE users (
+  user_id BIGINT PRIMARY KEY, locale TEXT, birthdate DATE, country_id INT, gender SMALLINT, currency_id INT,
+  client_platform_id INT, is_trial BOOLEAN, is_regulated BOOLEAN, is_public BOOLEAN, nickname TEXT,
+  created TIMESTAMP, aff_id INT, aff_track TEXT);
+CREATE TABLE country (id INT PRIMARY KEY, name TEXT);
+CREATE TABLE user_balance (id BIGINT PRIMARY KEY, user_id BIGINT, type INT);
+CREATE TABLE archive_position (
+  user_id BIGINT, user_balance_id BIGINT, instrument_type TEXT, position_type TEXT, buy_amount_enrolled BIGINT,
+  sell_amount_enrolled BIGINT, pnl_total_enrolled BIGINT, status TEXT, instrument_active_id INT, create_at TIMESTAMP);
+CREATE TABLE archive_option (
+  user_id BIGINT, user_balance_id BIGINT, active_id INT, enrolled_amount BIGINT, win_enrolled BIGINT,
+  created TIMESTAMP);
+CREATE TABLE tags (id INT PRIMARY KEY, name TEXT);
+CREATE TABLE user_tags (user_id BIGINT, tag_id INT, created TIMESTAMP);
+CREATE TABLE {updater.APPS_FLYER_TABLE} (
+  first_connected_user BIGINT, android_advertising_id TEXT, ios_idfa TEXT, os_version TEXT, client_platform_id INT,
+  aff_id INT, aff_track TEXT, install_time TIMESTAMP, extra JSON, ip_adress TEXT, device TEXT);
+CREATE TABLE {updater.ADWORDS_CLICK_HISTORY} (user_id BIGINT, gclid TEXT, operation_type TEXT, created TIMESTAMP);
+CREATE TABLE stat_transactions_data (
+  user_id BIGINT, registration_date TIMESTAMP, transaction_sum NUMERIC, transaction_date TIMESTAMP,
+  transaction_type TEXT, balance_type INT);
+CREATE TABLE {updater.MQL_WEB_TARGET_TABLE} (
+  user_id BIGINT, gclid TEXT, conversion_time TIMESTAMP, conversion_name TEXT, transaction_sum INT, aff_id INT,
+  aff_track TEXT, country TEXT, send_date TIMESTAMP, error TEXT, reg_platform INT);
+CREATE TABLE {updater.MQL_MOBILE_TARGET_TABLE} (
+  user_id BIGINT, client_platform_id INT, aff_id INT, aff_track TEXT, conversion_time TIMESTAMPTZ,
+  conversion_type TEXT, conversion_name TEXT, uid TEXT, uid_type TEXT, lat INT, app_version TEXT, os_version TEXT,
+  sdk_version TEXT, timestamp DOUBLE PRECISION, value NUMERIC, ip_adress TEXT, device TEXT, platform_version TEXT,
+  locale TEXT, send_date TIMESTAMP, error TEXT, insertion_time TIMESTAMPTZ, send_counter INT);
+"""
+
+SQL_CREATE_INDEXES = f"""
+CREATE INDEX ON archive_position (user_id);
+CREATE INDEX ON archive_option (user_id);
+CREATE INDEX ON user_tags (user_id);
+CREATE INDEX ON {updater.APPS_FLYER_TABLE} (first_connected_user);
+CREATE INDEX ON {updater.APPS_FLYER_TABLE} (install_time);
+CREATE INDEX ON {updater.ADWORDS_CLICK_HISTORY} (user_id);
+CREATE INDEX ON {updater.ADWORDS_CLICK_HISTORY} (created);
+CREATE INDEX ON stat_transactions_data (registration_date);
+CREATE INDEX ON {updater.MQL_WEB_TARGET_TABLE} (user_id);
+CREATE INDEX ON {updater.MQL_MOBILE_TARGET_TABLE} (user_id);
+"""
+
+
+def sql_array(values):
+    return 'ARRAY[' + ', '.join(f"'{value}'" if isinstance(value, str) else str(value) for value in values) + ']'
+
+
+def sql_pick(values):
+    return f"({sql_array(values)})[1 + floor(random() * {len(values)})::INT]"
+
+
+def sql_per_user_count(mean, salt):
+    # Deterministic number of rows per user in 0..2*mean, the same for every seed query that reads it
+    return f"(hashint8(u.user_id + {salt}) & 2147483647) % {2 * mean + 1}"
+
+
+def seed_queries(n_users, created_days, positions_per_user, options_per_user, tags_per_user, mobile_share,
+                 web_share, deposit_share):
+    # Server-side generation: nothing is sent over the connection, so millions of rows take seconds
+    last_user_id = FIRST_USER_ID + n_users - 1
+    mobile_to = mobile_share
+    web_to = mobile_share + web_share
+    return [
+        ('users', f"""
+        INSERT INTO users
+        SELECT id, {sql_pick(LOCALES)}, (now() - (18 + random() * 50) * INTERVAL '1 year')::DATE,
+          1 + floor(random() * 200)::INT, 1 + floor(random() * 2)::INT, {sql_pick(CURRENCY_IDS)},
+          {sql_pick(CLIENT_PLATFORM_IDS)}, random() < 0.3, random() < 0.3, random() < 0.3,
+          CASE WHEN random() < 0.4 THEN 'nik' || id END, now() - random() * INTERVAL '{created_days} days',
+          CASE WHEN platform < {mobile_to} THEN {sql_pick(MOBILE_AFF_IDS)}
+               WHEN platform < {web_to} THEN {sql_pick(WEB_AFF_IDS)}
+               ELSE {OTHER_AFF_ID} END,
+          'track' || floor(random() * 50)::INT
+        FROM (SELECT id, random() AS platform FROM generate_series({FIRST_USER_ID}, {last_user_id}) id) ids
+        """),
+        ('country', "INSERT INTO country SELECT id, 'country ' || id FROM generate_series(1, 200) id"),
+        ('user_balance', """
+        INSERT INTO user_balance
+        SELECT u.user_id * 2 + real_balance, u.user_id, CASE WHEN real_balance = 0 THEN 4 ELSE 1 END
+        FROM users u, generate_series(0, 1) real_balance
+        """),
+        ('archive_position', f"""
+        INSERT INTO archive_position
+        SELECT u.user_id, u.user_id * 2 + (random() < 0.2)::INT,
+          {sql_pick(['digital-option', 'cfd', 'forex', 'crypto'])}, {sql_pick(['short', 'long'])},
+          (random() * 1e8)::BIGINT, (random() * 1e8)::BIGINT, ((random() - 0.5) * 1e7)::BIGINT,
+          CASE WHEN random() < 0.8 THEN 'closed' ELSE 'open' END, 1 + floor(random() * 100)::INT,
+          u.created + random() * INTERVAL '2 days'
+        FROM users u CROSS JOIN LATERAL generate_series(1, {sql_per_user_count(positions_per_user, 1)}) n
+        """),
+        ('archive_option', f"""
+        INSERT INTO archive_option
+        SELECT u.user_id, u.user_id * 2 + (random() < 0.2)::INT, 1 + floor(random() * 100)::INT,
+          (random() * 1e8)::BIGINT, (random() * 1.8e8)::BIGINT, u.created + random() * INTERVAL '2 days'
+        FROM users u CROSS JOIN LATERAL generate_series(1, {sql_per_user_count(options_per_user, 2)}) n
+        """),
+        ('tags', f"INSERT INTO tags SELECT n, ({sql_array(TAG_NAMES)})[n] FROM generate_series(1, {len(TAG_NAMES)}) n"),
+        ('user_tags', f"""
+        INSERT INTO user_tags
+        SELECT u.user_id, 1 + floor(random() * {len(TAG_NAMES)})::INT, u.created + random() * INTERVAL '2 days'
+        FROM users u CROSS JOIN LATERAL generate_series(1, {sql_per_user_count(tags_per_user, 3)}) n
+        """),
+        (updater.APPS_FLYER_TABLE, f"""
+        INSERT INTO {updater.APPS_FLYER_TABLE}
+        SELECT u.user_id, CASE WHEN u.client_platform_id = 2 THEN md5(u.user_id::TEXT) END,
+          CASE WHEN u.client_platform_id IN (3, 12) THEN md5(u.user_id::TEXT) END, '11.' || floor(random() * 4)::INT,
+          u.client_platform_id, u.aff_id, u.aff_track, u.created - random() * INTERVAL '1 hour',
+          '{{"app_version":"5.3.1","sdk_version":"4.8.11"}}'::JSON, '10.0.0.1', 'device'
+        FROM users u
+        WHERE u.aff_id IN ({', '.join(str(aff_id) for aff_id in MOBILE_AFF_IDS)})
+        """),
+        (updater.ADWORDS_CLICK_HISTORY, f"""
+        INSERT INTO {updater.ADWORDS_CLICK_HISTORY}
+        SELECT u.user_id, md5(u.user_id::TEXT), 'register', u.created
+        FROM users u
+        WHERE u.aff_id IN ({', '.join(str(aff_id) for aff_id in WEB_AFF_IDS)})
+        """),
+        ('stat_transactions_data', f"""
+        INSERT INTO stat_transactions_data
+        SELECT u.user_id, u.created, 10 + floor(random() * 500), u.created + random() * INTERVAL '2 days', 'deposit',
+          CASE WHEN random() < 0.9 THEN 1 END
+        FROM users u
+        WHERE random() < {deposit_share}
+        """),
+    ]
+
+
+def seed_database(connection, args, n_users):
+    # Recreates the bench schema and fills it, returns the seconds and rows of every table
+    report = {}
+    with connection.cursor() as cur:
+        cur.execute(f"DROP SCHEMA IF EXISTS {BENCH_SCHEMA} CASCADE")
+        cur.execute(f"CREATE SCHEMA {BENCH_SCHEMA}")
+        cur.execute(f"SET search_path TO {BENCH_SCHEMA}")
+        cur.execute(SQL_CREATE_TABLES)
+        cur.execute("SELECT setseed(%s)", (args.seed,))
+        for table, sql in seed_queries(n_users, args.created_days, args.positions_per_user, args.options_per_user,
+                                       args.tags_per_user, args.mobile_share, args.web_share, args.deposit_share):
+            started = time.perf_counter()
+            cur.execute(sql)
+            report[table] = {'rows': cur.rowcount, 'seconds': time.perf_counter() - started}
+            logger.info(f"Seeded {table}: {cur.rowcount} rows in {report[table]['seconds']:.1f}s")
+        started = time.perf_counter()
+        cur.execute(SQL_CREATE_INDEXES)
+        cur.execute("ANALYZE")
+        report['indexes'] = {'rows': None, 'seconds': time.perf_counter() - started}
+    connection.commit()
+    return report
+
+
+def count_rows(connection, sql):
+    with connection.cursor() as cur:
+        cur.execute(f"SELECT count(*) FROM ({sql}) counted")
+        count = cur.fetchone()[0]
+    connection.commit()
+    return count
+
+
+def candidate_queries(event_intake):
+    # The queries the scoring stages take their users from
+    if event_intake:
+        return {'mobile_users': sql_ready_candidates(PLATFORM_MOBILE, updater.MQL_MOBILE_TARGET_TABLE,
+                                                     updater.WINDOW_GRACE_HOURS),
+                'web_users': sql_ready_candidates(PLATFORM_WEB, updater.MQL_WEB_TARGET_TABLE,
+                                                  updater.WINDOW_GRACE_HOURS, WEB_USER_AFF_IDS)}
+    return {'mobile_users': sql_get_unhandled_mobile_users(updater.APPS_FLYER_TABLE, updater.MQL_MOBILE_TARGET_TABLE),
+            'web_users': sql_get_unhandled_web_users(updater.ADWORDS_CLICK_HISTORY, updater.MQL_WEB_TARGET_TABLE)}
+
+
+STAGE_TARGET_TABLES = {'mobile_users': updater.MQL_MOBILE_TARGET_TABLE, 'web_users': updater.MQL_WEB_TARGET_TABLE,
+                       'web_deponators': updater.MQL_WEB_TARGET_TABLE,
+                       'mobile_deponators': updater.MQL_MOBILE_TARGET_TABLE}
+
+
+def run_pipeline(connection, config):
+    # Stages run one at a time in the updater's order, so every stage is timed without the others
+    # competing for the database and its queue inserts can be counted
+    pools = updater.make_pools(config)
+    report = {}
+    try:
+        stages = updater.make_stages(pools, None, config)
+        candidates = candidate_queries(config.event_intake)
+        for stage in stages:
+            input_rows = count_rows(connection, candidates[stage.name]) if stage.name in candidates else None
+            queue_sql = f"SELECT 1 FROM {STAGE_TARGET_TABLES[stage.name]}"
+            queued_before = count_rows(connection, queue_sql)
+            result, = run_stages(select_stages([stage], [stage.name]), config.max_sessions)
+            if result.status != STATUS_OK:
+                raise RuntimeError(f"Stage {stage.name} {result.status}") from result.error
+            inserted = count_rows(connection, queue_sql) - queued_before
+            rows = input_rows if input_rows is not None else inserted
+            report[stage.name] = {'seconds': result.duration, 'input_rows': input_rows, 'inserted_rows': inserted,
+                                  'rows_per_s': rows / result.duration if result.duration > 0 else None}
+    finally:
+        pools.gp.close()
+        pools.wpad.close()
+    return report
+
+
+def make_config(dsn, args):
+    bench_dsn = make_dsn(dsn, options=f"-c search_path={BENCH_SCHEMA}")
+    params = parse_dsn(dsn)
+    user, password = params.get('user'), params.get('password')
+    return updater.AppConfig(gp_user=user, gp_pass=password, wp_user=user, wp_pass=password,
+                             ver_ignore=args.ver_ignore, model_path=args.model_path, prefetch=args.prefetch,
+                             max_sessions=args.max_sessions, gp_session={}, wpad_session={}, ledger_path=None,
+                             daemon=False, interval=None, intervals={}, event_intake=args.event_intake,
+                             stages=updater.STAGE_NAMES, log_file='', profile_startup=False,
+                             model_name=args.model_name, gp_dsn=bench_dsn, wpad_dsn=bench_dsn, gp_distributed=False,
+                             metrics_json=None, metrics_textfile=None)
+
+
+def start_postgres(data_dir, pg_bin=None):
+    # Throwaway cluster listening only on a unix socket in data_dir. fsync is off: the data is disposable.
+    initdb = shutil.which('initdb', path=pg_bin)
+    pg_ctl = shutil.which('pg_ctl', path=pg_bin)
+    if initdb is None or pg_ctl is None:
+        raise ValueError("initdb and pg_ctl not found, set --pg_bin or use --dsn of a running server")
+    subprocess.run([initdb, '-D', data_dir, '-U', 'postgres', '-A', 'trust', '-E', 'UTF8'], check=True,
+                   stdout=subprocess.DEVNULL)
+    subprocess.run([pg_ctl, '-D', data_dir, '-l', os.path.join(data_dir, 'server.log'), '-w', '-o',
+                    f"-k {data_dir} -c listen_addresses='' -c fsync=off -c synchronous_commit=off", 'start'],
+                   check=True, stdout=subprocess.DEVNULL)
+    return make_dsn(host=data_dir, dbname='postgres', user='postgres'), \
+        lambda: subprocess.run([pg_ctl, '-D', data_dir, '-m', 'fast', 'stop'], check=True, stdout=subprocess.DEVNULL)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Runs the updater stages against a seeded local PostgreSQL")
+    parser.add_argument("--dsn", type=str, help="Server to use instead of a throwaway cluster. "
+                                                f"Tables are created in the {BENCH_SCHEMA} schema, which is dropped")
+    parser.add_argument("--pg_bin", type=str, help="Directory of initdb and pg_ctl (default - PATH)")
+    parser.add_argument("--users", type=int, nargs='+', default=DEFAULT_USERS, help="Users seeded per run")
+    parser.add_argument("--created_days", type=int, default=3, help="Users registered during the last days")
+    parser.add_argument("--positions_per_user", type=int, default=5, help="Mean archive_position rows per user")
+    parser.add_argument("--options_per_user", type=int, default=5, help="Mean archive_option rows per user")
+    parser.add_argument("--tags_per_user", type=int, default=10, help="Mean user_tags rows per user")
+    parser.add_argument("--mobile_share", type=float, default=0.4, help="Share of users from the mobile affiliates")
+    parser.add_argument("--web_share", type=float, default=0.4, help="Share of users from the web affiliates")
+    parser.add_argument("--deposit_share", type=float, default=0.1, help="Share of users with a deposit")
+    parser.add_argument("--seed", type=float, default=0.5, help="setseed() value of the generator, -1..1")
+    parser.add_argument("--model_path", type=str, default=os.getcwd(), help="Path to model")
+    parser.add_argument("--model_name", type=str, default=updater.MODEL_NAME, help="Name of the model files")
+    parser.add_argument("--ver_ignore", action='store_true', help="Ignore sklearn version of a pickled model")
+    parser.add_argument("--prefetch", type=int, default=0, help="Updater --prefetch")
+    parser.add_argument("--max_sessions", type=int, default=4, help="Updater --max_sessions")
+    parser.add_argument("--event_intake", action='store_true',
+                        help="Install the event outbox after seeding and take candidates from it")
+    parser.add_argument("--output", type=str, default='pipeline_bench.json', help="JSON file for the results")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    logger.info("Launch")
+    args = parse_args()
+    data_dir = None
+    stop_postgres = None
+    try:
+        if args.dsn:
+            dsn = args.dsn
+        else:
+            data_dir = tempfile.mkdtemp(prefix='ltv-pg-')
+            dsn, stop_postgres = start_postgres(data_dir, args.pg_bin)
+            logger.info(f"PostgreSQL started in {data_dir}")
+        config = make_config(dsn, args)
+        updater.load_model(config)
+        tracer.enable()
+        results = []
+        with closing(psycopg2.connect(dsn, options=f"-c search_path={BENCH_SCHEMA}")) as connection:
+            for n_users in args.users:
+                logger.info(f"Seed {n_users} users")
+                seeded = seed_database(connection, args, n_users)
+                if args.event_intake:
+                    started = time.perf_counter()
+                    install_event_intake(connection, updater.APPS_FLYER_TABLE, updater.ADWORDS_CLICK_HISTORY,
+                                         args.created_days + 1)
+                    seeded['event_intake'] = {'rows': None, 'seconds': time.perf_counter() - started}
+                tracer.reset()
+                stages = run_pipeline(connection, config)
+                # Time, rows and bytes of the steps inside the stages: candidate queries, COPY, join, inserts
+                steps = tracer.summary()['totals']
+                results.append({'users': n_users, 'seed': seeded, 'stages': stages, 'steps': steps,
+                                'total_seconds': sum(stage['seconds'] for stage in stages.values())})
+
+        logger.info("Pipeline report:")
+        for result in results:
+            for name, stage in result['stages'].items():
+                rows_per_s = f"{stage['rows_per_s']:10.0f}" if stage['rows_per_s'] is not None else f"{'-':>10}"
+                logger.info(f"{result['users']:>9} users {name:<18} {stage['seconds']:8.2f}s {rows_per_s} rows/s, "
+                            f"input {stage['input_rows']}, inserted {stage['inserted_rows']}")
+            tracer.log_report({'totals': result['steps']})
+        with open(args.output, 'w') as output_file:
+            json.dump({'arguments': vars(args), 'results': results}, output_file, indent=2)
+        logger.info(f"Results saved to {args.output}")
+
+    except Exception as e:
+        logger.exception("Unexpected error.")
+    finally:
+        if stop_postgres is not None:
+            stop_postgres()
+        if data_dir is not None:
+            shutil.rmtree(data_dir, ignore_errors=True)
+
+    logger.info("Complete")
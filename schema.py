@@ -0,0 +1,75 @@
+import pandas as pd
+
+DATETIME = 'datetime64[ns]'
+BOOLEAN = 'boolean'
+CATEGORY = 'category'
+# Parsed as float64 and stored as category, so the categories stay numeric
+NUMERIC_CATEGORY = 'numeric_category'
+
+STAT_TAGS_COLUMNS = ['used_historical_prices', 'tried_to_change_asset', 'changed_deal_amount_manualy',
+                     'visit_traderoom', 'button_deposit_pag', 'visited_withdrawal_page', 'added_technical_analysis',
+                     'changed_chart_type', 'open_video_tutorial', 'sell_option_used', 'refreshed_demo',
+                     'phone_confirmed', 'user_use_buyback', 'trading_indicator_added']
+
+AMOUNT_COLUMNS = ['volume_train_digital', 'pnl_train_digital', 'volume_train_cfd', 'pnl_train_cfd',
+                  'volume_train_forex', 'pnl_train_forex', 'volume_train_crypto', 'pnl_train_crypto',
+                  'volume_train_bin', 'pnl_train_bin']
+
+COUNT_COLUMNS = ['closed_count', 'instrument_actives_count', 'instrument_actives_digital_count',
+                 'instrument_actives_cfd_count', 'instrument_actives_forex_count', 'instrument_actives_crypto_count',
+                 'digital_count', 'cfd_count', 'forex_count', 'crypto_count', 'bin_count',
+                 'instrument_actives_bin_count', 'deposits']
+
+# Types of every column produced by the dataset and scoring queries
+COLUMN_DTYPES = {
+    'user_id': 'int64',
+    'locale': CATEGORY,
+    'age': 'float32',
+    'country_id': NUMERIC_CATEGORY,
+    'gender': 'float32',
+    'currency_id': 'float32',
+    'client_platform_id': 'float32',
+    'is_trial': BOOLEAN,
+    'is_regulated': BOOLEAN,
+    'is_public': BOOLEAN,
+    'has_nik': BOOLEAN,
+    'created': DATETIME,
+    'window_end': DATETIME,
+    'window_closed': BOOLEAN,
+}
+COLUMN_DTYPES.update((column, 'float32') for column in AMOUNT_COLUMNS)
+COLUMN_DTYPES.update((column, 'int32') for column in COUNT_COLUMNS + STAT_TAGS_COLUMNS)
+
+
+def read_csv_options(columns, dtypes=None):
+    # Options for parsing COPY CSV output. Categories are parsed as plain values and cast by apply_schema,
+    # so blocks parsed separately don't end up with different categories.
+    dtypes = COLUMN_DTYPES if dtypes is None else dtypes
+    dtype = {}
+    parse_dates = []
+    for column in columns:
+        column_dtype = dtypes.get(column)
+        if column_dtype == DATETIME:
+            parse_dates.append(column)
+        elif column_dtype == CATEGORY:
+            dtype[column] = object
+        elif column_dtype == NUMERIC_CATEGORY:
+            dtype[column] = 'float64'
+        elif column_dtype is not None:
+            dtype[column] = column_dtype
+    # COPY writes booleans as t/f
+    return dict(dtype=dtype, parse_dates=parse_dates, true_values=['t'], false_values=['f'])
+
+
+def apply_schema(df, dtypes=None):
+    dtypes = COLUMN_DTYPES if dtypes is None else dtypes
+    for column in df.columns:
+        if dtypes.get(column) in (CATEGORY, NUMERIC_CATEGORY):
+            df[column] = df[column].astype('category')
+    return df
+
+
+def read_csv(path, dtypes=None, **kwargs):
+    columns = pd.read_csv(path, nrows=0, **kwargs).columns
+    df = pd.read_csv(path, **read_csv_options(columns, dtypes), **kwargs)
+    return apply_schema(df, dtypes)
@@ -0,0 +1,368 @@
+import argparse
+import hashlib
+import http.client
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import Future
+from functools import partial
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+import numpy as np
+import pandas as pd
+
+from db_pool import ConnectionPool
+from feature_encoder import FeatureEncoder
+from synthetic import SyntheticFeatureSource
+from tree_artifact import read_artifact
+
+MODEL_NAME = 'random_forest_04'
+DEFAULT_PORT = 8085
+DEFAULT_MAX_BATCH_SIZE = 1024
+DEFAULT_MAX_WAIT_MS = 5.0
+REQUEST_TIMEOUT = 60.0
+MAX_BODY_SIZE = 16 * 1024 * 1024
+
+LOG_LEVEL = "INFO"
+
+logger = logging.getLogger()
+logger.setLevel(LOG_LEVEL)
+ch = logging.StreamHandler()
+ch.setLevel(LOG_LEVEL)
+formatter = logging.Formatter(
+    '%(asctime)s [%(filename)s.%(lineno)d] %(threadName)s %(levelname)-1s %(name)s - %(message)s')
+ch.setFormatter(formatter)
+logger.addHandler(ch)
+
+LoadedModel = namedtuple("LoadedModel", "clf threshold encoder version")
+# Exactly one of user_ids (list of ints) and rows (DataFrame of source columns) is set
+ScoreRequest = namedtuple("ScoreRequest", "user_ids rows")
+PendingRequest = namedtuple("PendingRequest", "request size future")
+
+
+class BadRequest(Exception):
+    pass
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-c", "--config", type=str, help="App config with GP credentials")
+    parser.add_argument("--model_path", type=str, default=os.getcwd(), help="Path to model")
+    parser.add_argument("--model_name", type=str, default=MODEL_NAME, help="Name of the model files")
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="Listen address")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help="Listen port (0 - any free port)")
+    parser.add_argument("--max_batch_size", type=int, default=DEFAULT_MAX_BATCH_SIZE,
+                        help="Max rows scored in one micro-batch")
+    parser.add_argument("--max_wait_ms", type=float, default=DEFAULT_MAX_WAIT_MS,
+                        help="Max time the first request of a micro-batch waits for others")
+    parser.add_argument("--max_sessions", type=int, default=2, help="Max GP sessions")
+    parser.add_argument("--fake_source", action='store_true',
+                        help="Generate features for requested user_ids instead of querying GP")
+    parser.add_argument("--bench", type=int, default=0,
+                        help="Send this many requests to an in-process server, report latency and exit")
+    parser.add_argument("--bench_concurrency", type=int, default=32, help="Concurrent clients of the benchmark")
+    parser.add_argument("--bench_users", type=int, default=1, help="user_ids per benchmark request")
+    return parser.parse_args()
+
+
+def load_model(model_name, model_path):
+    # Serves tree artifacts only (make_model.py --export_only adds one to a pickled model)
+    with open(os.path.join(model_path, model_name + '.json')) as cfg_file:
+        cfg_json = json.load(cfg_file)
+    if 'artifact' not in cfg_json:
+        raise ValueError(f"Model {model_name} has no tree artifact")
+    artifact_path = os.path.join(model_path, cfg_json['artifact'])
+    with open(artifact_path, 'rb') as artifact_file:
+        digest = hashlib.sha1(artifact_file.read()).hexdigest()
+    model = LoadedModel(clf=read_artifact(artifact_path), threshold=cfg_json['main_threshold'],
+                        encoder=FeatureEncoder(cfg_json['feature_columns']), version=f"{model_name}-{digest[:12]}")
+    logger.info(f"Model {model.version} loaded: trees={model.clf.n_trees} threshold={model.threshold}")
+    return model
+
+
+class GreenplumFeatureSource:
+    # The scoring queries of the updater, one bound id table per micro-batch
+    def __init__(self, gp_pool, distributed=True):
+        from adwords_mql_updater import get_dataset_for_users
+        self._get_dataset_for_users = get_dataset_for_users
+        self.gp_pool = gp_pool
+        self.distributed = distributed
+
+    def fetch(self, user_ids):
+        with self.gp_pool.connection() as gp_connect:
+            return self._get_dataset_for_users(gp_connect, user_ids, distributed=self.distributed)
+
+    def close(self):
+        self.gp_pool.close()
+
+
+def make_feature_source(args):
+    if args.fake_source:
+        return SyntheticFeatureSource()
+    if args.config is None:
+        raise ValueError("GP credentials are required, use -c or --fake_source")
+    from adwords_mql_updater import connect_to_gp, read_config_file
+    settings = read_config_file(args.config)
+    gp_pool = ConnectionPool(partial(connect_to_gp, settings['gp_user'], settings['gp_pass'], settings['gp_dsn']), "GP",
+                             maxconn=args.max_sessions, session_settings=settings['gp_session'])
+    return GreenplumFeatureSource(gp_pool, distributed=settings['gp_distributed'])
+
+
+class Scorer:
+    # Scores a micro-batch: one feature fetch for all requested user_ids, one predict for all rows
+    def __init__(self, model, feature_source):
+        self.model = model
+        self.feature_source = feature_source
+
+    def score_batch(self, requests):
+        user_ids = list(dict.fromkeys(user_id for request in requests if request.user_ids
+                                      for user_id in request.user_ids))
+        parts = []
+        if user_ids:
+            fetched = self.feature_source.fetch(user_ids)
+            parts.append(fetched)
+        parts.extend(request.rows for request in requests if request.rows is not None)
+        encoded = [self.model.encoder.encode(part) for part in parts if len(part)]
+        proba = self.model.clf.predict_proba(np.vstack(encoded))[:, 1] if encoded else np.zeros(0)
+        is_mql = proba > self.model.threshold
+
+        position = 0
+        fetched_positions = {}
+        if user_ids:
+            fetched_positions = dict(zip(fetched['user_id'].tolist(), range(len(fetched))))
+            position = len(fetched)
+        results = []
+        for request in requests:
+            if request.user_ids:
+                results.append([self._result(user_id, fetched_positions.get(user_id), proba, is_mql)
+                                for user_id in request.user_ids])
+            else:
+                request_user_ids = request.rows['user_id'].tolist() if 'user_id' in request.rows \
+                    else [None] * len(request.rows)
+                results.append([self._result(user_id, position + idx, proba, is_mql)
+                                for idx, user_id in enumerate(request_user_ids)])
+                position += len(request.rows)
+        return results
+
+    @staticmethod
+    def _result(user_id, position, proba, is_mql):
+        if position is None:
+            return {'user_id': user_id, 'error': 'user not found'}
+        return {'user_id': user_id, 'proba': float(proba[position]), 'is_mql': bool(is_mql[position])}
+
+
+class MicroBatcher:
+    # Coalesces concurrent requests: the first request of a batch waits up to max_wait seconds for others,
+    # a batch holds up to max_batch_size rows. A single request larger than that is scored alone.
+    # Batches are scored on one thread, so requests arriving meanwhile form the next batch.
+    def __init__(self, score_batch, max_batch_size=DEFAULT_MAX_BATCH_SIZE, max_wait=DEFAULT_MAX_WAIT_MS / 1000):
+        self.score_batch = score_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.n_batches = 0
+        self.n_rows = 0
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="micro-batcher", daemon=True)
+        self._thread.start()
+
+    def submit(self, request, size):
+        future = Future()
+        self._queue.put(PendingRequest(request, size, future))
+        return future
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        carry = None
+        stopping = False
+        while not stopping or carry is not None:
+            first = carry if carry is not None else self._queue.get()
+            carry = None
+            if first is None:
+                break
+            batch, rows = [first], first.size
+            deadline = time.monotonic() + self.max_wait
+            while rows < self.max_batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    pending = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if pending is None:
+                    stopping = True
+                    break
+                if rows + pending.size > self.max_batch_size:
+                    carry = pending
+                    break
+                batch.append(pending)
+                rows += pending.size
+            self._score(batch, rows)
+
+    def _score(self, batch, rows):
+        self.n_batches += 1
+        self.n_rows += rows
+        try:
+            results = self.score_batch([pending.request for pending in batch])
+        except Exception as e:
+            logger.exception(f"Scoring of a batch of {rows} rows failed")
+            for pending in batch:
+                pending.future.set_exception(e)
+            return
+        for pending, result in zip(batch, results):
+            pending.future.set_result(result)
+
+
+def parse_score_request(body, source_columns):
+    # {"user_ids": [1, 2]} or {"rows": [{"age": 25, "gender": 1, ...}]}
+    try:
+        payload = json.loads(body)
+    except ValueError as e:
+        raise BadRequest(f"Invalid JSON: {e}")
+    if not isinstance(payload, dict):
+        raise BadRequest("Expected a JSON object")
+    if 'user_ids' in payload:
+        user_ids = payload['user_ids']
+        if not isinstance(user_ids, list) or not all(isinstance(user_id, int) for user_id in user_ids):
+            raise BadRequest("user_ids must be a list of integers")
+        return ScoreRequest(user_ids=user_ids, rows=None), len(user_ids)
+    if 'rows' in payload:
+        rows = payload['rows']
+        if not isinstance(rows, list) or not all(isinstance(row, dict) for row in rows):
+            raise BadRequest("rows must be a list of objects")
+        df = pd.DataFrame(rows)
+        missing = [column for column in source_columns if column not in df.columns]
+        if rows and missing:
+            raise BadRequest(f"Missing columns: {missing}")
+        return ScoreRequest(user_ids=None, rows=df), len(rows)
+    raise BadRequest("Expected user_ids or rows")
+
+
+class ScoringHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, address, model, batcher):
+        super().__init__(address, ScoringRequestHandler)
+        self.model = model
+        self.batcher = batcher
+
+
+class ScoringRequestHandler(BaseHTTPRequestHandler):
+    # POST /score -> {"model_version": ..., "threshold": ..., "results": [{"user_id", "proba", "is_mql"}]}
+    # GET /health -> {"status": "ok", "model_version": ...}
+    protocol_version = "HTTP/1.1"
+    # Headers and body go out in separate writes, with Nagle every response would wait for a delayed ACK
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        if self.path != '/health':
+            return self._send(404, {'error': 'not found'})
+        self._send(200, {'status': 'ok', 'model_version': self.server.model.version})
+
+    def do_POST(self):
+        if self.path != '/score':
+            return self._send(404, {'error': 'not found'})
+        length = int(self.headers.get('Content-Length') or 0)
+        if length > MAX_BODY_SIZE:
+            return self._send(413, {'error': 'request too large'})
+        model = self.server.model
+        try:
+            request, size = parse_score_request(self.rfile.read(length), model.encoder.source_columns)
+        except BadRequest as e:
+            return self._send(400, {'error': str(e)})
+        try:
+            results = self.server.batcher.submit(request, size).result(timeout=REQUEST_TIMEOUT) if size else []
+        except Exception as e:
+            return self._send(500, {'error': f"{type(e).__name__}: {e}"})
+        self._send(200, {'model_version': model.version, 'threshold': model.threshold, 'results': results})
+
+    def _send(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug("%s - %s", self.address_string(), format % args)
+
+
+def run_bench(address, n_requests, concurrency, users_per_request):
+    # Closed loop: every client sends its next request when the previous one is answered
+    host, port = address
+    latencies = []
+    counter = iter(range(n_requests))
+    lock = threading.Lock()
+
+    def client(client_num):
+        connection = http.client.HTTPConnection(host, port)
+        user_id = client_num * 10 ** 9
+        while True:
+            with lock:
+                if next(counter, None) is None:
+                    break
+            body = json.dumps({'user_ids': list(range(user_id, user_id + users_per_request))})
+            user_id += users_per_request
+            started = time.perf_counter()
+            connection.request('POST', '/score', body, {'Content-Type': 'application/json'})
+            response = connection.getresponse()
+            response.read()
+            if response.status != 200:
+                raise RuntimeError(f"Benchmark request failed with status {response.status}")
+            with lock:
+                latencies.append(time.perf_counter() - started)
+        connection.close()
+
+    started = time.perf_counter()
+    clients = [threading.Thread(target=client, args=(num,)) for num in range(concurrency)]
+    for thread in clients:
+        thread.start()
+    for thread in clients:
+        thread.join()
+    duration = time.perf_counter() - started
+    latencies_ms = np.array(latencies) * 1000
+    logger.info(f"Benchmark: {len(latencies)} requests x {users_per_request} users, {concurrency} clients, "
+                f"{duration:.2f}s, {len(latencies) / duration:.0f} req/s")
+    logger.info(f"Latency ms: p50={np.percentile(latencies_ms, 50):.2f} p95={np.percentile(latencies_ms, 95):.2f} "
+                f"p99={np.percentile(latencies_ms, 99):.2f} max={latencies_ms.max():.2f}")
+
+
+if __name__ == "__main__":
+    logger.info("Launch")
+    args = parse_args()
+    try:
+        model = load_model(args.model_name, args.model_path)
+        feature_source = make_feature_source(args)
+        batcher = MicroBatcher(Scorer(model, feature_source).score_batch, args.max_batch_size, args.max_wait_ms / 1000)
+        server = ScoringHTTPServer((args.host, 0 if args.bench else args.port), model, batcher)
+        try:
+            if args.bench:
+                threading.Thread(target=server.serve_forever, name="http", daemon=True).start()
+                run_bench(server.server_address, args.bench, args.bench_concurrency, args.bench_users)
+            else:
+                logger.info(f"Listening on {server.server_address[0]}:{server.server_address[1]}")
+                server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if args.bench:
+                server.shutdown()
+            server.server_close()
+            batcher.close()
+            feature_source.close()
+            logger.info(f"Scored {batcher.n_rows} rows in {batcher.n_batches} batches")
+
+    except Exception as e:
+        logger.exception("Unexpected error.")
+
+    logger.info("Complete")
@@ -0,0 +1,114 @@
+import logging
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+logger = logging.getLogger(__name__)
+
+Stage = namedtuple("Stage", "name fn sessions depends_on")
+StageResult = namedtuple("StageResult", "name status duration error")
+
+STATUS_OK = "ok"
+STATUS_FAILED = "failed"
+STATUS_SKIPPED = "skipped"
+
+
+def run_stages(stages, max_sessions):
+    # Runs every stage as soon as its dependencies succeeded and enough DB sessions are free.
+    # A stage that needs more sessions than the limit runs alone. Dependents of a failed stage are skipped.
+    names = [stage.name for stage in stages]
+    for stage in stages:
+        unknown = set(stage.depends_on) - set(names)
+        if unknown:
+            raise ValueError(f"Stage {stage.name} depends on unknown stages: {unknown}")
+
+    results = {}
+    pending = list(stages)
+    running = {}
+    used_sessions = 0
+    with ThreadPoolExecutor(max_workers=max(len(stages), 1), thread_name_prefix="stage") as executor:
+        while pending or running:
+            progress = True
+            while progress:
+                progress = False
+                for stage in list(pending):
+                    dependency_statuses = [results[name].status for name in stage.depends_on if name in results]
+                    if any(status != STATUS_OK for status in dependency_statuses):
+                        logger.warning(f"Stage {stage.name} skipped: dependency failed")
+                        results[stage.name] = StageResult(stage.name, STATUS_SKIPPED, 0.0, None)
+                    elif len(dependency_statuses) < len(stage.depends_on):
+                        continue
+                    elif running and used_sessions + stage.sessions > max_sessions:
+                        continue
+                    else:
+                        logger.info(f"Stage {stage.name} started")
+                        running[executor.submit(__timed_call, stage.fn)] = stage
+                        used_sessions += stage.sessions
+                    pending.remove(stage)
+                    progress = True
+            if not running:
+                if pending:
+                    raise ValueError(f"Stages can't be scheduled: {[stage.name for stage in pending]}")
+                continue
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                stage = running.pop(future)
+                used_sessions -= stage.sessions
+                duration, error = future.result()
+                if error is None:
+                    logger.info(f"Stage {stage.name} complete in {duration:.1f}s")
+                    results[stage.name] = StageResult(stage.name, STATUS_OK, duration, None)
+                else:
+                    logger.error(f"Stage {stage.name} failed in {duration:.1f}s", exc_info=error)
+                    results[stage.name] = StageResult(stage.name, STATUS_FAILED, duration, error)
+
+    ordered_results = [results[name] for name in names]
+    log_stage_report(ordered_results)
+    return ordered_results
+
+
+def select_stages(stages, names):
+    # Dependencies on stages left out are dropped: those stages ran earlier or are not part of this run
+    names = set(names)
+    return [stage._replace(depends_on=[name for name in stage.depends_on if name in names])
+            for stage in stages if stage.name in names]
+
+
+def run_periodically(stages, intervals, max_sessions, wakeup, should_stop, before_cycle=None, after_cycle=None):
+    # Service loop: a stage is due when its interval (seconds) has passed since its previous start. Due stages
+    # run together as one run_stages cycle, dependencies on stages that are not due are dropped. Setting wakeup
+    # interrupts the sleep; should_stop is checked between cycles, so a started cycle always completes.
+    # after_cycle gets the stage results of every cycle.
+    next_start = {stage.name: 0.0 for stage in stages}
+    while not should_stop():
+        wakeup.clear()
+        if before_cycle is not None:
+            before_cycle()
+        now = time.monotonic()
+        due = {name for name, start in next_start.items() if start <= now}
+        if not due:
+            wakeup.wait(min(next_start.values()) - now)
+            continue
+        for name in due:
+            next_start[name] = now + intervals[name]
+        cycle = select_stages(stages, due)
+        started = time.monotonic()
+        results = run_stages(cycle, max_sessions)
+        logger.info(f"Cycle of {len(cycle)} stages complete in {time.monotonic() - started:.1f}s")
+        if after_cycle is not None:
+            after_cycle(results)
+
+
+def log_stage_report(results):
+    logger.info("Stage report:")
+    for result in results:
+        logger.info(f"{result.name:<30} {result.status:<8} {result.duration:8.1f}s")
+
+
+def __timed_call(fn):
+    started = time.monotonic()
+    try:
+        fn()
+        return time.monotonic() - started, None
+    except Exception as e:
+        return time.monotonic() - started, e
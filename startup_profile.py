@@ -0,0 +1,105 @@
+import argparse
+import json
+import logging
+import os
+import statistics
+import subprocess
+import sys
+import time
+from collections import namedtuple
+
+# Imported first by the entry points, so modules loaded from here on are attributed to their phases
+PROFILE_STARTED = time.perf_counter()
+BASE_MODULES = frozenset(sys.modules)
+
+logger = logging.getLogger(__name__)
+
+Phase = namedtuple("Phase", "name duration modules")
+PROFILE_PREFIX = 'STARTUP_PROFILE '
+
+
+class StartupProfile:
+    # Splits the time from interpreter start (approximately: import of this module) to the end of
+    # initialization into phases. Every mark() closes the phase started by the previous one and notes
+    # the top-level packages imported during it.
+    def __init__(self):
+        self.phases = []
+        self._last = PROFILE_STARTED
+        self._modules = set(BASE_MODULES)
+
+    def mark(self, name):
+        now = time.perf_counter()
+        modules = set(sys.modules)
+        packages = sorted({module.split('.')[0] for module in modules - self._modules})
+        self.phases.append(Phase(name, now - self._last, packages))
+        self._last = now
+        self._modules = modules
+
+    @property
+    def total(self):
+        return sum(phase.duration for phase in self.phases)
+
+    def report(self):
+        logger.info(f"Startup profile: {self.total * 1000:.1f}ms")
+        for phase in self.phases:
+            logger.info(f"{phase.name:<20} {phase.duration * 1000:8.1f}ms  {', '.join(phase.modules)}")
+        # One parseable line for run_cold_starts
+        print(PROFILE_PREFIX + json.dumps({'total': self.total,
+                                           'phases': [phase._asdict() for phase in self.phases]}), flush=True)
+
+
+def run_cold_starts(command, runs):
+    # Every run is a fresh interpreter, so imports are never cached in-process
+    results = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        completed = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+        wall = time.perf_counter() - started
+        if completed.returncode != 0:
+            raise RuntimeError(f"{command} exited with {completed.returncode}:\n{completed.stderr[-2000:]}")
+        output = completed.stdout
+        lines = [line for line in output.splitlines() if line.startswith(PROFILE_PREFIX)]
+        if not lines:
+            raise ValueError(f"No startup profile in the output of {command}")
+        profile = json.loads(lines[-1][len(PROFILE_PREFIX):])
+        profile['wall'] = wall
+        results.append(profile)
+    return results
+
+
+def summarize(results):
+    phases = {}
+    for result in results:
+        for phase in result['phases']:
+            phases.setdefault(phase['name'], []).append(phase['duration'])
+    return {'runs': len(results),
+            'wall_median': statistics.median([result['wall'] for result in results]),
+            'total_median': statistics.median([result['total'] for result in results]),
+            'phases_median': {name: statistics.median(durations) for name, durations in phases.items()}}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Cold-start benchmark of an entry point, e.g. "
+                                                 "startup_profile.py --runs 5 -- adwords_mql_updater.py -c prod.ini")
+    parser.add_argument("--runs", type=int, default=5, help="Fresh interpreter runs")
+    parser.add_argument("--output", type=str, help="JSON file for the results")
+    parser.add_argument("script", nargs=argparse.REMAINDER, help="Entry point and its arguments")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s [%(filename)s.%(lineno)d] %(levelname)-1s %(name)s - %(message)s')
+    args = parse_args()
+    script = [arg for arg in args.script if arg != '--']
+    command = [sys.executable] + script + ['--profile_startup']
+    results = run_cold_starts(command, args.runs)
+    summary = summarize(results)
+    summary['command'] = script
+    logger.info(f"Cold start of {os.path.basename(script[0])}: wall {summary['wall_median'] * 1000:.0f}ms, "
+                f"profiled {summary['total_median'] * 1000:.0f}ms (median of {summary['runs']})")
+    for name, duration in summary['phases_median'].items():
+        logger.info(f"{name:<20} {duration * 1000:8.1f}ms")
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(dict(summary, results=results), output_file, indent=2)
@@ -0,0 +1,82 @@
+import numpy as np
+import pandas as pd
+
+from schema import STAT_TAGS_COLUMNS, AMOUNT_COLUMNS, COUNT_COLUMNS, BOOLEAN, apply_schema
+
+CURRENCY_IDS = [1, 2, 4, 5, 6, 7, 8]
+CLIENT_PLATFORM_IDS = [2, 3, 9, 12]
+LOCALES = ['en_US', 'ru_RU', 'es_ES', 'pt_PT', 'th_TH']
+
+# Column order of sql_user_data and sql_user_stat_tags_gp in the updater
+USER_DATA_COLUMNS = ['user_id', 'locale', 'age', 'country_id', 'gender', 'currency_id', 'client_platform_id',
+                     'is_trial', 'is_regulated', 'is_public', 'has_nik', 'created', 'window_end', 'window_closed',
+                     'volume_train_digital', 'pnl_train_digital', 'volume_train_cfd', 'pnl_train_cfd',
+                     'volume_train_forex', 'pnl_train_forex', 'volume_train_crypto', 'pnl_train_crypto',
+                     'closed_count', 'instrument_actives_count', 'instrument_actives_digital_count',
+                     'instrument_actives_cfd_count', 'instrument_actives_forex_count',
+                     'instrument_actives_crypto_count', 'digital_count', 'cfd_count', 'forex_count', 'crypto_count',
+                     'bin_count', 'volume_train_bin', 'pnl_train_bin', 'instrument_actives_bin_count']
+USER_TAGS_COLUMNS = ['user_id'] + STAT_TAGS_COLUMNS
+
+
+def synthetic_user_data(user_ids, random_state=0, created_from='2018-01-01', created_days=180):
+    # Rows shaped like the result of the scoring and dataset queries, with the schema dtypes. Deposits
+    # depend on activity, so models trained on it have something to find.
+    rng = np.random.RandomState(random_state)
+    n_rows = len(user_ids)
+    activity = rng.gamma(0.5, 2.0, n_rows)
+    created = pd.Timestamp(created_from) + pd.to_timedelta(rng.randint(0, created_days * 86400, n_rows), 's')
+    columns = {
+        'user_id': np.asarray(user_ids, dtype=np.int64),
+        'locale': rng.choice(LOCALES, n_rows),
+        'age': np.where(rng.rand(n_rows) < 0.05, np.nan, rng.randint(14, 90, n_rows)).astype(np.float32),
+        'country_id': rng.randint(1, 200, n_rows).astype(np.float64),
+        'gender': rng.choice([1, 2, np.nan], n_rows, p=[0.6, 0.35, 0.05]).astype(np.float32),
+        'currency_id': rng.choice(CURRENCY_IDS, n_rows).astype(np.float32),
+        'client_platform_id': rng.choice(CLIENT_PLATFORM_IDS, n_rows).astype(np.float32),
+    }
+    for column in ['is_trial', 'is_regulated', 'is_public', 'has_nik']:
+        columns[column] = pd.array(rng.rand(n_rows) < 0.3, dtype=BOOLEAN)
+    columns['created'] = created
+    columns['window_end'] = created + pd.Timedelta(days=1)
+    columns['window_closed'] = pd.array(np.ones(n_rows, dtype=bool), dtype=BOOLEAN)
+    for column in STAT_TAGS_COLUMNS:
+        columns[column] = (rng.rand(n_rows) < np.clip(0.1 * activity, 0, 0.9)).astype(np.int32)
+    for column in COUNT_COLUMNS:
+        columns[column] = rng.poisson(activity * 3).astype(np.int32)
+    for column in AMOUNT_COLUMNS:
+        volume = rng.exponential(50.0, n_rows) * (activity > 0.5)
+        amount = rng.normal(0, 0.3, n_rows) * volume if column.startswith('pnl') else volume
+        columns[column] = amount.astype(np.float32)
+    logit = -3.0 + 0.4 * columns['closed_count'] + 1.5 * columns['phone_confirmed'] + \
+        0.8 * columns['visit_traderoom']
+    deposit_proba = 1.0 / (1.0 + np.exp(-np.clip(logit, -30, 30)))
+    columns['deposits'] = ((rng.rand(n_rows) < deposit_proba) * rng.randint(1, 5, n_rows)).astype(np.int32)
+    df = pd.DataFrame(columns)
+    return apply_schema(df)
+
+
+class SyntheticFeatureSource:
+    # Feature source for offline runs: every requested user exists and gets generated features
+    def __init__(self, random_state=0):
+        self.random_state = random_state
+        self._calls = 0
+
+    def fetch(self, user_ids):
+        self._calls += 1
+        return synthetic_user_data(user_ids, random_state=self.random_state + self._calls)
+
+    def close(self):
+        pass
+
+
+def synthetic_scoring_frames(user_ids, random_state=0, tagged_share=0.7):
+    # The two frames the updater copies from GP for a chunk of users. Only users with tags have a row in
+    # the second one (some of them with all counters zero), and both come in no particular order.
+    df = synthetic_user_data(user_ids, random_state=random_state)
+    rng = np.random.RandomState(random_state + 1)
+    has_tags = (df[STAT_TAGS_COLUMNS].values > 0).any(axis=1) | (rng.rand(len(df)) < tagged_share)
+    user_data = df[USER_DATA_COLUMNS].take(rng.permutation(len(df))).reset_index(drop=True)
+    user_tags = df.loc[has_tags, USER_TAGS_COLUMNS]
+    user_tags = user_tags.take(rng.permutation(len(user_tags))).reset_index(drop=True)
+    return user_data, user_tags
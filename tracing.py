@@ -0,0 +1,172 @@
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+STAGE_SPAN = 'stage'
+METRICS_PREFIX = 'ltv_updater'
+
+
+class Span:
+    # rows and bytes are filled in by the traced block
+    __slots__ = ('name', 'stage', 'chunk', 'started', 'duration', 'rows', 'bytes', 'error')
+
+    def __init__(self, name, stage, chunk):
+        self.name = name
+        self.stage = stage
+        self.chunk = chunk
+        self.started = time.time()
+        self.duration = 0.0
+        self.rows = None
+        self.bytes = None
+        self.error = False
+
+    def as_dict(self):
+        return {slot: getattr(self, slot) for slot in self.__slots__}
+
+
+class Tracer:
+    # Wall time, rows and bytes of the steps of one run. Stages run on their own threads, so the current stage
+    # is kept per thread; work handed to another thread binds the stage with in_stage(). Disabled tracers
+    # record nothing, so long-running users of the traced functions don't accumulate spans.
+    def __init__(self):
+        self.enabled = False
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.reset()
+
+    def enable(self):
+        self.enabled = True
+
+    def reset(self):
+        with self._lock:
+            self.spans = []
+            self.started = time.time()
+
+    def current_stage(self):
+        return getattr(self._local, 'stage', None)
+
+    @contextmanager
+    def in_stage(self, stage):
+        previous = self.current_stage()
+        self._local.stage = stage
+        try:
+            yield
+        finally:
+            self._local.stage = previous
+
+    @contextmanager
+    def span(self, name, chunk=None):
+        span = Span(name, self.current_stage(), chunk)
+        started = time.perf_counter()
+        try:
+            yield span
+        except BaseException:
+            span.error = True
+            raise
+        finally:
+            span.duration = time.perf_counter() - started
+            if self.enabled:
+                with self._lock:
+                    self.spans.append(span)
+
+    def run_stage(self, stage, fn):
+        with self.in_stage(stage), self.span(STAGE_SPAN):
+            return fn()
+
+    def summary(self):
+        with self._lock:
+            spans = list(self.spans)
+        stages = {}
+        totals = {}
+        for span in spans:
+            if span.name == STAGE_SPAN:
+                stages[span.stage] = {'seconds': span.duration, 'ok': not span.error}
+                continue
+            total = totals.setdefault((span.stage, span.name), {'stage': span.stage, 'span': span.name, 'calls': 0,
+                                                                'seconds': 0.0, 'max_seconds': 0.0, 'rows': 0,
+                                                                'bytes': 0, 'errors': 0})
+            total['calls'] += 1
+            total['seconds'] += span.duration
+            total['max_seconds'] = max(total['max_seconds'], span.duration)
+            total['rows'] += span.rows or 0
+            total['bytes'] += span.bytes or 0
+            total['errors'] += span.error
+        # Grouped by stage, in the order of the first span of every kind
+        totals = sorted(totals.values(), key=lambda total: total['stage'] or '')
+        for total in totals:
+            total['rows_per_s'] = total['rows'] / total['seconds'] if total['seconds'] > 0 else None
+        # A daemon resets the tracer after a cycle, so the next run starts with its first span, not after the sleep
+        started = min((span.started for span in spans), default=self.started)
+        return {'started': started, 'duration': time.time() - started, 'stages': stages,
+                'totals': totals, 'spans': [span.as_dict() for span in spans]}
+
+    def log_report(self, summary=None):
+        summary = self.summary() if summary is None else summary
+        logger.info("Span report:")
+        for total in summary['totals']:
+            rows_per_s = f"{total['rows_per_s']:10.0f}/s" if total['rows_per_s'] is not None else f"{'-':>12}"
+            logger.info(f"{total['stage'] or '-':<18} {total['span']:<18} {total['calls']:>5} calls "
+                        f"{total['seconds']:8.2f}s (max {total['max_seconds']:.2f}s) {total['rows']:>9} rows "
+                        f"{rows_per_s} {total['bytes'] / 2 ** 20:8.1f}MB")
+
+    def export(self, json_path=None, textfile_path=None):
+        # Called at the end of every run; failures to write are logged and don't fail the run
+        summary = self.summary()
+        self.log_report(summary)
+        try:
+            if json_path:
+                write_atomically(json_path, json.dumps(summary, indent=2))
+            if textfile_path:
+                write_atomically(textfile_path, prometheus_text(summary))
+        except OSError:
+            logger.exception("Can't write metrics")
+        return summary
+
+
+def prometheus_text(summary, prefix=METRICS_PREFIX):
+    # Gauges of the last run in the text exposition format, for the node_exporter textfile collector
+    metrics = [
+        ('run_timestamp_seconds', "Start of the last run", [({}, summary['started'])]),
+        ('run_duration_seconds', "Wall time of the last run", [({}, summary['duration'])]),
+        ('stage_duration_seconds', "Wall time of the stage in the last run",
+         [({'stage': stage}, result['seconds']) for stage, result in summary['stages'].items()]),
+        ('stage_success', "1 if the stage succeeded in the last run",
+         [({'stage': stage}, int(result['ok'])) for stage, result in summary['stages'].items()]),
+    ]
+    span_values = [('span_duration_seconds', "Total wall time of the spans in the last run", 'seconds'),
+                   ('span_max_duration_seconds', "Longest span in the last run", 'max_seconds'),
+                   ('span_calls', "Spans in the last run", 'calls'),
+                   ('span_rows', "Rows handled by the spans in the last run", 'rows'),
+                   ('span_bytes', "Bytes transferred by the spans in the last run", 'bytes'),
+                   ('span_errors', "Failed spans in the last run", 'errors')]
+    for name, help_text, field in span_values:
+        metrics.append((name, help_text, [({'stage': total['stage'] or '', 'span': total['span']}, total[field])
+                                          for total in summary['totals']]))
+    lines = []
+    for name, help_text, samples in metrics:
+        lines.append(f"# HELP {prefix}_{name} {help_text}")
+        lines.append(f"# TYPE {prefix}_{name} gauge")
+        for labels, value in samples:
+            label_text = ','.join(f'{key}="{escape_label(label)}"' for key, label in labels.items())
+            lines.append(f"{prefix}_{name}{{{label_text}}} {value}" if label_text else f"{prefix}_{name} {value}")
+    return '\n'.join(lines) + '\n'
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def write_atomically(path, text):
+    # Readers (e.g. node_exporter) never see a half-written file
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as output_file:
+        output_file.write(text)
+    os.replace(tmp_path, path)
+
+
+tracer = Tracer()
@@ -0,0 +1,116 @@
+import json
+import logging
+import os
+
+import numpy as np
+import sklearn
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.externals import joblib
+
+from columnar import read_columnar
+from evaluation import ThresholdSweep, THRESHOLD_YOUDEN, DEFAULT_BOOTSTRAP
+from tree_artifact import write_artifact, ARTIFACT_SUFFIX, ARTIFACT_VERSION
+from tree_engine import CompiledForest
+
+DATASET_PATH = "mql_data/mql_dataset"
+TEST_SIZE = 0.33
+SPLIT_RANDOM_STATE = 13
+
+logger = logging.getLogger(__name__)
+
+
+def load_training_data(encoder, dataset_path=DATASET_PATH):
+    logger.info(f"Read data {dataset_path}...")
+    data = read_columnar(dataset_path, encoder.source_columns + ['deposits'])
+    return to_clf_data(data, encoder)
+
+
+def to_clf_data(df, encoder):
+    X = encoder.encode(df)
+    y = (df['deposits'] > 0).values
+    return X, y
+
+
+def make_forest(params, n_jobs=1, random_state=0, verbose=0):
+    return RandomForestClassifier(n_jobs=n_jobs, random_state=random_state, verbose=verbose,
+                                  class_weight="balanced_subsample", **params)
+
+
+def evaluate_and_save(clf, X_test, y_test, feature_columns, model_name, extra_fields=None,
+                      threshold_method=THRESHOLD_YOUDEN, threshold_target=None, n_bootstrap=DEFAULT_BOOTSTRAP):
+    logger.info("Test classifier")
+    y_predict_prob = clf.predict_proba(X_test)[:, 1]
+    sweep = ThresholdSweep(y_test, y_predict_prob)
+    threshold_index = sweep.select(threshold_method, threshold_target)
+    metrics = sweep.at(threshold_index)
+    roc_auc = metrics['roc_auc']
+    logger.info(f"Roc_auc:{roc_auc}")
+    main_threshold = metrics['threshold']
+    logger.info(f"Threshold ({threshold_method}):{main_threshold}")
+    cnf_matrix = sweep.confusion_matrix(threshold_index)
+    logger.info(f"Confusion matrix:\n{cnf_matrix}")
+    ncnf_matrix = cnf_matrix.astype('float') / cnf_matrix.sum(axis=1)[:, np.newaxis]
+    logger.info(f"Confusion matrix normalized:\n{ncnf_matrix}")
+    acc = metrics['accuracy']
+    prec = metrics['precision']
+    rec = metrics['recall']
+    f1_s = metrics['f1']
+    logger.info(f"Accuracy:{acc}")
+    logger.info(f"Precision:{prec}")
+    logger.info(f"Recall:{rec}")
+    logger.info(f"F1_score:{f1_s}")
+    confidence_intervals = sweep.bootstrap(threshold_index, n_bootstrap) if n_bootstrap > 0 else {}
+    for name, (low, high) in confidence_intervals.items():
+        logger.info(f"{name} 95% CI: [{low:.4f}, {high:.4f}]")
+    imp_f = sorted(list(zip(feature_columns, clf.feature_importances_)), key=lambda x: -x[1])
+    logger.info("Feature importance:")
+    for f, i in imp_f:
+        logger.info(f"{f},{i}")
+
+    json_data = {"sklearn_v": sklearn.__version__,
+                 "roc_auc": roc_auc,
+                 "main_threshold": main_threshold,
+                 "accuracy": acc, "precision": prec,
+                 "recall": rec, "feature_columns": feature_columns,
+                 "f1": f1_s, "threshold_method": threshold_method,
+                 "confidence_intervals": confidence_intervals}
+    json_data.update(extra_fields or {})
+    save_model(clf, model_name, json_data)
+    return json_data
+
+
+def save_model(clf, model_name, json_data):
+    model_filename = model_name + '.pkl'
+    joblib.dump(clf, model_filename)
+    export_artifact(clf, model_name, json_data)
+    with open(model_name + '.json', 'w') as outfile:
+        json.dump(json_data, outfile)
+    logger.info(f"Save model to {model_filename}")
+
+
+def export_saved_model(model_name):
+    # Adds the artifact to a model saved before the artifact format existed
+    logger.info(f"Read model {model_name}.pkl")
+    clf = joblib.load(model_name + '.pkl')
+    with open(model_name + '.json') as cfg_file:
+        json_data = json.load(cfg_file)
+    export_artifact(clf, model_name, json_data)
+    with open(model_name + '.json', 'w') as outfile:
+        json.dump(json_data, outfile)
+    return json_data
+
+
+def export_artifact(clf, model_name, json_data):
+    # The artifact is what read_model serves: no pickle and no sklearn version pinning
+    try:
+        compiled = clf if isinstance(clf, CompiledForest) else CompiledForest.from_sklearn(clf)
+    except ValueError as e:
+        logger.warning(f"Can't export tree artifact, the pickle will be served: {e}")
+        json_data.pop('artifact', None)
+        return None
+    artifact_filename = model_name + ARTIFACT_SUFFIX
+    json_data['artifact'] = os.path.basename(artifact_filename)
+    json_data['artifact_version'] = ARTIFACT_VERSION
+    write_artifact(compiled, artifact_filename, metadata=json_data)
+    logger.info(f"Export tree artifact to {artifact_filename}")
+    return artifact_filename
@@ -0,0 +1,107 @@
+import json
+import mmap
+import os
+import struct
+
+import numpy as np
+
+from tree_engine import CompiledForest, CompiledBoosting, ENGINE_RANDOM_FOREST, ENGINE_HIST_GBM
+
+ARTIFACT_SUFFIX = '.trees'
+ARTIFACT_MAGIC = b'LTVTREES'
+ARTIFACT_VERSION = 1
+ALIGNMENT = 64
+# magic, format version, header length
+PREAMBLE = struct.Struct('<8sII')
+
+# Fixed little-endian dtypes, so the file means the same on every machine. Features are stored as
+# int64 (np.intp on 64-bit), which lets the engine use the mapped arrays without a copy.
+ARRAY_DTYPES = {'feature': '<i8', 'threshold': '<f4', 'value': '<f8', 'feature_importances': '<f8'}
+
+
+def write_artifact(clf, path, metadata=None):
+    # File layout: preamble, JSON header, then every array aligned to ALIGNMENT bytes
+    if isinstance(clf, CompiledBoosting):
+        engine, baseline = ENGINE_HIST_GBM, clf.baseline
+    elif isinstance(clf, CompiledForest):
+        engine, baseline = ENGINE_RANDOM_FOREST, None
+    else:
+        raise ValueError(f"Can't export {type(clf).__name__}, compile the model first")
+    arrays = {'feature': clf.feature, 'threshold': clf.threshold, 'value': clf.value}
+    feature_importances = getattr(clf, 'feature_importances_', None)
+    if feature_importances is not None:
+        arrays['feature_importances'] = feature_importances
+    arrays = {name: np.ascontiguousarray(array, dtype=ARRAY_DTYPES[name]) for name, array in arrays.items()}
+
+    header = {'engine': engine, 'max_depth': clf.max_depth, 'n_features': clf.n_features,
+              'classes': clf.classes_.tolist(), 'baseline': baseline, 'metadata': metadata or {}, 'arrays': {}}
+    # Offsets depend on the header length, which depends on the offsets: size it with the widest offsets
+    header_size = len(_encode_header(header, arrays, 10 ** 18))
+    offset = _align(PREAMBLE.size + header_size)
+    for name, array in arrays.items():
+        header['arrays'][name] = {'dtype': ARRAY_DTYPES[name], 'shape': list(array.shape), 'offset': offset}
+        offset = _align(offset + array.nbytes)
+    header_bytes = json.dumps(header).encode().ljust(header_size)
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as artifact_file:
+        artifact_file.write(PREAMBLE.pack(ARTIFACT_MAGIC, ARTIFACT_VERSION, header_size))
+        artifact_file.write(header_bytes)
+        for name, array in arrays.items():
+            artifact_file.seek(header['arrays'][name]['offset'])
+            artifact_file.write(array.tobytes())
+        artifact_file.truncate(offset)
+    os.replace(tmp_path, path)
+    return path
+
+
+def read_header(path):
+    with open(path, 'rb') as artifact_file:
+        return _parse_header(artifact_file.read(PREAMBLE.size), artifact_file, path)
+
+
+def read_artifact(path, mmap_mode=True):
+    # With mmap_mode the arrays are read-only views of the page cache, shared by every process that maps the file
+    with open(path, 'rb') as artifact_file:
+        header = _parse_header(artifact_file.read(PREAMBLE.size), artifact_file, path)
+        if mmap_mode:
+            buffer = mmap.mmap(artifact_file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            artifact_file.seek(0)
+            buffer = artifact_file.read()
+    arrays = {name: np.frombuffer(buffer, dtype=spec['dtype'], count=int(np.prod(spec['shape'])),
+                                  offset=spec['offset']).reshape(spec['shape'])
+              for name, spec in header['arrays'].items()}
+    params = dict(feature=arrays['feature'], threshold=arrays['threshold'], value=arrays['value'],
+                  max_depth=header['max_depth'], n_features=header['n_features'], classes=header['classes'])
+    if header['engine'] == ENGINE_HIST_GBM:
+        clf = CompiledBoosting(baseline=header['baseline'], feature_importances=arrays.get('feature_importances'),
+                               **params)
+    elif header['engine'] == ENGINE_RANDOM_FOREST:
+        clf = CompiledForest(**params)
+        clf.feature_importances_ = arrays.get('feature_importances')
+    else:
+        raise ValueError(f"Unknown engine '{header['engine']}' in {path}")
+    clf.metadata = header['metadata']
+    return clf
+
+
+def _parse_header(preamble, artifact_file, path):
+    if len(preamble) < PREAMBLE.size:
+        raise ValueError(f"Not a tree artifact: {path}")
+    magic, version, header_size = PREAMBLE.unpack(preamble)
+    if magic != ARTIFACT_MAGIC:
+        raise ValueError(f"Not a tree artifact: {path}")
+    if version != ARTIFACT_VERSION:
+        raise ValueError(f"Unsupported artifact version {version} in {path}, expected {ARTIFACT_VERSION}")
+    return json.loads(artifact_file.read(header_size).decode())
+
+
+def _encode_header(header, arrays, offset):
+    sized = dict(header, arrays={name: {'dtype': ARRAY_DTYPES[name], 'shape': list(array.shape), 'offset': offset}
+                                 for name, array in arrays.items()})
+    return json.dumps(sized).encode()
+
+
+def _align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
@@ -0,0 +1,150 @@
+import numpy as np
+
+TREE_LEAF = -1
+MAX_COMPILED_DEPTH = 12
+DEFAULT_BLOCK_SIZE = 256
+# Value of the "engine" field in the model json
+ENGINE_RANDOM_FOREST = 'random_forest'
+ENGINE_HIST_GBM = 'hist_gbm'
+
+
+def threshold_to_float32(threshold):
+    # sklearn casts X to float32 and compares it with float64 thresholds. Rounding the threshold down
+    # to the nearest float32 keeps `x <= threshold` exact for every float32 x.
+    threshold = np.asarray(threshold, dtype=np.float64)
+    result = threshold.astype(np.float32)
+    rounded_up = result > threshold
+    result[rounded_up] = np.nextafter(result[rounded_up], np.float32(-np.inf))
+    return result
+
+
+class CompiledForest:
+    # Every tree is stored as a complete binary tree of depth max_depth in heap order: children of
+    # slot i are 2i+1 and 2i+2. Leaves above max_depth are padded with always-left splits, so each
+    # level of traversal is three gathers and a comparison for all trees and samples at once.
+    def __init__(self, feature, threshold, value, max_depth, n_features, classes):
+        self.max_depth = int(max_depth)
+        self.n_features = int(n_features)
+        self.classes_ = np.asarray(classes)
+        self.feature = np.ascontiguousarray(feature, dtype=np.intp)
+        self.threshold = np.ascontiguousarray(threshold, dtype=np.float32)
+        self.value = np.ascontiguousarray(value, dtype=np.float64)
+        self.n_trees = len(self.value) // self.n_leaves
+        self._tree_offsets = (np.arange(self.n_trees, dtype=np.intp) * self.n_splits)[:, np.newaxis]
+        self._leaf_offsets = (np.arange(self.n_trees, dtype=np.intp) * self.n_leaves - self.n_splits)[:, np.newaxis]
+
+    @property
+    def n_splits(self):
+        return 2 ** self.max_depth - 1
+
+    @property
+    def n_leaves(self):
+        return 2 ** self.max_depth
+
+    @classmethod
+    def from_sklearn(cls, forest):
+        max_depth = max(estimator.tree_.max_depth for estimator in forest.estimators_)
+        if max_depth > MAX_COMPILED_DEPTH:
+            raise ValueError(f"Forest depth {max_depth} exceeds {MAX_COMPILED_DEPTH}")
+        n_splits = 2 ** max_depth - 1
+        n_trees = len(forest.estimators_)
+        n_classes = forest.n_classes_
+        feature = np.zeros((n_trees, n_splits), dtype=np.intp)
+        threshold = np.full((n_trees, n_splits), np.inf)
+        value = np.zeros((n_trees, n_splits + 1, n_classes))
+        for tree_num, estimator in enumerate(forest.estimators_):
+            tree = estimator.tree_
+            # Same normalisation as DecisionTreeClassifier.predict_proba
+            node_value = tree.value[:, 0, :]
+            normalizer = node_value.sum(axis=1)[:, np.newaxis]
+            normalizer[normalizer == 0.0] = 1.0
+            node_value = node_value / normalizer
+
+            stack = [(0, 0, 0)]
+            while stack:
+                node, slot, depth = stack.pop()
+                if depth == max_depth:
+                    value[tree_num, slot - n_splits] = node_value[node]
+                    continue
+                left, right = tree.children_left[node], tree.children_right[node]
+                if left == TREE_LEAF:
+                    left = right = node
+                else:
+                    feature[tree_num, slot] = tree.feature[node]
+                    threshold[tree_num, slot] = tree.threshold[node]
+                stack.append((left, 2 * slot + 1, depth + 1))
+                stack.append((right, 2 * slot + 2, depth + 1))
+        return cls(feature=feature.ravel(),
+                   threshold=threshold_to_float32(threshold.ravel()),
+                   value=value.reshape(-1, n_classes),
+                   max_depth=max_depth,
+                   n_features=forest.n_features_,
+                   classes=forest.classes_)
+
+    def apply(self, X):
+        # Leaf ids into self.value with shape (n_trees, n_samples)
+        X = self._check_input(X)
+        n_samples = X.shape[0]
+        x_flat = X.ravel()
+        row_offsets = np.arange(n_samples, dtype=np.intp) * self.n_features
+        slots = np.zeros((self.n_trees, n_samples), dtype=np.intp)
+        index = np.empty_like(slots)
+        x_values = np.empty(slots.shape, dtype=np.float32)
+        thresholds = np.empty(slots.shape, dtype=np.float32)
+        go_left = np.empty(slots.shape, dtype=bool)
+        for _ in range(self.max_depth):
+            np.add(slots, self._tree_offsets, out=index)
+            np.take(self.threshold, index, out=thresholds)
+            np.take(self.feature, index, out=index)
+            index += row_offsets
+            np.take(x_flat, index, out=x_values)
+            np.less_equal(x_values, thresholds, out=go_left)
+            slots *= 2
+            slots += 2
+            slots -= go_left
+        slots += self._leaf_offsets
+        return slots
+
+    def predict_proba(self, X, block_size=DEFAULT_BLOCK_SIZE):
+        X = self._check_input(X)
+        n_samples = X.shape[0]
+        n_classes = self.value.shape[1]
+        proba = np.empty((n_samples, n_classes), dtype=np.float64)
+        for start in range(0, n_samples, block_size):
+            stop = min(start + block_size, n_samples)
+            leaves = self.apply(X[start:stop])
+            for class_idx in range(n_classes):
+                # Reducing over the tree axis adds trees one after another, like the sklearn forest does
+                np.sum(self.value[:, class_idx][leaves], axis=0, out=proba[start:stop, class_idx])
+        proba /= self.n_trees
+        return proba
+
+    def _check_input(self, X):
+        X = np.ascontiguousarray(X, dtype=np.float32)
+        if X.ndim != 2 or X.shape[1] != self.n_features:
+            raise ValueError(f"Expected X with {self.n_features} features, got shape {X.shape}")
+        return X
+
+
+class CompiledBoosting(CompiledForest):
+    # Gradient boosted trees in the same heap layout. Leaves hold raw scores with the learning rate
+    # applied, the positive class probability is the logistic function of baseline + sum of leaf scores.
+    def __init__(self, feature, threshold, value, max_depth, n_features, classes, baseline,
+                 feature_importances=None):
+        super().__init__(feature, threshold, np.reshape(value, (-1, 1)), max_depth, n_features, classes)
+        self.baseline = float(baseline)
+        self.feature_importances_ = feature_importances
+
+    def decision_function(self, X, block_size=DEFAULT_BLOCK_SIZE):
+        X = self._check_input(X)
+        raw = np.empty(X.shape[0], dtype=np.float64)
+        scores = self.value[:, 0]
+        for start in range(0, X.shape[0], block_size):
+            stop = min(start + block_size, X.shape[0])
+            np.sum(scores[self.apply(X[start:stop])], axis=0, out=raw[start:stop])
+        raw += self.baseline
+        return raw
+
+    def predict_proba(self, X, block_size=DEFAULT_BLOCK_SIZE):
+        positive = 1.0 / (1.0 + np.exp(-self.decision_function(X, block_size)))
+        return np.column_stack([1.0 - positive, positive])
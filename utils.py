@@ -1,3 +1,5 @@
+from functools import lru_cache
+
 FEATURE_COLUMNS = ['b_actives_real_count',
                    'b_actives_train_count',
                    'b_deals',
@@ -71,6 +73,30 @@ FEATURE_COLUMNS = ['b_actives_real_count',
                    'is_trial']
 
 
+ENGINEERED_COLUMNS = ['age_18_24', 'age_24_30', 'age_30_40', 'age_40_50', 'age_50_80', 'age_trash', 'locale_en_US',
+                      'locale_pt_PT', 'locale_id_ID', 'locale_es_ES', 'locale_de_DE', 'locale_ru_RU',
+                      'locale_fr_FR', 'locale_it_IT', 'locale_th_TH', 'locale_ko_KO', 'locale_zh_CN',
+                      'locale_tr_TR', 'locale_ar_KW', 'locale_sv_SE', 'locale_no_NO', 'country_id_225',
+                      'country_id_94', 'country_id_30', 'country_id_194', 'country_id_151', 'country_id_119',
+                      'country_id_162', 'country_id_128', 'country_id_78', 'country_id_206', 'country_id_200',
+                      'country_id_180', 'country_id_205', 'country_id_157', 'country_id_97', 'country_id_72',
+                      'country_id_181', 'country_id_175', 'country_id_164', 'country_id_212', 'country_id_91',
+                      'country_id_182', 'country_id_140', 'country_id_46', 'country_id_204', 'country_id_18',
+                      'country_id_134', 'country_id_183', 'country_id_146', 'country_id_191', 'country_id_189',
+                      'country_id_171', 'country_id_10', 'country_id_62', 'country_id_220', 'country_id_2',
+                      'country_id_211', 'country_id_14', 'country_id_159', 'country_id_156', 'country_id_101',
+                      'country_id_160', 'country_id_108', 'country_id_3', 'country_id_55', 'country_id_0',
+                      'country_id_95', 'country_id_42', 'country_id_61', 'country_id_59', 'country_id_188',
+                      'country_id_77', 'country_id_113', 'country_id_92', 'country_id_79', 'country_id_102',
+                      'country_id_100', 'country_id_143', 'country_id_32', 'country_id_130', 'country_id_139',
+                      'country_id_104', 'country_id_15', 'country_id_81', 'country_id_20', 'country_id_176',
+                      'gender_1', 'gender_2', 'currency_id_5', 'currency_id_1', 'currency_id_2', 'currency_id_6',
+                      'currency_id_7', 'currency_id_4', 'currency_id_8', 'currency_id_9', 'currency_id_43',
+                      'currency_id_10', 'currency_id_3', 'client_platform_id_2', 'client_platform_id_9',
+                      'client_platform_id_3', 'client_platform_id_12', 'client_platform_id_1000',
+                      'client_platform_id_14', 'client_platform_id_13', 'is_public_1', 'is_public_0']
+
+
 def rename_columns(prefix, df):
     column_mapper = {x: f"{prefix}{x}" for x in df.columns.values if x != 'user_id'}
     return df.rename(index=str, columns=column_mapper)
@@ -163,134 +189,21 @@ def sql_stat_tags_dataset(days_after_reg):
     """
 
 
+@lru_cache(maxsize=None)
+def cached_encoder(feature_columns):
+    # Rules are compiled once per column list. Imported here: the updater uses this module only for SQL and
+    # must not pay for pandas at startup.
+    from feature_encoder import FeatureEncoder
+
+    return FeatureEncoder(list(feature_columns))
+
+
 def features_engineering(df):
-    # Features
-    # age
-    df["age_18_24"] = ((df["age"] >= 18) & (df["age"] < 24))
-    df["age_24_30"] = ((df["age"] >= 24) & (df["age"] < 30))
-    df["age_30_40"] = ((df["age"] >= 30) & (df["age"] < 40))
-    df["age_40_50"] = ((df["age"] >= 40) & (df["age"] < 50))
-    df["age_50_80"] = ((df["age"] >= 50) & (df["age"] <= 80))
-    df["age_trash"] = ((df["age"] < 18) | (df["age"] > 80))
-    # locle
-
-    df["locale_en_US"] = df["locale"] == "en_US"
-    df["locale_pt_PT"] = df["locale"] == "pt_PT"
-    df["locale_id_ID"] = df["locale"] == "id_ID"
-    df["locale_es_ES"] = df["locale"] == "es_ES"
-    df["locale_de_DE"] = df["locale"] == "de_DE"
-    df["locale_ru_RU"] = df["locale"] == "ru_RU"
-    df["locale_fr_FR"] = df["locale"] == "fr_FR"
-    df["locale_it_IT"] = df["locale"] == "it_IT"
-    df["locale_th_TH"] = df["locale"] == "th_TH"
-    df["locale_ko_KO"] = df["locale"] == "ko_KO"
-    df["locale_zh_CN"] = df["locale"] == "zh_CN"
-    df["locale_tr_TR"] = df["locale"] == "tr_TR"
-    df["locale_ar_KW"] = df["locale"] == "ar_KW"
-    df["locale_sv_SE"] = df["locale"] == "sv_SE"
-    df["locale_no_NO"] = df["locale"] == "no_NO"
-
-    # country
-    df['country_id_225'] = df['country_id'] == 225
-    df['country_id_94'] = df['country_id'] == 94
-    df['country_id_30'] = df['country_id'] == 30
-    df['country_id_194'] = df['country_id'] == 194
-    df['country_id_151'] = df['country_id'] == 151
-    df['country_id_119'] = df['country_id'] == 119
-    df['country_id_162'] = df['country_id'] == 162
-    df['country_id_128'] = df['country_id'] == 128
-    df['country_id_78'] = df['country_id'] == 78
-    df['country_id_206'] = df['country_id'] == 206
-    df['country_id_200'] = df['country_id'] == 200
-    df['country_id_180'] = df['country_id'] == 180
-    df['country_id_205'] = df['country_id'] == 205
-    df['country_id_157'] = df['country_id'] == 157
-    df['country_id_97'] = df['country_id'] == 97
-    df['country_id_72'] = df['country_id'] == 72
-    df['country_id_181'] = df['country_id'] == 181
-    df['country_id_175'] = df['country_id'] == 175
-    df['country_id_164'] = df['country_id'] == 164
-    df['country_id_212'] = df['country_id'] == 212
-    df['country_id_91'] = df['country_id'] == 91
-    df['country_id_182'] = df['country_id'] == 182
-    df['country_id_140'] = df['country_id'] == 140
-    df['country_id_46'] = df['country_id'] == 46
-    df['country_id_204'] = df['country_id'] == 204
-    df['country_id_18'] = df['country_id'] == 18
-    df['country_id_134'] = df['country_id'] == 134
-    df['country_id_183'] = df['country_id'] == 183
-    df['country_id_146'] = df['country_id'] == 146
-    df['country_id_191'] = df['country_id'] == 191
-    df['country_id_189'] = df['country_id'] == 189
-    df['country_id_171'] = df['country_id'] == 171
-    df['country_id_10'] = df['country_id'] == 10
-    df['country_id_62'] = df['country_id'] == 62
-    df['country_id_220'] = df['country_id'] == 220
-    df['country_id_2'] = df['country_id'] == 2
-    df['country_id_211'] = df['country_id'] == 211
-    df['country_id_14'] = df['country_id'] == 14
-    df['country_id_159'] = df['country_id'] == 159
-    df['country_id_156'] = df['country_id'] == 156
-    df['country_id_101'] = df['country_id'] == 101
-    df['country_id_160'] = df['country_id'] == 160
-    df['country_id_108'] = df['country_id'] == 108
-    df['country_id_3'] = df['country_id'] == 3
-    df['country_id_55'] = df['country_id'] == 55
-    df['country_id_0'] = df['country_id'] == 0
-    df['country_id_95'] = df['country_id'] == 95
-    df['country_id_42'] = df['country_id'] == 42
-    df['country_id_61'] = df['country_id'] == 61
-    df['country_id_59'] = df['country_id'] == 59
-    df['country_id_188'] = df['country_id'] == 188
-    df['country_id_77'] = df['country_id'] == 77
-    df['country_id_113'] = df['country_id'] == 113
-    df['country_id_92'] = df['country_id'] == 92
-    df['country_id_79'] = df['country_id'] == 79
-    df['country_id_102'] = df['country_id'] == 102
-    df['country_id_100'] = df['country_id'] == 100
-    df['country_id_143'] = df['country_id'] == 143
-    df['country_id_32'] = df['country_id'] == 32
-    df['country_id_130'] = df['country_id'] == 130
-    df['country_id_139'] = df['country_id'] == 139
-    df['country_id_104'] = df['country_id'] == 104
-    df['country_id_15'] = df['country_id'] == 15
-    df['country_id_81'] = df['country_id'] == 81
-    df['country_id_20'] = df['country_id'] == 20
-    df['country_id_176'] = df['country_id'] == 176
-
-    # gender
-    df["gender_1"] = df["gender"] == 1
-    df["gender_2"] = df["gender"] == 2
-
-    # currency_id
-    df['currency_id_5'] = df['currency_id'] == 5
-    df['currency_id_1'] = df['currency_id'] == 1
-    df['currency_id_2'] = df['currency_id'] == 2
-    df['currency_id_6'] = df['currency_id'] == 6
-    df['currency_id_7'] = df['currency_id'] == 7
-    df['currency_id_4'] = df['currency_id'] == 4
-    df['currency_id_8'] = df['currency_id'] == 8
-    df['currency_id_9'] = df['currency_id'] == 9
-    df['currency_id_43'] = df['currency_id'] == 43
-    df['currency_id_10'] = df['currency_id'] == 10
-    df['currency_id_3'] = df['currency_id'] == 3
-    df['currency_id_5'] = df['currency_id'] == 5
-
-    # client_platform_id
-    df['client_platform_id_2'] = df['client_platform_id'] == 2
-    df['client_platform_id_9'] = df['client_platform_id'] == 9
-    df['client_platform_id_3'] = df['client_platform_id'] == 3
-    df['client_platform_id_12'] = df['client_platform_id'] == 12
-    df['client_platform_id_1000'] = df['client_platform_id'] == 1000
-    df['client_platform_id_14'] = df['client_platform_id'] == 14
-    df['client_platform_id_13'] = df['client_platform_id'] == 13
-
-    # logical
+    import pandas as pd
+
     df["is_trial"] = df["is_trial"].fillna(False)
     df["is_regulated"] = df["is_regulated"].fillna(False)
     df["is_public"] = df["is_public"].fillna(False)
-    df["is_public_1"] = df["is_public"] == True
-    df["is_public_0"] = df["is_public"] == False
 
     # fill na by prefix
     def fill_na_by_prefix(df, prefixs, def_na=0):
@@ -302,14 +215,18 @@ def features_engineering(df):
         df[cols_for_fill] = df[cols_for_fill].fillna(def_na)
 
     fill_na_by_prefix(df, prefixs=["b_", "n_", "c_"])
-    return df
+    # The NaNs above are filled in df in place, the bool feature columns are joined as one block into the
+    # returned frame: callers use the return value
+    encoded = pd.DataFrame(cached_encoder(tuple(ENGINEERED_COLUMNS)).encode(df).astype(bool), index=df.index,
+                           columns=ENGINEERED_COLUMNS)
+    return df.join(encoded)
 
 
 def df_to_feature_matrix(df):
-    return df[FEATURE_COLUMNS].as_matrix()
+    return cached_encoder(tuple(FEATURE_COLUMNS)).encode(df)
 
 
-def sql_commissions_dataset_for_users(user_ids, days_after_reg=1):
+def sql_commissions_dataset_for_users(user_ids_table, days_after_reg=1):
     return f"""
   SELECT
     user_id,
@@ -364,7 +281,7 @@ def sql_commissions_dataset_for_users(user_ids, days_after_reg=1):
            orders o
            JOIN users u ON u.user_id = o.user_id
          WHERE
-           o.user_id in ({",".join([str(x) for x in user_ids])}) 
+           o.user_id in (SELECT user_id FROM {user_ids_table}) 
            AND o.create_at < u.created :: DATE + INTERVAL '{days_after_reg} day'
            AND instrument_type IN ('crypto', 'cfd')
            AND status = 'filled'
@@ -382,7 +299,7 @@ def sql_commissions_dataset_for_users(user_ids, days_after_reg=1):
          FROM orders_archive oa
            JOIN users u ON u.user_id = oa.user_id
          WHERE
-           oa.user_id in ({",".join([str(x) for x in user_ids])}) 
+           oa.user_id in (SELECT user_id FROM {user_ids_table}) 
            AND oa.create_at < u.created :: DATE + INTERVAL '{days_after_reg} day'
            AND instrument_type IN ('crypto', 'cfd')
            AND status = 'filled'
@@ -392,7 +309,7 @@ def sql_commissions_dataset_for_users(user_ids, days_after_reg=1):
     """
 
 
-def sql_new_instruments_dataset_for_users(user_ids, days_after_reg=1):
+def sql_new_instruments_dataset_for_users(user_ids_table, days_after_reg=1):
     return f"""
      SELECT
       --   digital-option
@@ -550,13 +467,13 @@ def sql_new_instruments_dataset_for_users(user_ids, days_after_reg=1):
       JOIN users u ON u.user_id = ap.user_id
       JOIN user_balance ub ON ap.user_balance_id = ub.id
     WHERE
-      ap.user_id IN ({",".join([str(x) for x in user_ids])})
+      ap.user_id IN (SELECT user_id FROM {user_ids_table})
       AND ap.create_at < u.created :: DATE + INTERVAL '{days_after_reg} day'
     GROUP BY ap.user_id
     """
 
 
-def sql_binary_dataset_for_users(user_ids, days_after_reg=1):
+def sql_binary_dataset_for_users(user_ids_table, days_after_reg=1):
     return f"""
     SELECT
     ao.user_id,
@@ -589,13 +506,13 @@ def sql_binary_dataset_for_users(user_ids, days_after_reg=1):
     JOIN users u ON u.user_id = ao.user_id
     JOIN user_balance ub ON ao.user_balance_id = ub.id
   WHERE
-    ao.user_id in ({",".join([str(x) for x in user_ids])}) 
+    ao.user_id in (SELECT user_id FROM {user_ids_table}) 
     AND ao.created < u.created :: DATE + INTERVAL '{days_after_reg} day'
   GROUP BY ao.user_id
     """
 
 
-def sql_user_data_dataset_for_users(user_ids):
+def sql_user_data_dataset_for_users(user_ids_table):
     return f"""
     SELECT
       user_id,
@@ -611,7 +528,7 @@ def sql_user_data_dataset_for_users(user_ids):
       is_public,
       (nickname IS NOT NULL)            AS has_nik
     FROM users u
-    WHERE u.user_id in ({",".join([str(x) for x in user_ids])})
+    WHERE u.user_id in (SELECT user_id FROM {user_ids_table})
     """
 
 
@@ -638,7 +555,7 @@ def sql_get_unhandled_mobile_users(apps_flyer_tname, adwords_mob_queue_tname):
     """
 
 
-def sql_insert_mobile_mql_for_users(adwords_mob_queue_tname, user_ids):
+def sql_insert_mobile_mql_for_users(adwords_mob_queue_tname, user_ids_table):
     return f"""
     WITH T_apps_flyer AS
 (
@@ -667,7 +584,7 @@ def sql_insert_mobile_mql_for_users(adwords_mob_queue_tname, user_ids):
               OVER (
                 PARTITION BY first_connected_user ) END) last_install
         FROM apps_flyer
-        WHERE first_connected_user IN ({",".join([str(x) for x in user_ids])})
+        WHERE first_connected_user IN (SELECT user_id FROM {user_ids_table})
       ) AS t
     WHERE install_time = last_install
 )
@@ -735,13 +652,12 @@ def sql_get_unhandled_web_users(click_history_tname, adwords_queue_tname):
         """
 
 
-def sql_insert_web_mql_for_users(click_history_tname, adwords_queue_tname, user_ids):
+def sql_insert_web_mql_for_users(click_history_tname, adwords_queue_tname, user_ids_table):
     return f"""
     INSERT INTO {adwords_queue_tname}
     WITH mql_users AS (SELECT *
                        FROM users
-                       WHERE user_id IN
-                             ({",".join([str(x) for x in user_ids])}))
+                       WHERE user_id IN (SELECT user_id FROM {user_ids_table}))
     SELECT
       h.user_id             AS user_id,
       gclid                 AS gclid,